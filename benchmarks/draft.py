@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Compares decoding time and peak memory usage (RSS) of creating the thumbnails requested by the
+# exposure theme from a JPEG picture, with and without draft (DCT-scaled) decoding.
+#
+# Usage: python benchmarks/draft.py [picture.jpg]
+#
+# A 48MP JPEG picture is generated if none is provided.
+
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from PIL import Image, ImageChops, ImageStat
+
+from recitale.image import thumbnail_size
+
+SIZES = [(None, 450), (None, 600), (None, 800), (None, 1366), (None, 1920)]
+
+
+def render(filepath, draft):
+    start = time.perf_counter()
+    img = Image.open(filepath)
+    sizes = [thumbnail_size(img.size, size) for size in SIZES]
+
+    if draft:
+        img.draft(img.mode, (max(w for w, _ in sizes), max(h for _, h in sizes)))
+
+    img.load()
+    decoded = time.perf_counter()
+
+    thumbnails = [img.resize(size, Image.LANCZOS) for size in sizes]
+
+    end = time.perf_counter()
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return img.size, decoded - start, end - decoded, rss, thumbnails[0]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if len(sys.argv) > 1:
+            filepath = sys.argv[1]
+        else:
+            filepath = Path(tmpdir).joinpath("bench.jpg")
+            Image.effect_mandelbrot((8000, 6000), (-2, -1.5, 1, 1.5), 100).convert(
+                "RGB"
+            ).save(filepath, quality=90)
+
+        # Spawn a new process per run so that peak RSS is measured independently
+        ctx = multiprocessing.get_context("spawn")
+        smallest = []
+        for draft in (False, True):
+            with ctx.Pool(1) as pool:
+                size, decode, resize, rss, thumbnail = pool.apply(
+                    render, (filepath, draft)
+                )
+            smallest.append(thumbnail)
+            print(
+                "draft=%-5s decoded size=%-12s decode=%.3fs resize=%.3fs peak RSS=%.1fMiB"
+                % (draft, "%dx%d" % size, decode, resize, rss)
+            )
+
+        # Mean absolute difference per channel between both smallest thumbnails (0-255)
+        diff = ImageStat.Stat(ImageChops.difference(*smallest)).mean
+        print("mean difference of smallest thumbnail: %s" % [round(d, 3) for d in diff])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Compares requests per second and latency of the preview webserver with those of the former
+# single-threaded http.server based one, with several clients fetching pages, pictures and
+# ranges of a video, and optionally one slow client streaming the video.
+#
+# Usage: python benchmarks/preview.py [--clients 8] [--duration 5] [--slow-client]
+
+from argparse import ArgumentParser
+import http.client
+import http.server
+import multiprocessing
+import os
+import random
+import socket
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+
+from functools import partial
+
+from recitale.preview import make_server
+
+FILES = {
+    "gallery/index.html": 30 * 1024,
+    "gallery/thumbnail.jpg": 200 * 1024,
+    "static/css/style.css": 20 * 1024,
+    "gallery/video.webm": 16 * 1024 * 1024,
+}
+
+
+class BaselineServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def baseline_server(directory):
+    handler = partial(QuietHandler, directory=directory)
+    return BaselineServer(("127.0.0.1", 0), handler)
+
+
+def client(address, deadline, latencies, sizes, errors):
+    connection = http.client.HTTPConnection(*address, timeout=30)
+    paths = list(FILES)
+    while time.monotonic() < deadline:
+        path = random.choice(paths)
+        headers = {}
+        if path.endswith(".webm"):
+            # Seeking in a video
+            start = random.randrange(FILES[path] - 1024 * 1024)
+            headers["Range"] = "bytes=%d-%d" % (start, start + 1024 * 1024 - 1)
+        begin = time.perf_counter()
+        try:
+            connection.request("GET", "/" + path, headers=headers)
+            response = connection.getresponse()
+            sizes.append(len(response.read()))
+        except (OSError, http.client.HTTPException):
+            errors.append(path)
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - begin)
+
+
+def slow_client(address, deadline):
+    # Reads the whole video at about 1MB/s
+    sock = socket.create_connection(address)
+    sock.sendall(b"GET /gallery/video.webm HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    while time.monotonic() < deadline:
+        if not sock.recv(64 * 1024):
+            break
+        time.sleep(0.064)
+    sock.close()
+
+
+def serve(kind, directory, ports):
+    # Runs in a process of its own so that clients do not compete with the server for the GIL
+    if kind == "baseline":
+        server = baseline_server(directory)
+    else:
+        server = make_server(directory, "127.0.0.1", 0)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def run(kind, directory, clients, duration, slow):
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(kind, directory, ports))
+    process.start()
+    address = "127.0.0.1", ports.get()
+
+    deadline = time.monotonic() + duration
+    latencies = []
+    sizes = []
+    errors = []
+    threads = [
+        threading.Thread(
+            target=client, args=(address, deadline, latencies, sizes, errors)
+        )
+        for _ in range(clients)
+    ]
+    if slow:
+        threading.Thread(
+            target=slow_client, args=(address, deadline), daemon=True
+        ).start()
+        time.sleep(0.1)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    process.terminate()
+    process.join()
+    return latencies, sizes, errors
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of the preview webserver")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--slow-client", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for path, size in FILES.items():
+            os.makedirs(os.path.join(tmpdir, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(tmpdir, path), "wb") as f:
+                f.write(os.urandom(size))
+
+        for name, kind in (
+            ("http.server", "baseline"),
+            ("recitale preview", "preview"),
+        ):
+            latencies, sizes, errors = run(
+                kind, tmpdir, args.clients, args.duration, args.slow_client
+            )
+            latencies.sort()
+            print(
+                "%-17s %7.1f req/s %7.1f MB/s  p50 %6.1fms  p99 %7.1fms  errors %d"
+                % (
+                    name,
+                    len(latencies) / args.duration,
+                    sum(sizes) / args.duration / 1024 / 1024,
+                    statistics.median(latencies) * 1000 if latencies else 0,
+                    latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+                    len(errors),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
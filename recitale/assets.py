@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import re
+
+from pathlib import Path
+
+from jinja2.ext import Extension
+
+from .utils import sync_tree
+
+
+logger = logging.getLogger("recitale." + __name__)
+
+# Stylesheets and scripts referenced by templates
+ASSET_TAG = re.compile(
+    r"<link\b(?P<link>[^>]*)>|<script\b(?P<script>[^>]*)>\s*</script>"
+)
+ATTRIBUTE = re.compile(r'([\w-]+)\s*=\s*"([^"]*)"')
+# URL of a file of the static directory, the prefix is the path from the page to the static
+# directory, e.g. "../" or "{{ pathstatic }}/".
+STATIC_URL = re.compile(
+    r"^(?P<prefix>[^\"]*?)static/(?P<path>css/[^/]+\.css|js/[^/]+\.js)$"
+)
+# Copied to the static directory of the build from the site, they are not in the static
+# directory of the theme and must be loaded after it to override it.
+SITE_FILES = ("css/custom.css", "js/custom.js")
+# Bundles are written next to their files so that URLs relative to them, e.g. of fonts, are the
+# same. Files are joined on a new line and scripts separated by a semicolon, in case one does not
+# end its last statement.
+SEPARATORS = {"css": b"\n", "js": b"\n;\n"}
+
+# Strings and comments of stylesheets, whitespaces in them are kept
+CSS_TOKEN = re.compile(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'|/\*.*?\*/", re.DOTALL)
+CSS_SPACE = re.compile(r"\s+")
+CSS_PUNCTUATION = re.compile(r" ?([{};,>]) ?")
+
+
+def static_source(theme):
+    # The static directory of the site replaces the one of the theme
+    if Path(".").joinpath("static").exists():
+        return Path(".").joinpath("static")
+    return Path(__file__).parent.joinpath("themes", theme, "static")
+
+
+def minify_css(css):
+    # Removes comments, except /*! ones which are usually licences, and unneeded whitespaces.
+    # Whitespaces around colons are kept since they matter in selectors, e.g. "a :hover".
+    def minify(code):
+        code = CSS_SPACE.sub(" ", code)
+        return CSS_PUNCTUATION.sub(r"\1", code).replace(";}", "}")
+
+    minified = []
+    code = []
+    end = 0
+    for match in CSS_TOKEN.finditer(css):
+        code.append(css[end : match.start()])
+        end = match.end()
+        token = match.group(0)
+        if token.startswith("/*") and not token.startswith("/*!"):
+            # A comment separates tokens like a whitespace
+            code.append(" ")
+            continue
+        minified.append(minify("".join(code)))
+        minified.append(token)
+        code = []
+    code.append(css[end:])
+    minified.append(minify("".join(code)))
+    return "".join(minified).strip()
+
+
+def parse_asset(match, static):
+    # Returns the kind, prefix and path in static of the file of a tag, and the other attributes
+    # of the tag, None if the tag is not a stylesheet or a script of static which can be bundled.
+    if match.group("link") is not None:
+        kind, attributes = "css", match.group("link")
+    else:
+        kind, attributes = "js", match.group("script")
+    attributes = dict(ATTRIBUTE.findall(attributes))
+    url = attributes.pop("href" if kind == "css" else "src", "")
+    if kind == "css" and attributes.get("rel") != "stylesheet":
+        return None
+
+    url = STATIC_URL.match(url)
+    if url is None or url.group("path") in SITE_FILES:
+        return None
+    path = url.group("path")
+    if not path.startswith(kind + "/") or not static.joinpath(path).is_file():
+        return None
+    # @import rules are only allowed at the beginning of a stylesheet
+    if kind == "css" and b"@import" in static.joinpath(path).read_bytes():
+        return None
+    return kind, url.group("prefix"), path, sorted(attributes.items())
+
+
+def bundle_name(kind, paths):
+    digest = hashlib.blake2b("\0".join(paths).encode("utf-8"), digest_size=6)
+    return "%s/bundle-%s.%s" % (kind, digest.hexdigest(), kind)
+
+
+def asset_runs(source, static):
+    # Yields the runs of tags of source loading files of static one after the other, with only
+    # whitespaces between them and the same attributes, as lists of (match, asset). Tags in a
+    # {% if %} block or separated by anything else are not in the same run, so that bundling a
+    # run does not change which files a page loads nor their order.
+    run = []
+    for match in ASSET_TAG.finditer(source):
+        asset = parse_asset(match, static)
+        if run and (
+            asset is None
+            or source[run[-1][0].end() : match.start()].strip()
+            or asset[:2] != run[-1][1][:2]
+            or asset[3] != run[-1][1][3]
+        ):
+            yield run
+            run = []
+        if asset is not None:
+            run.append((match, asset))
+    if run:
+        yield run
+
+
+def bundle_tags(source, static):
+    # Returns source with the runs of several tags loading files of static replaced by a tag
+    # loading their bundle, and the files of each bundle by path in static.
+    bundles = {}
+    replaced = []
+    end = 0
+    for run in asset_runs(source, static):
+        if len(run) < 2:
+            continue
+        first, (kind, prefix, _, _) = run[0]
+        paths = [path for _, (_, _, path, _) in run]
+        name = bundle_name(kind, paths)
+        bundles[name] = paths
+
+        tag = first.group(0).replace(
+            prefix + "static/" + paths[0], prefix + "static/" + name
+        )
+        replaced.append(source[end : first.start()])
+        replaced.append(tag)
+        end = run[-1][0].end()
+    replaced.append(source[end:])
+    return "".join(replaced), bundles
+
+
+def bundle(static, paths):
+    # Returns the content of the bundle of paths in static, stylesheets not minified already
+    # are minified. Files also in the bundle under another name are only included once.
+    kind = paths[0].rsplit(".", 1)[1]
+    contents = []
+    digests = set()
+    for path in paths:
+        content = static.joinpath(path).read_bytes()
+        digest = hashlib.blake2b(content).digest()
+        if digest in digests:
+            logger.debug("Bundle: %s already included, skipping it", path)
+            continue
+        digests.add(digest)
+        if kind == "css" and not path.endswith(".min.css"):
+            content = minify_css(content.decode("utf-8", "surrogateescape")).encode(
+                "utf-8", "surrogateescape"
+            )
+        contents.append(content.strip())
+    return SEPARATORS[kind].join(contents) + b"\n"
+
+
+def stage_static(templates, static, directory):
+    # Makes directory a copy of static with the bundles of all templates of the theme, so that
+    # they are written once per build and copied to each static directory of the build like any
+    # other file. Bundles are only written again if their content changed.
+    bundles = {}
+    for name in templates.list_templates(
+        filter_func=lambda name: name.endswith(".html")
+    ):
+        source, _, _ = templates.loader.get_source(templates, name)
+        bundles.update(bundle_tags(source, static)[1])
+
+    directory = Path(directory)
+    sync_tree(static, directory, keep=bundles)
+    for name, paths in sorted(bundles.items()):
+        content = bundle(static, paths)
+        path = directory.joinpath(name)
+        if path.is_file() and path.read_bytes() == content:
+            continue
+        logger.debug("Bundle: writing %s with %s", path, ", ".join(paths))
+        path.write_bytes(content)
+    return directory
+
+
+class AssetsExtension(Extension):
+    # Loads bundles instead of the files of the static directory they are made of, see
+    # stage_static(). The environment is expected to have the theme attribute of
+    # TemplatesEnvironment.
+    def preprocess(self, source, name, filename=None):
+        return bundle_tags(source, static_source(self.environment.theme))[0]
@@ -13,22 +13,47 @@ from .utils import remove_superficial_options
 
 logger = logging.getLogger("recitale." + __name__)
 
+# Rough time in milliseconds to reencode a second of audio, only meaningful relatively to the
+# estimated costs of other media.
+REENCODE_COST = 20
+
+
+def probe(filepath):
+    # Returns the duration, the codecs of all streams and the overall bitrate (None if unknown)
+    # of filepath.
+    if AudioFactory.global_options["binary"] == "ffmpeg":
+        binary = "ffprobe"
+    else:
+        binary = "avprobe"
+    command = (
+        binary
+        + " -v error -show_entries stream=codec_name "
+        + " -show_entries format=duration,bit_rate "
+        + " -print_format json=compact=1 "
+        + shlex.quote(str(filepath))
+    )
+    out = subprocess.check_output(shlex.split(command))
+    infos = json_loads(out)
+    bitrate = infos["format"].get("bit_rate")
+    return {
+        "duration": float(infos["format"]["duration"]),
+        "codecs": [
+            s["codec_name"] for s in infos.get("streams", []) if "codec_name" in s
+        ],
+        "bitrate": int(bitrate) if bitrate else None,
+    }
+
 
 class AudioCommon:
     def __get_infos(self):
-        if AudioFactory.global_options["binary"] == "ffmpeg":
-            binary = "ffprobe"
-        else:
-            binary = "avprobe"
-        command = (
-            binary
-            + " -v error -show_entries format=duration "
-            + " -print_format json=compact=1 "
-            + shlex.quote(str(self.filepath))
-        )
-        out = subprocess.check_output(shlex.split(command))
-        infos = json_loads(out)
-        self.dur = float(infos["format"]["duration"])
+        # Probing is expensive, results are kept in the cache, if any, until the file changes
+        cache = AudioFactory.cache
+        infos = cache.probe_infos(self.filepath) if cache is not None else None
+        if infos is None:
+            infos = probe(self.filepath)
+            if cache is not None:
+                cache.store_probe_infos(self.filepath, infos)
+        self.dur = infos["duration"]
 
     @property
     def duration(self):
@@ -65,6 +90,10 @@ class BaseAudio(AudioCommon):
     def _add_reencode(self, reencode):
         return self.reencodes.setdefault(reencode.filepath, reencode)
 
+    def cost(self):
+        # Estimated time in milliseconds to create a reencode
+        return REENCODE_COST * self.duration
+
     def reencode(self):
         reencode = Reencode(self.filepath, self.chksum_opt, self.options["extension"])
         return urllib.parse.quote(self._add_reencode(reencode).filepath.name)
@@ -74,6 +103,7 @@ class BaseAudio(AudioCommon):
 class AudioFactory:
     base_audios = dict()
     global_options = dict()
+    cache = None
 
     @classmethod
     def get(cls, path, filepath):
@@ -82,3 +112,13 @@ class AudioFactory:
         filepath = Path(path).joinpath(filepath).resolve().relative_to(Path.cwd())
         baud = BaseAudio(filepath, cls.global_options)
         return cls.base_audios.setdefault(baud.filepath / str(baud.chksum_opt), baud)
+
+    @classmethod
+    def merge(cls, base_audios):
+        # Adds the audio files and reencodes requested in another process, e.g. one
+        # rendering galleries
+        for key, base in base_audios.items():
+            known = cls.base_audios.setdefault(key, base)
+            if known is not base:
+                for reencode in base.reencodes.values():
+                    known._add_reencode(reencode)
@@ -4,8 +4,8 @@ import sys
 from time import gmtime, strftime, strptime
 from jinja2 import Template
 from pathlib import Path
-from PIL import Image
 
+from .image import ImageFactory, image_metadata
 from .utils import load_settings
 
 DATA = """title: {{ title }}
@@ -37,12 +37,9 @@ TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
 
 
 def get_exif(filename):
-    exif = Image.open(filename).getexif()
-    if exif is not None:
-        # DateTimeOriginal, DateTimeDigitized, DateTime(DateTimeModified)
-        ctime = exif.get(0x9003, exif.get(0x9004, exif.get(0x0132)))
-        if ctime is not None:
-            return ctime
+    ctime = image_metadata(filename, ImageFactory.cache)["date"]
+    if ctime is not None:
+        return ctime
 
     return strftime(TIME_FORMAT, gmtime(os.path.getmtime(filename)))
 
@@ -1,75 +1,526 @@
+import hashlib
 import json
 import logging
 import os
-import signal
+import sqlite3
+import time
 
-from multiprocessing import Manager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
 
 from .utils import remove_superficial_options
 
-CACHE_VERSION = 3
+CACHE_VERSION = 5
+# Versions of the former JSON cache which can be migrated to CACHE_VERSION without pruning it
+UPGRADABLE_CACHE_VERSIONS = (3, 4)
+
+# Size of the chunks read from a source file to compute its digest. It needs to be big enough for
+# hashlib to release the GIL for most of the time spent hashing.
+DIGEST_BUFFER_SIZE = 1024 * 1024
+
+# Changes to the cache are committed to the database every COMMIT_EVERY changes or every
+# COMMIT_INTERVAL seconds, whichever comes first, so that a killed build loses at most that.
+COMMIT_EVERY = 1000
+COMMIT_INTERVAL = 5
+
+# Entries created from a cache version 3 have a NULL digest and the size of the source instead.
+# Options of entries are interned in the options table since most entries share the same ones.
+# Probes store the metadata of pictures read from their header and what ffprobe found out about
+# videos and audio files, as JSON. Pages store the digest of the inputs of the last rendering of
+# each page, the templates and media it used, and the media it requested, as JSON. Precompressed
+# stores the fingerprint of the content of outputs of the build when their compressed siblings were
+# written, and the encodings written. Placeholders store the placeholder of pictures by the digest
+# of their content, so that touching or moving a picture does not decode it again. Tables are only
+# ever added, so the schema is also applied to databases of the current version.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS options (
+    id INTEGER PRIMARY KEY,
+    options TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    target TEXT PRIMARY KEY,
+    digest TEXT,
+    size INTEGER,
+    options_id INTEGER NOT NULL REFERENCES options (id)
+);
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    infos TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    page TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    templates TEXT NOT NULL,
+    media TEXT NOT NULL,
+    requests BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS precompressed (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    encodings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS placeholders (
+    digest TEXT PRIMARY KEY,
+    placeholder TEXT NOT NULL
+);
+"""
 
 
 logger = logging.getLogger("recitale." + __name__)
 
 
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=32)
+    buf = bytearray(DIGEST_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def serialize_options(options):
+    # Sorted keys so that the same options always give the same string, json.dumps() also
+    # transforms tuples into lists which is what they are once loaded from the database anyway.
+    return json.dumps(remove_superficial_options(options), sort_keys=True)
+
+
 class Cache:
-    cache_file_path = os.path.join(os.getcwd(), ".recitale_cache")
+    cache_dir = os.path.join(os.getcwd(), ".recitale_cache")
 
-    def __init__(self):
-        if os.path.exists(os.path.join(os.getcwd(), ".recitale_cache")):
-            cache = json.load(open(self.cache_file_path, "r"))
-        else:
-            cache = {"version": CACHE_VERSION}
+    def __init__(self, cache_dir=None):
+        if cache_dir is not None:
+            self.cache_dir = str(cache_dir)
+        self.db_path = os.path.join(self.cache_dir, "cache.sqlite")
+
+        # Only the process which created the cache writes to the database. Processes of a pool
+        # open their own read-only connection and record the entries, source fingerprints and
+        # probes they add or modify, so that they can be sent back to the main process with
+        # pop_updates() and written there with merge().
+        self.pid = os.getpid()
+        self.connections = {}
+        self.updated_cache = {}
+        self.updated_sources = {}
+        self.updated_probes = {}
+        self.options_ids = {}
+        self.pending = 0
+        self.last_commit = time.monotonic()
 
-        if "version" not in cache or cache["version"] != CACHE_VERSION:
+        # The former cache was a JSON file at the path of the current cache directory
+        legacy = None
+        if os.path.isfile(self.cache_dir):
+            with open(self.cache_dir, "r") as f:
+                try:
+                    legacy = json.load(f)
+                except ValueError:
+                    legacy = {}
+            os.remove(self.cache_dir)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_VERSION:
+            if version:
+                print("info: cache format as changed, prune cache")
+                self.db.executescript(
+                    "DROP TABLE IF EXISTS entries;"
+                    "DROP TABLE IF EXISTS options;"
+                    "DROP TABLE IF EXISTS sources;"
+                    "DROP TABLE IF EXISTS probes;"
+                    "DROP TABLE IF EXISTS pages;"
+                    "DROP TABLE IF EXISTS precompressed;"
+                    "DROP TABLE IF EXISTS placeholders;"
+                )
+            self.db.execute("PRAGMA user_version = %d" % CACHE_VERSION)
+        self.db.executescript(SCHEMA)
+
+        if legacy is not None:
+            self._migrate(legacy)
+
+    def __getstate__(self):
+        # Connections cannot be sent to other processes, they open their own
+        state = self.__dict__.copy()
+        state["connections"] = {}
+        return state
+
+    @property
+    def db(self):
+        pid = os.getpid()
+        # Connections must not be used across fork(), hence one connection per process. Those
+        # inherited from the parent process are kept but never used nor closed.
+        if pid not in self.connections:
+            if pid == self.pid:
+                connection = sqlite3.connect(self.db_path, timeout=30)
+                # WAL allows pool processes and other builds to read the cache while it is
+                # being written to.
+                connection.execute("PRAGMA journal_mode = WAL")
+                connection.execute("PRAGMA synchronous = NORMAL")
+            else:
+                connection = sqlite3.connect(
+                    "file:%s?mode=ro" % pathname2url(self.db_path), uri=True, timeout=30
+                )
+            self.connections[pid] = connection
+        return self.connections[pid]
+
+    def _migrate(self, cache):
+        if cache.get("version") not in UPGRADABLE_CACHE_VERSIONS:
             print("info: cache format as changed, prune cache")
-            cache = {"version": CACHE_VERSION}
+            return
+
+        logger.info("Migrating cache to SQLite database %s", self.db_path)
+        del cache["version"]
+        for source, fingerprint in cache.pop("sources", {}).items():
+            self._update_source(source, fingerprint)
+        for target, entry in cache.items():
+            self._update_entry(
+                target,
+                {
+                    "digest": entry.get("digest"),
+                    "size": entry.get("size"),
+                    "options": json.dumps(entry["options"], sort_keys=True),
+                },
+            )
+        self.commit()
+
+    def _options_id(self, options):
+        if options not in self.options_ids:
+            self.db.execute(
+                "INSERT OR IGNORE INTO options (options) VALUES (?)", (options,)
+            )
+            self.options_ids[options] = self.db.execute(
+                "SELECT id FROM options WHERE options = ?", (options,)
+            ).fetchone()[0]
+        return self.options_ids[options]
+
+    def _entry(self, target):
+        if target in self.updated_cache:
+            return self.updated_cache[target]
+
+        row = self.db.execute(
+            "SELECT entries.digest, entries.size, options.options FROM entries "
+            "JOIN options ON options.id = entries.options_id WHERE target = ?",
+            (target,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        digest, size, options = row
+        return {"digest": digest, "size": size, "options": options}
+
+    def _source(self, source):
+        if source in self.updated_sources:
+            return self.updated_sources[source]
+
+        row = self.db.execute(
+            "SELECT mtime_ns, size, digest FROM sources WHERE path = ?", (source,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        mtime_ns, size, digest = row
+        return {"mtime_ns": mtime_ns, "size": size, "digest": digest}
+
+    def _update_entry(self, target, entry):
+        if os.getpid() != self.pid:
+            self.updated_cache[target] = entry
+            return
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries (target, digest, size, options_id) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                target,
+                entry["digest"],
+                entry["size"],
+                self._options_id(entry["options"]),
+            ),
+        )
+        self._changed()
+
+    def _update_source(self, source, fingerprint):
+        if os.getpid() != self.pid:
+            self.updated_sources[source] = fingerprint
+            return
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO sources (path, mtime_ns, size, digest) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                source,
+                fingerprint["mtime_ns"],
+                fingerprint["size"],
+                fingerprint["digest"],
+            ),
+        )
+        self._changed()
+
+    def _changed(self):
+        self.pending += 1
+        if (
+            self.pending >= COMMIT_EVERY
+            or time.monotonic() - self.last_commit >= COMMIT_INTERVAL
+        ):
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def pop_updates(self):
+        updates = self.updated_cache, self.updated_sources, self.updated_probes
+        self.updated_cache = {}
+        self.updated_sources = {}
+        self.updated_probes = {}
+        return updates
 
-        # Make the Manager server process ignore the SIGINT (Ctrl+, aka KeyboardInterrupt exception)
-        # so that it is possible to still dump the cache variable after a KeyboardInterrupt.
-        old = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        self.cache = Manager().dict(cache)
-        # Current process should handle SIGINT as it used to do before starting the Manager process.
-        signal.signal(signal.SIGINT, old)
+    def merge(self, updates):
+        cache, sources, probes = updates
+        for source, fingerprint in sources.items():
+            self._update_source(source, fingerprint)
+        for target, entry in cache.items():
+            self._update_entry(target, entry)
+        for path, row in probes.items():
+            self._update_probe(path, row)
+
+    def _stale_fingerprint(self, fingerprint, stat):
+        return (
+            fingerprint is None
+            or fingerprint["mtime_ns"] != stat.st_mtime_ns
+            or fingerprint["size"] != stat.st_size
+        )
+
+    def fingerprint(self, source):
+        source = str(source)
+        stat = os.stat(source)
+        fingerprint = self._source(source)
+
+        if self._stale_fingerprint(fingerprint, stat):
+            logger.debug("(%s) Source changed or unknown, computing its digest", source)
+            fingerprint = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "digest": file_digest(source),
+            }
+            self._update_source(source, fingerprint)
+
+        return fingerprint
+
+    def update_fingerprints(self, sources, jobs=None):
+        # Computes the digest of all sources whose mtime or size changed since last time, in
+        # parallel. Hashing a file is mostly reading it and hashlib releases the GIL while
+        # hashing big chunks of data, so threads are enough.
+        stale = {}
+        for source in set(str(source) for source in sources):
+            stat = os.stat(source)
+            if self._stale_fingerprint(self._source(source), stat):
+                stale[source] = stat
+
+        if stale:
+            logger.info("Computing digest of %d new or modified files...", len(stale))
+            with ThreadPoolExecutor(jobs) as executor:
+                digests = executor.map(file_digest, stale.keys())
+                for (source, stat), digest in zip(stale.items(), digests):
+                    self._update_source(
+                        source,
+                        {
+                            "mtime_ns": stat.st_mtime_ns,
+                            "size": stat.st_size,
+                            "digest": digest,
+                        },
+                    )
+
+        # Pool processes only see what is committed
+        self.commit()
 
     def needs_to_be_generated(self, source, target, options):
         if not os.path.exists(target):
             logger.debug("%s does not exist. Requesting generation...", target)
             return True
 
-        if target not in self.cache:
+        cached_picture = self._entry(target)
+
+        if cached_picture is None:
             logger.debug("%s not in cache. Requesting generation...", target)
             return True
 
-        cached_picture = self.cache[target]
+        fingerprint = self.fingerprint(source)
 
-        if cached_picture["size"] != os.path.getsize(source):
+        if cached_picture["digest"] is None:
+            # Entry from a cache version 3, only the size of the source is known
+            if cached_picture["size"] != fingerprint["size"]:
+                logger.debug(
+                    "%s has different size than in cache. Requesting generation...",
+                    target,
+                )
+                return True
+        elif cached_picture["digest"] != fingerprint["digest"]:
             logger.debug(
-                "%s has different size than in cache. Requesting generation...", target
+                "%s has different content than in cache. Requesting generation...",
+                target,
             )
             return True
 
-        options = remove_superficial_options(options)
-        # json.dumps() transforms tuples into list, so to be able to compare options
-        # same transformation needs to be done on runtime dict.
-        options = json.loads(json.dumps(options))
-
-        if cached_picture["options"] != options:
+        if cached_picture["options"] != serialize_options(options):
             logger.debug(
                 "%s has different options than in cache. Requesting generation...",
                 target,
             )
             return True
 
+        if cached_picture["digest"] is None:
+            self._update_entry(
+                target,
+                {
+                    "digest": fingerprint["digest"],
+                    "size": None,
+                    "options": cached_picture["options"],
+                },
+            )
+
         logger.debug("(%s) Skipping cached thumbnail %s", source, target)
         return False
 
-    def cache_picture(self, source, target, options):
-        self.cache[target] = {
-            "size": os.path.getsize(source),
-            "options": remove_superficial_options(options),
+    def may_be_cached(self, source, target):
+        # Cheaper version of needs_to_be_generated() which does not check options since they
+        # are only known once the source is opened. Only meant to estimate the work left.
+        if not os.path.exists(target):
+            return False
+
+        cached_picture = self._entry(target)
+        if cached_picture is None:
+            return False
+
+        fingerprint = self.fingerprint(source)
+        if cached_picture["digest"] is None:
+            return cached_picture["size"] == fingerprint["size"]
+        return cached_picture["digest"] == fingerprint["digest"]
+
+    def probe_infos(self, path):
+        # Returns what was stored for path with store_probe_infos() if it did not change since,
+        # None otherwise.
+        path = str(path)
+        stat = os.stat(path)
+        if path in self.updated_probes:
+            row = self.updated_probes[path]
+        else:
+            row = self.db.execute(
+                "SELECT mtime_ns, size, infos FROM probes WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None or self._stale_fingerprint(
+            {"mtime_ns": row[0], "size": row[1]}, stat
+        ):
+            return None
+        return json.loads(row[2])
+
+    def _update_probe(self, path, row):
+        if os.getpid() != self.pid:
+            self.updated_probes[path] = row
+            return
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO probes (path, mtime_ns, size, infos) "
+            "VALUES (?, ?, ?, ?)",
+            (path,) + tuple(row),
+        )
+        self._changed()
+
+    def store_probe_infos(self, path, infos):
+        path = str(path)
+        stat = os.stat(path)
+        self._update_probe(path, (stat.st_mtime_ns, stat.st_size, json.dumps(infos)))
+
+    def placeholder(self, digest):
+        row = self.db.execute(
+            "SELECT placeholder FROM placeholders WHERE digest = ?", (digest,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def store_placeholder(self, digest, placeholder):
+        # Placeholders are computed in the probe step, by the main process
+        self.db.execute(
+            "INSERT OR REPLACE INTO placeholders (digest, placeholder) VALUES (?, ?)",
+            (digest, json.dumps(placeholder)),
+        )
+        self._changed()
+
+    def page(self, page):
+        row = self.db.execute(
+            "SELECT digest, templates, media, requests FROM pages WHERE page = ?",
+            (page,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        digest, templates, media, requests = row
+        return {
+            "digest": digest,
+            "templates": json.loads(templates),
+            "media": json.loads(media),
+            "requests": requests,
+        }
+
+    def store_page(self, page, digest, templates, media, requests):
+        # Pages are only rendered by the main process or stored from there
+        self.db.execute(
+            "INSERT OR REPLACE INTO pages (page, digest, templates, media, requests) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (page, digest, json.dumps(templates), json.dumps(media), requests),
+        )
+        self._changed()
+
+    def precompressed(self, path):
+        row = self.db.execute(
+            "SELECT mtime_ns, size, digest, encodings FROM precompressed WHERE path = ?",
+            (str(path),),
+        ).fetchone()
+        if row is None:
+            return None
+
+        mtime_ns, size, digest, encodings = row
+        return {
+            "mtime_ns": mtime_ns,
+            "size": size,
+            "digest": digest,
+            "encodings": json.loads(encodings),
         }
 
+    def store_precompressed(self, path, fingerprint, encodings):
+        self.db.execute(
+            "INSERT OR REPLACE INTO precompressed (path, mtime_ns, size, digest, encodings) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                str(path),
+                fingerprint["mtime_ns"],
+                fingerprint["size"],
+                fingerprint["digest"],
+                json.dumps(encodings),
+            ),
+        )
+        self._changed()
+
+    def cache_picture(self, source, target, options):
+        self._update_entry(
+            target,
+            {
+                "digest": self.fingerprint(source)["digest"],
+                "size": None,
+                "options": serialize_options(options),
+            },
+        )
+
     def cache_dump(self):
-        json.dump(dict(self.cache), open(self.cache_file_path, "w"))
+        self.commit()
@@ -0,0 +1,207 @@
+import logging
+import shlex
+import shutil
+import subprocess
+import sys
+
+from argparse import ArgumentParser, ArgumentTypeError
+from pathlib import Path
+
+from .__init__ import __version__
+from .utils import CustomFormatter, find_galleries, load_settings
+
+# Only modules of the standard library and light ones of recitale are imported here, so that
+# --version, preview and deploy start fast. Modules rendering the site (Pillow, Jinja, Babel,
+# tqdm, ...) are only imported by the commands which need them, see run() in recitale.py.
+
+logger = logging.getLogger("recitale")
+
+
+def loglevel(string):
+    try:
+        return int(string)
+    except ValueError:
+        pass
+    if hasattr(logging, string):
+        return getattr(logging, string)
+    raise ArgumentTypeError(
+        "takes an integer or a predefined log level from logging module."
+    )
+
+
+def preview(bind, port):
+    from .preview import make_server
+
+    if not Path("build").exists():
+        logger.error("Please build the website before launch preview")
+        sys.exit(1)
+
+    httpd = make_server("build", bind, port)
+    print("Start server on http://%s:%d" % (bind or "localhost", port))
+    try:
+        httpd.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        print("\nShutdown server")
+        raise
+    finally:
+        httpd.server_close()
+
+
+def deploy():
+    if shutil.which("rsync") is None:
+        logger.error("I can't locate the rsync + please install the 'rsync' package.")
+        sys.exit(1)
+    if not Path("build").exists():
+        logger.error("Please build the website before launch deployment")
+        sys.exit(1)
+
+    # Only the deploy settings are needed, media settings are not even looked at
+    settings = load_settings(".")
+    r_dest = settings["settings"]["deploy"]["dest"]
+    if settings["settings"]["deploy"]["others"]:
+        r_others = settings["settings"]["deploy"]["others"]
+    else:
+        r_others = ""
+    if settings["settings"]["deploy"]["ssh"]:
+        r_username = settings["settings"]["deploy"]["username"]
+        r_hostname = settings["settings"]["deploy"]["hostname"]
+        r_cmd = "rsync -avz --progress %s build/* %s@%s:%s" % (
+            shlex.quote(r_others),
+            shlex.quote(r_username),
+            shlex.quote(r_hostname),
+            shlex.quote(r_dest),
+        )
+    else:
+        r_cmd = "rsync -avz --progress %s build/* %s" % (
+            shlex.quote(r_others),
+            shlex.quote(r_dest),
+        )
+    if subprocess.run(shlex.split(r_cmd)).returncode != 0:
+        logger.error("deployment failed")
+        sys.exit(1)
+
+
+def main():
+    loglevel_parser = ArgumentParser(add_help=False)
+    loglevel_parser.add_argument(
+        "--log-level",
+        default=logging.WARNING,
+        type=loglevel,
+        help="Configure the logging level",
+    )
+
+    # Options of the preview webserver, shared by preview and watch
+    server_parser = ArgumentParser(add_help=False)
+    server_parser.add_argument(
+        "-b",
+        "--bind",
+        default="",
+        help="Address to bind the preview webserver to. Default: all interfaces",
+    )
+    server_parser.add_argument(
+        "-p",
+        "--port",
+        default=9000,
+        type=int,
+        help="Port of the preview webserver. Default: 9000",
+    )
+
+    parser = ArgumentParser(
+        description="Static site generator for your story.", parents=[loglevel_parser]
+    )
+    parser.add_argument(
+        "--version", action="version", version="%(prog)s " + __version__
+    )
+
+    subparser = parser.add_subparsers(dest="cmd")
+    parser_build = subparser.add_parser(
+        "build", help="Generate static site", parents=[loglevel_parser]
+    )
+    parser_build.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        type=int,
+        help="Specifies number of CPUs to use for thumbnail generations and reencodes. Default: "
+        "number of threads available on the system",
+    )
+    parser_build.add_argument(
+        "--full",
+        action="store_true",
+        help="Render all pages, even those whose settings, templates and media did not change "
+        "since the last build",
+    )
+    subparser.add_parser(
+        "test", help="Verify all your yaml data", parents=[loglevel_parser]
+    )
+    parser_watch = subparser.add_parser(
+        "watch",
+        help="Build the site again whenever it changes and preview it on port 9000",
+        parents=[loglevel_parser, server_parser],
+    )
+    parser_watch.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        type=int,
+        help="Specifies number of CPUs to use for thumbnail generations and reencodes. Default: "
+        "number of threads available on the system",
+    )
+    subparser.add_parser(
+        "preview",
+        help="Start preview webserver on port 9000",
+        parents=[loglevel_parser, server_parser],
+    )
+    subparser.add_parser(
+        "deploy", help="Deploy your website", parents=[loglevel_parser]
+    )
+    parser_autogen = subparser.add_parser(
+        "autogen", help="Generate gallery automaticaly", parents=[loglevel_parser]
+    )
+    group = parser_autogen.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "-d",
+        dest="folder",
+        metavar="folder",
+        help="folder to use for automatic gallery generation",
+    )
+    group.add_argument(
+        "--all",
+        action="store_const",
+        const=None,
+        dest="folder",
+        help="find all folders with settings.yaml for automatic gallery generation",
+    )
+    parser_autogen.add_argument(
+        "--force",
+        action="store_true",
+        help="**DESTRUCTIVE** force regeneration of gallery even if sections are already defined.",
+    )
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(CustomFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(args.log_level)
+
+    galleries_dirs = find_galleries()
+
+    if not galleries_dirs:
+        logger.error(
+            "I can't find at least one directory with a settings.yaml in the current "
+            "working directory (NOT the settings.yaml in your current directory, but one "
+            "INSIDE A DIRECTORY in your current directory), you don't have any gallery?"
+        )
+        sys.exit(1)
+
+    if args.cmd == "preview":
+        preview(args.bind, args.port)
+        return
+
+    if args.cmd == "deploy":
+        deploy()
+        return
+
+    from .recitale import run
+
+    run(args, galleries_dirs)
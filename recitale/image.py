@@ -1,30 +1,258 @@
-import imagesize
+import base64
+import io
 import logging
+import math
 import re
 import sys
 import urllib.parse
 
 from json import dumps as json_dumps
 from pathlib import Path
+from PIL import Image, ImageOps, JpegImagePlugin
 from zlib import crc32
 
 from .utils import remove_superficial_options
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 logger = logging.getLogger("recitale." + __name__)
 
+# Rough time in milliseconds to decode and to encode a megapixel, per format. Used to estimate how
+# long rendering the thumbnails of a picture takes, which only matters relatively to other pictures.
+# Run a build with --log-level DEBUG to compare estimated and actual costs.
+FORMAT_COSTS = {
+    "JPEG": (15, 25),
+    "MPO": (15, 25),
+    "PNG": (35, 150),
+    "WEBP": (55, 200),
+    "AVIF": (60, 1200),
+    "GIF": (15, 20),
+    "TIFF": (2, 2),
+}
+DEFAULT_FORMAT_COST = (20, 50)
+# Time in milliseconds to resample a megapixel of the source picture
+RESIZE_COST = 30
+
+# Formats thumbnails can also be rendered in, by name in settings.gm.formats: format written by
+# Pillow, extension appended to the name of the thumbnail and MIME type.
+OUTPUT_FORMATS = {
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "avif": ("AVIF", ".avif", "image/avif"),
+}
+
+
+def get_formats(formats):
+    # Returns the formats of the formats setting, in order of preference, without those Pillow
+    # cannot write.
+    if not formats:
+        return []
+
+    formats = [formats] if isinstance(formats, str) else list(formats)
+    for name in formats:
+        if name not in OUTPUT_FORMATS:
+            logger.error(
+                "Unknown thumbnail format '%s', supported formats are: %s",
+                name,
+                ", ".join(OUTPUT_FORMATS),
+            )
+            sys.exit(1)
+
+    Image.init()
+    for name in list(formats):
+        if OUTPUT_FORMATS[name][0] not in Image.SAVE:
+            logger.warning(
+                "Pillow cannot write %s pictures, not rendering thumbnails in this format",
+                OUTPUT_FORMATS[name][0],
+            )
+            formats.remove(name)
+    return formats
+
+
+# Placeholders are computed from a sample of the picture fitting in a square of PLACEHOLDER_SAMPLE
+# pixels. Their inline picture fits in a square of PLACEHOLDER_SIZE pixels, which browsers scale
+# up into a blurry preview, and is encoded in the first of PLACEHOLDER_FORMATS Pillow can write.
+PLACEHOLDER_SAMPLE = 64
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_FORMATS = (("WEBP", {"quality": 50}), ("PNG", {"optimize": True}))
+# The dominant colour is the average of the most common bin of colours, bins being the first
+# DOMINANT_BITS bits of each channel.
+DOMINANT_BITS = 3
+
+
+def thumbnail_size(size, box):
+    # Returns the size of the thumbnail of a picture of dimensions size which fits in box, keeping
+    # the aspect ratio and never upscaling. A None dimension in box is not constrained.
+    # This computes the exact same dimensions as PIL.Image.thumbnail() so that thumbnails can be
+    # resized from an intermediate (e.g. draft or smaller) picture and still be of the same size.
+    width, height = size
+    box_width = box[0] or width
+    box_height = box[1] or height
+
+    if box_width >= width and box_height >= height:
+        return width, height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if box_width / box_height >= aspect:
+        box_width = round_aspect(
+            box_height * aspect, key=lambda n: abs(aspect - n / box_height)
+        )
+    else:
+        box_height = round_aspect(
+            box_width / aspect,
+            key=lambda n: 0 if n == 0 else abs(aspect - box_width / n),
+        )
+    return box_width, box_height
+
+
+def pyramid_resize(pyramid, size, ratio):
+    # pyramid is the list of pictures already created from the same original picture (the
+    # decoded original picture first), sorted from the biggest to the smallest. The returned
+    # picture is appended to it if it had to be created, so sizes must be requested from the
+    # biggest to the smallest.
+    # Resampling from the smallest picture rather than from the original is much cheaper, but
+    # resampling an already resampled picture adds some blur. This blur is negligible as long as
+    # each resampling step reduces the picture by a big enough factor, hence ratio which is the
+    # minimum reduction factor between the picture used and the requested size.
+    width, height = size
+    ratio = max(ratio, 1)
+
+    for im in reversed(pyramid):
+        if im.size == size:
+            return im
+        if im.width >= width * ratio and im.height >= height * ratio:
+            break
+    else:
+        im = pyramid[0]
+
+    im = im.resize(size, Image.LANCZOS)
+    pyramid.append(im)
+    return im
+
+
+def dominant_color(im):
+    # Returns the dominant colour of im, an RGB picture, as an (r, g, b) tuple. The average
+    # colour of a picture is often a dull grey, that of its most common shade is closer to what
+    # is seen at first glance. Ties are broken by the lowest bin so that both implementations
+    # return the same colour.
+    shift = 8 - DOMINANT_BITS
+    if numpy is not None:
+        pixels = numpy.asarray(im, dtype=numpy.uint32).reshape(-1, 3)
+        bins = pixels >> shift
+        bins = (
+            (bins[:, 0] << (2 * DOMINANT_BITS))
+            | (bins[:, 1] << DOMINANT_BITS)
+            | bins[:, 2]
+        )
+        dominant = pixels[bins == numpy.bincount(bins).argmax()]
+        return tuple(int(c) for c in dominant.sum(axis=0) // len(dominant))
+
+    data = im.tobytes()
+    counts = {}
+    sums = {}
+    for i in range(0, len(data), 3):
+        pixel = data[i : i + 3]
+        key = (pixel[0] >> shift, pixel[1] >> shift, pixel[2] >> shift)
+        counts[key] = counts.get(key, 0) + 1
+        total = sums.setdefault(key, [0, 0, 0])
+        total[0] += pixel[0]
+        total[1] += pixel[1]
+        total[2] += pixel[2]
+    dominant = min(counts, key=lambda key: (-counts[key], key))
+    return tuple(c // counts[dominant] for c in sums[dominant])
+
+
+def image_placeholder(im):
+    # Returns the placeholder of a picture shown while its thumbnail loads: its dominant colour
+    # and a tiny version of it as a data URI. im is usually a draft decode of the picture so
+    # that this costs next to nothing.
+    if im.mode == "P":
+        im = im.convert("RGBA")
+    im = im.resize(thumbnail_size(im.size, (PLACEHOLDER_SAMPLE,) * 2), Image.LANCZOS)
+    im = im.convert("RGB")
+    color = "#%02x%02x%02x" % dominant_color(im)
+
+    im = im.resize(thumbnail_size(im.size, (PLACEHOLDER_SIZE,) * 2), Image.LANCZOS)
+    Image.init()
+    fmt, params = next(
+        (fmt, params) for fmt, params in PLACEHOLDER_FORMATS if fmt in Image.SAVE
+    )
+    buffer = io.BytesIO()
+    im.save(buffer, fmt, **params)
+    return {
+        "color": color,
+        "uri": "data:%s;base64,%s"
+        % (Image.MIME[fmt], base64.b64encode(buffer.getvalue()).decode("ascii")),
+    }
+
+
+def read_placeholder(filepath):
+    # Returns the placeholder of the picture at filepath, decoded at a reduced scale by the JPEG
+    # decoder. That of the upright picture is added as "upright" when its EXIF orientation is
+    # not 1, for the thumbnails rotated by auto-orient.
+    with Image.open(filepath) as img:
+        img.draft("RGB", (PLACEHOLDER_SAMPLE, PLACEHOLDER_SAMPLE))
+        placeholder = image_placeholder(img)
+        if img.getexif().get(0x0112, 1) != 1:
+            placeholder["upright"] = image_placeholder(ImageOps.exif_transpose(img))[
+                "uri"
+            ]
+    return placeholder
+
+
+def read_metadata(filepath):
+    # Reads the metadata of a picture needed to build the galleries and to render its thumbnails
+    # from its header, without decoding it. The capture date is None if unknown.
+    with Image.open(filepath) as img:
+        exif = img.getexif()
+        dpi = img.info.get("dpi")
+        if dpi is not None and img.format in ["JPEG", "MPO", "TIFF"]:
+            # For these formats, dpi is of type IFDRational which is not serializable
+            dpi = float(dpi[0]), float(dpi[1])
+        subsampling = None
+        if img.format == "JPEG" or img.format == "MPO":
+            subsampling = JpegImagePlugin.get_sampling(img)
+
+        return {
+            "width": img.width,
+            "height": img.height,
+            "format": img.format,
+            "orientation": exif.get(0x0112, 1),
+            "subsampling": subsampling,
+            "dpi": list(dpi) if dpi is not None else None,
+            # DateTimeOriginal, DateTimeDigitized, DateTime(DateTimeModified)
+            "date": exif.get(0x9003, exif.get(0x9004, exif.get(0x0132))),
+        }
+
+
+def image_metadata(filepath, cache=None):
+    # Metadata of a picture, kept in the cache, if any, until the picture changes so that the
+    # picture is not even opened again by later builds.
+    metadata = cache.probe_infos(filepath) if cache is not None else None
+    if metadata is None:
+        metadata = read_metadata(filepath)
+        if cache is not None:
+            cache.store_probe_infos(filepath, metadata)
+    return metadata
+
 
 class ImageCommon:
     @property
     def ratio(self):
-        # For when BaseImage.ratio is called before BaseImage.copy() is.
-        if not self.size:
-            self.size = imagesize.get(self.filepath)
         width, height = self.size
         return width / height
 
 
 class Thumbnail(ImageCommon):
+    # Names of the other formats the thumbnail is rendered in too, see BaseImage.variants()
+    formats = frozenset()
+
     def __init__(self, base_filepath, base_id, size):
         self.filepath = self.__filepath(base_filepath, base_id, size)
         self.size = size
@@ -41,6 +269,11 @@ class Thumbnail(ImageCommon):
 
         return p.parent / (p.stem + suffix)
 
+    def variant(self, name):
+        # Path of the thumbnail in the format name, e.g. picture-123-x800.jpg.webp so that
+        # thumbnails of pictures with the same name but another extension do not collide.
+        return self.filepath.with_name(self.filepath.name + OUTPUT_FORMATS[name][1])
+
 
 class BaseImage(ImageCommon):
     re_rsz = re.compile(r"^(\d+)%$")
@@ -52,14 +285,32 @@ class BaseImage(ImageCommon):
         self.options.update(options)
         self.filepath = self.options["name"]
         self.resize = self.options.get("resize")
+        self.draft = self.options.get("draft", True)
+        self._metadata = None
+        self.reduction_ratio = self.options.get("reduction-ratio", 2)
         self.options = remove_superficial_options(self.options)
         self.chksum_opt = crc32(
             bytes(json_dumps(self.options, sort_keys=True), "utf-8")
         )
 
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = image_metadata(self.filepath, ImageFactory.cache)
+        return self._metadata
+
+    @property
+    def size(self):
+        # Dimensions of the picture as shown in the galleries, thumbnails are rotated according to
+        # the EXIF orientation if auto-orient is set. Orientations 5 to 8 swap width and height.
+        width, height = self.metadata["width"], self.metadata["height"]
+        if self.options.get("auto-orient", False) and self.metadata["orientation"] >= 5:
+            return height, width
+        return width, height
+
     def copy(self):
         if not self.copysize:
-            width, height = imagesize.get(self.filepath)
+            width, height = self.size
 
             if self.resize:
                 match = BaseImage.re_rsz.match(str(self.resize))
@@ -76,18 +327,95 @@ class BaseImage(ImageCommon):
 
         return self.thumbnail(self.copysize)
 
+    @property
+    def placeholder(self):
+        # Dominant colour and inline picture shown while the thumbnails load, see
+        # read_placeholder(). None for pictures out of the galleries of the site.
+        placeholder = self.metadata.get("placeholder")
+        if placeholder and "upright" in placeholder:
+            if self.options.get("auto-orient", False):
+                return dict(placeholder, uri=placeholder["upright"])
+        return placeholder
+
+    @property
+    def mime_type(self):
+        # MIME types are registered by the plugins of Pillow, only loaded once needed
+        Image.init()
+        return Image.MIME.get(self.metadata["format"])
+
     def _add_thumbnail(self, thumbnail):
-        return self.thumbnails.setdefault(thumbnail.filepath, thumbnail)
+        known = self.thumbnails.setdefault(thumbnail.filepath, thumbnail)
+        known.formats = known.formats | thumbnail.formats
+        return known
 
     def thumbnail(self, size):
         thumbnail = Thumbnail(self.filepath, self.chksum_opt, size)
         return urllib.parse.quote(self._add_thumbnail(thumbnail).filepath.name)
 
+    def variants(self, size):
+        # Returns the MIME type and URL of the thumbnail of size in each of the formats of
+        # settings.gm.formats, in order of preference, for the <source> tags of a <picture> or
+        # an image-set(). They are rendered along with the thumbnail, from the same resized
+        # picture. The format of the picture itself is skipped.
+        formats = [
+            name
+            for name in ImageFactory.global_options.get("formats", [])
+            if OUTPUT_FORMATS[name][0] != self.metadata["format"]
+        ]
+        thumbnail = Thumbnail(self.filepath, self.chksum_opt, size)
+        thumbnail.formats = frozenset(formats)
+        thumbnail = self._add_thumbnail(thumbnail)
+        return [
+            (OUTPUT_FORMATS[name][2], urllib.parse.quote(thumbnail.variant(name).name))
+            for name in formats
+        ]
+
+    def cost(self, thumbnails):
+        # Estimated time in milliseconds to render the given thumbnails: decoding and resampling
+        # the source picture, then encoding each thumbnail. Thumbnails resampled from other
+        # thumbnails are cheap in comparison. Orientation is ignored.
+        thumbnails = list(thumbnails)
+        if not thumbnails:
+            return 0
+
+        width, height = self.size
+        decode, encode = FORMAT_COSTS.get(self.metadata["format"], DEFAULT_FORMAT_COST)
+        encoding = 0
+        for thumbnail in thumbnails:
+            w, h = thumbnail_size((width, height), thumbnail.size)
+            encoding += w * h * encode
+            for name in thumbnail.formats:
+                encoding += w * h * FORMAT_COSTS[OUTPUT_FORMATS[name][0]][1]
+        return (width * height * (decode + RESIZE_COST) + encoding) / 1000000
+
+    def task(self):
+        # Compact description of the thumbnails to render, sent to the processes rendering them
+        # instead of the whole object. Options are shared by most pictures so they are sent only
+        # once to each process and referenced here by their checksum.
+        return (
+            str(self.filepath),
+            self.chksum_opt,
+            self.draft,
+            self.reduction_ratio,
+            tuple(
+                (
+                    str(thumbnail.filepath),
+                    thumbnail.size,
+                    tuple(
+                        (str(thumbnail.variant(name)), OUTPUT_FORMATS[name][0])
+                        for name in sorted(thumbnail.formats)
+                    ),
+                )
+                for thumbnail in self.thumbnails.values()
+            ),
+        )
+
 
 # TODO: add support for looking into parent directories (name: ../other_gallery/pic.jpg)
 class ImageFactory:
     base_imgs = dict()
     global_options = dict()
+    cache = None
 
     @classmethod
     def get(cls, path, image):
@@ -108,3 +436,13 @@ class ImageFactory:
         im["name"] = Path(path).joinpath(im["name"]).resolve().relative_to(Path.cwd())
         img = BaseImage(im, cls.global_options)
         return cls.base_imgs.setdefault(img.filepath / str(img.chksum_opt), img)
+
+    @classmethod
+    def merge(cls, base_imgs):
+        # Adds the pictures and thumbnails requested in another process, e.g. one
+        # rendering galleries
+        for key, base in base_imgs.items():
+            known = cls.base_imgs.setdefault(key, base)
+            if known is not base:
+                for thumbnail in base.thumbnails.values():
+                    known._add_thumbnail(thumbnail)
@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import logging
+import os
+import sys
+
+from .cache import file_digest
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger("recitale." + __name__)
+
+# Outputs of the build worth compressing, other files (pictures, videos, fonts) are compressed
+# already.
+COMPRESSIBLE = (".html", ".xml", ".css", ".js", ".svg", ".json", ".txt")
+# Smaller files do not get any smaller once compressed
+MIN_SIZE = 256
+
+# Extension of the precompressed sibling of a file, by encoding
+EXTENSIONS = {"gzip": ".gz", "br": ".br"}
+# Rough time in milliseconds to compress a megabyte, by encoding
+COMPRESS_COSTS = {"gzip": 60, "br": 1800}
+
+
+def get_encodings(precompress):
+    # Returns the encodings of the precompress setting, either a list of encodings or True for
+    # all those available.
+    if not precompress:
+        return []
+    if precompress is True:
+        return ["gzip", "br"] if brotli is not None else ["gzip"]
+
+    encodings = [precompress] if isinstance(precompress, str) else list(precompress)
+    for encoding in encodings:
+        if encoding not in EXTENSIONS:
+            logger.error(
+                "Unknown precompress encoding '%s', supported encodings are: %s",
+                encoding,
+                ", ".join(EXTENSIONS),
+            )
+            sys.exit(1)
+    if "br" in encodings and brotli is None:
+        logger.warning(
+            "Precompress: the brotli package is not installed, not writing .br files"
+        )
+        encodings.remove("br")
+    return encodings
+
+
+def compress(data, encoding):
+    # The output only depends on data: gzip headers have no file name nor modification time and
+    # brotli has none, so that unchanged files are compressed the same way from one build to the
+    # other.
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+def compressible(path):
+    return path.endswith(COMPRESSIBLE) and os.path.getsize(path) >= MIN_SIZE
+
+
+def precompress(path, encodings):
+    # Writes the siblings of path compressed with each of encodings, with the same modification
+    # time as path. Returns the fingerprint of the content compressed.
+    with open(path, "rb") as f:
+        data = f.read()
+        stat = os.fstat(f.fileno())
+
+    for encoding in encodings:
+        sibling = path + EXTENSIONS[encoding]
+        with open(sibling, "wb") as f:
+            f.write(compress(data, encoding))
+        os.utime(sibling, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        # Same as file_digest()
+        "digest": hashlib.blake2b(data, digest_size=32).hexdigest(),
+    }
+
+
+def cost(path, encodings):
+    size = os.path.getsize(path) / 1024 / 1024
+    return sum(COMPRESS_COSTS[encoding] for encoding in encodings) * size
+
+
+def needs_precompress(cache, path, encodings):
+    # Returns whether the siblings of path are missing or were compressed from another content.
+    # Files written again with the same content, e.g. pages rendered again, are not compressed
+    # again, only the modification time of their siblings is updated.
+    siblings = [path + EXTENSIONS[encoding] for encoding in encodings]
+    stored = cache.precompressed(path)
+    if (
+        stored is None
+        or stored["encodings"] != encodings
+        or not all(os.path.exists(sibling) for sibling in siblings)
+    ):
+        return True
+
+    stat = os.stat(path)
+    if stored["mtime_ns"] == stat.st_mtime_ns and stored["size"] == stat.st_size:
+        return False
+    digest = file_digest(path)
+    if digest != stored["digest"]:
+        return True
+
+    for sibling in siblings:
+        os.utime(sibling, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    cache.store_precompressed(
+        path,
+        {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "digest": digest},
+        encodings,
+    )
+    return False
+
+
+def stale_outputs(cache, directory, encodings):
+    # Returns the compressible files of directory whose siblings need to be written
+    stale = []
+    for dirpath, _, filenames in os.walk(directory):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if compressible(path) and needs_precompress(cache, path, encodings):
+                stale.append(path)
+    return stale
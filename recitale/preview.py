@@ -0,0 +1,322 @@
+from functools import partial
+from http import HTTPStatus
+import email.utils
+import datetime
+import http.server
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import urllib.parse
+
+
+logger = logging.getLogger("recitale." + __name__)
+
+LIVERELOAD_PATH = "/__recitale__/livereload"
+
+# Reloads the page whenever the server sends an event, EventSource reconnects by itself if the
+# server is restarted.
+LIVERELOAD_SCRIPT = (
+    '<script>new EventSource("%s").onmessage = function () { location.reload(); };'
+    "</script>" % LIVERELOAD_PATH
+).encode("utf-8")
+
+# Browsers close connections idle for too long, and the server only notices a browser left
+# when writing to its connection.
+KEEPALIVE_INTERVAL = 15
+
+# Precompressed siblings of files sent instead of them when the client accepts their encoding,
+# by order of preference.
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+
+def parse_range(header, size):
+    # Returns the first and last bytes of the range of a Range header for a file of size bytes,
+    # None if the header is to be ignored. Only single ranges are supported, the whole file is
+    # sent otherwise. The first byte is past the end of the file if the range is unsatisfiable.
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, separator, last = ranges.strip().partition("-")
+    if not separator:
+        return None
+    try:
+        if not first:
+            # The last bytes of the file
+            length = int(last)
+            return (max(size - length, 0) if length else size), size - 1
+        start = int(first)
+        end = int(last) if last else max(start, size - 1)
+    except ValueError:
+        return None
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def accepted_encodings(header):
+    # Returns the content codings of an Accept-Encoding header not refused with q=0
+    encodings = set()
+    for item in header.split(","):
+        coding, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if coding.strip() and quality > 0:
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+class LiveReload:
+    # Tells the browsers connected to the server to reload the page after each build
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+
+    def reload(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout=None):
+        # Returns the current generation once different from generation, or after timeout
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+
+class PreviewServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # Each connection is handled in its own thread so that a slow client, or a video being
+    # streamed, does not stall the others.
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients close connections anytime, e.g. when seeking in a video
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class PreviewServerV6(PreviewServer):
+    address_family = socket.AF_INET6
+
+
+class PreviewHandler(http.server.SimpleHTTPRequestHandler):
+    # Keeps connections open between requests
+    protocol_version = "HTTP/1.1"
+    # Closes connections idle for that long (in seconds)
+    timeout = 60
+    # Headers and content are sent separately, the content would otherwise wait for the client
+    # to acknowledge the headers, which it delays by up to 40ms.
+    disable_nagle_algorithm = True
+    # Thumbnail variants, missing from the MIME types of older systems
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
+        ".avif": "image/avif",
+        ".webp": "image/webp",
+    }
+
+    def __init__(self, *args, livereload=None, **kwargs):
+        # The request is handled by the constructor of the parent class
+        self.livereload = livereload
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.livereload is not None:
+            if self.path == LIVERELOAD_PATH:
+                self.send_events()
+                return
+            if self.send_html():
+                return
+        super().do_GET()
+
+    def send_head(self):
+        # Same as SimpleHTTPRequestHandler.send_head() with support for ETag, Range and
+        # precompressed files. Returns the file to send, whose range to send is in self.range.
+        self.range = 0, None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            index = os.path.join(path, "index.html")
+            trailing_slash = urllib.parse.urlsplit(self.path).path.endswith("/")
+            if not trailing_slash or not os.path.isfile(index):
+                # Redirects to the path with a trailing slash or lists the directory
+                return super().send_head()
+            path = index
+        if path.endswith("/") or not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        encoding, sent, variants = self.precompressed(path)
+        try:
+            f = open(sent, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        try:
+            stat = os.fstat(f.fileno())
+            etag = '"%x-%x%s"' % (
+                stat.st_mtime_ns,
+                stat.st_size,
+                "-" + encoding if encoding else "",
+            )
+            headers = [
+                ("ETag", etag),
+                ("Last-Modified", self.date_time_string(stat.st_mtime)),
+                # Browsers check whether files changed, e.g. after a build, each time
+                ("Cache-Control", "no-cache"),
+            ]
+            if encoding:
+                headers.append(("Content-Encoding", encoding))
+            if variants:
+                headers.append(("Vary", "Accept-Encoding"))
+
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                f.close()
+                return None
+
+            status = HTTPStatus.OK
+            start, end = 0, stat.st_size - 1
+            requested = self.requested_range(etag, stat.st_size)
+            if requested is not None:
+                start, end = requested
+                if start >= stat.st_size:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", "bytes */%d" % stat.st_size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    f.close()
+                    return None
+                status = HTTPStatus.PARTIAL_CONTENT
+
+            self.send_response(status)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header(
+                    "Content-Range", "bytes %d-%d/%d" % (start, end, stat.st_size)
+                )
+            for header in headers:
+                self.send_header(*header)
+            self.end_headers()
+            self.range = start, end - start + 1
+            return f
+        except BaseException:
+            f.close()
+            raise
+
+    def precompressed(self, path):
+        # Returns the encoding and path of the file to send for path, and whether there are
+        # precompressed siblings of it. Siblings older than path are left from a former
+        # version of it and ignored.
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding", ""))
+        mtime = os.stat(path).st_mtime_ns
+        variants = False
+        for encoding, extension in PRECOMPRESSED:
+            try:
+                if os.stat(path + extension).st_mtime_ns < mtime:
+                    continue
+            except OSError:
+                continue
+            variants = True
+            if encoding in accepted or "*" in accepted:
+                return encoding, path + extension, variants
+        return None, path, variants
+
+    def not_modified(self, etag, mtime):
+        if "If-None-Match" in self.headers:
+            tags = [tag.strip() for tag in self.headers["If-None-Match"].split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
+        if "If-Modified-Since" in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    self.headers["If-Modified-Since"]
+                )
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def requested_range(self, etag, size):
+        if "Range" not in self.headers:
+            return None
+        # The whole file is sent if it changed since the client got the first bytes of it
+        if "If-Range" in self.headers and self.headers["If-Range"].strip() != etag:
+            return None
+        return parse_range(self.headers["Range"], size)
+
+    def copyfile(self, source, outputfile):
+        # Files are sent with sendfile(), without copying them to user space. Directory
+        # listings, which are not files, are sent with send().
+        offset, count = self.range
+        if count != 0:
+            self.connection.sendfile(source, offset, count)
+
+    def send_html(self):
+        # Sends HTML pages with the live reload script added, returns False for other files
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split("?", 1)[0].endswith("/"):
+            path = os.path.join(path, "index.html")
+        if not path.endswith(".html") or not os.path.isfile(path):
+            return False
+
+        with open(path, "rb") as f:
+            html = f.read()
+        end = html.rfind(b"</body>")
+        if end < 0:
+            end = len(html)
+        html = html[:end] + LIVERELOAD_SCRIPT + html[end:]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(html)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(html)
+        return True
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+
+        generation = self.livereload.generation
+        try:
+            while True:
+                current = self.livereload.wait(generation, KEEPALIVE_INTERVAL)
+                if current != generation:
+                    generation = current
+                    self.wfile.write(b"data: reload\n\n")
+                else:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def make_server(directory, bind="", port=9000, livereload=None):
+    # Returns a server of the files of directory, pages reload themselves when
+    # livereload.reload() is called if given.
+    handler = partial(PreviewHandler, directory=str(directory), livereload=livereload)
+    server_class = PreviewServerV6 if ":" in bind else PreviewServer
+    return server_class((bind, port), handler)
@@ -1,46 +1,72 @@
 #!/usr/bin/env python
 
-from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
+import copy
+import hashlib
+import json
 import logging
+import mimetypes
+import multiprocessing
 import os
 import shutil
 import shlex
-import socketserver
 import subprocess
 import sys
-import http.server
 import struct
-import re
+import threading
+import time
 
-from babel.core import default_locale
-from babel.dates import format_date
-from multiprocessing import Pool, Manager, Process
-from PIL import Image, ImageOps, JpegImagePlugin, ImageFile
+from multiprocessing import Pool
+from PIL import Image, ImageOps, ImageFile
 from tqdm import tqdm
 
 from pathlib import Path
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    TemplateNotFound,
+)
 
+from .assets import AssetsExtension, stage_static, static_source
 from .cache import Cache
-from .utils import encrypt, rfc822, load_settings, CustomFormatter
+
+# Entry point of former versions, the command line is handled by cli.py
+from .cli import main  # noqa: F401
+from .utils import (
+    encrypt,
+    find_galleries,
+    rfc822,
+    load_settings,
+    preload_settings,
+    sync_tree,
+)
 from .autogen import autogen
 from .__init__ import __version__
-from .image import ImageFactory
-from .video import VideoFactory
-from .audio import AudioFactory
-
-
-def loglevel(string):
-    try:
-        return int(string)
-    except ValueError:
-        pass
-    if hasattr(logging, string):
-        return getattr(logging, string)
-    raise ArgumentTypeError(
-        "takes an integer or a predefined log level from logging module."
-    )
+from .image import (
+    BaseImage,
+    ImageFactory,
+    Thumbnail,
+    get_formats,
+    image_metadata,
+    pyramid_resize,
+    read_metadata,
+    read_placeholder,
+    thumbnail_size,
+)
+from .video import BaseVideo, VideoFactory
+from .video import probe as probe_video
+from .audio import AudioFactory, BaseAudio
+from .audio import probe as probe_audio
+from .scheduler import Job, Scheduler
+from .precompress import EXTENSIONS as PRECOMPRESSED_EXTENSIONS
+from .precompress import cost as precompress_cost
+from .precompress import get_encodings, precompress, stale_outputs
+from .preview import LiveReload, make_server
+from .watch import get_watcher
 
 
 SETTINGS = {
@@ -50,6 +76,8 @@ SETTINGS = {
         "strip": True,
         "resize": None,
         "progressive": True,
+        "draft": True,
+        "reduction-ratio": 2,
     },
     "ffmpeg": {
         "binary": "ffmpeg",
@@ -62,12 +90,15 @@ SETTINGS = {
         "video": "libvpx",
         "other": "-qmin 10 -qmax 42 -maxrate 500k -bufsize 1500k",
         "extension": "webm",
+        "threads": 2,
+        "concurrency": None,
     },
     "ffmpeg_audio": {
         "binary": "ffmpeg",
         "loglevel": "error",
         "audio": "libmp3lame",
         "extension": "mp3",
+        "concurrency": None,
     },
 }
 
@@ -77,10 +108,6 @@ ImageFactory.global_options = SETTINGS["gm"]
 VideoFactory.global_options = SETTINGS["ffmpeg"]
 
 
-class TCPServerV4(socketserver.TCPServer):
-    allow_reuse_address = True
-
-
 def get_settings():
     DEFAULTS = {
         "rss": True,
@@ -100,6 +127,23 @@ def get_settings():
         if key not in settings:
             settings[key] = value
 
+    if (
+        settings["rss"] or settings["share"] or settings["settings"].get("og")
+    ) and not settings.get("url"):
+        logger.warning(
+            "warning: If you want the rss, OpenGraph and/or the social network share to work, "
+            "you need to specify the website url in root settings"
+        )
+        settings["rss"] = False
+        settings["share"] = False
+        settings["settings"]["og"] = False
+
+    return settings
+
+
+def set_media_settings(settings):
+    # Settings of thumbnails and reencodes, and the binaries reencoding videos. Only looked at
+    # by commands reading media.
     if settings["settings"].get("ffmpeg"):
         SETTINGS["ffmpeg"].update(settings["settings"]["ffmpeg"])
 
@@ -126,24 +170,17 @@ def get_settings():
             )
             SETTINGS["ffmpeg"] = False
 
-    if (
-        settings["rss"] or settings["share"] or settings["settings"].get("og")
-    ) and not settings.get("url"):
-        logger.warning(
-            "warning: If you want the rss, OpenGraph and/or the social network share to work, "
-            "you need to specify the website url in root settings"
-        )
-        settings["rss"] = False
-        settings["share"] = False
-        settings["settings"]["og"] = False
-
     if settings["settings"].get("gm"):
         SETTINGS["gm"].update(settings["settings"]["gm"])
-
-    return settings
+    if SETTINGS["gm"].get("formats"):
+        SETTINGS["gm"]["formats"] = get_formats(SETTINGS["gm"]["formats"])
 
 
 def get_local_date_filter(date_locale):
+    # Babel takes a while to import, only needed by templates
+    from babel.core import default_locale
+    from babel.dates import format_date
+
     if date_locale is None:
         date_locale = default_locale("LC_TIME") or "en_US_POSIX"
 
@@ -153,6 +190,93 @@ def get_local_date_filter(date_locale):
     return local_date
 
 
+# Templates loaded since the last call to record_page(), as (theme, name)
+loaded_templates = set()
+
+
+class TemplatesEnvironment(Environment):
+    # Records the templates loaded, including those extended, included or imported by other
+    # templates, in loaded_templates.
+    def __init__(self, theme, **kwargs):
+        super().__init__(**kwargs)
+        self.theme = theme
+
+    def _load_template(self, name, globals):
+        loaded_templates.add((self.theme, name))
+        return super()._load_template(name, globals)
+
+
+class TemplatesBytecodeCache(FileSystemBytecodeCache):
+    # Compiled templates are kept from one build to the other, as long as their source did not
+    # change once preprocessed: the tags of bundles added by AssetsExtension depend on the static
+    # directory too.
+    def get_bucket(self, environment, name, filename, source):
+        source = environment.preprocess(source, name, filename)
+        return super().get_bucket(environment, name, filename, source)
+
+
+# Environments by theme, locale and template search path, shared by all pages of a build so that
+# each template is only loaded once per process. Kept from one build to the other by watch(),
+# until their templates or static files change.
+theme_templates = {}
+
+
+def get_theme_templates(theme, date_locale=None):
+    templates_dir = [
+        Path(".").joinpath("templates").resolve(),
+        Path(__file__).parent.joinpath("themes", theme, "templates"),
+    ]
+
+    if theme != "exposure":
+        templates_dir.append(
+            Path(__file__).parent.joinpath("themes", "exposure", "templates")
+        )
+
+    key = theme, date_locale, tuple(templates_dir)
+    if key in theme_templates:
+        return theme_templates[key]
+
+    bytecode_dir = Path(".").joinpath(".recitale_cache", "templates").resolve()
+    bytecode_dir.mkdir(parents=True, exist_ok=True)
+    templates = TemplatesEnvironment(
+        theme,
+        loader=FileSystemLoader(templates_dir),
+        trim_blocks=True,
+        extensions=[AssetsExtension],
+        bytecode_cache=TemplatesBytecodeCache(str(bytecode_dir)),
+    )
+    templates.filters["rfc822"] = rfc822
+    templates.filters["local_date"] = get_local_date_filter(date_locale)
+    theme_templates[key] = templates
+    return templates
+
+
+def invalidate_theme_templates(changes):
+    # Forgets the environments depending on the changed paths, all of them if changes is None:
+    # templates of the site may have been added, overriding those of the theme, and the bundles
+    # of compiled templates depend on the static directories.
+    if changes is None:
+        theme_templates.clear()
+        return
+    changes = [Path(path).resolve() for path in changes]
+    for key in list(theme_templates):
+        theme, _, templates_dir = key
+        sources = [
+            source.resolve()
+            for source in list(templates_dir)
+            + [
+                Path(".").joinpath("static"),
+                Path(__file__).parent.joinpath("themes", theme, "static"),
+            ]
+        ]
+        if any(
+            path == source or source in path.parents or path in source.parents
+            for path in changes
+            for source in sources
+        ):
+            del theme_templates[key]
+
+
 def get_gallery_templates(
     theme, gallery_path="", parent_templates=None, date_locale=None
 ):
@@ -170,48 +294,41 @@ def get_gallery_templates(
         )
         sys.exit(1)
 
-    templates_dir = [
-        Path(".").joinpath("templates").resolve(),
-        Path(__file__).parent.joinpath("themes", theme, "templates"),
-    ]
+    subgallery_templates = get_theme_templates(theme, date_locale)
+    copy_static(theme, gallery_path)
 
-    if theme != "exposure":
-        templates_dir.append(
-            Path(__file__).parent.joinpath("themes", "exposure", "templates")
-        )
+    return subgallery_templates
 
-    subgallery_templates = Environment(
-        loader=FileSystemLoader(templates_dir), trim_blocks=True
-    )
-    subgallery_templates.filters["rfc822"] = rfc822
-    subgallery_templates.filters["local_date"] = get_local_date_filter(date_locale)
 
-    try:
-        buildp = (
-            Path(".").joinpath("build", gallery_path, "static").resolve(strict=True)
-        )
-        shutil.rmtree(buildp)
-    except FileNotFoundError:
-        pass
-
-    if Path(".").joinpath("static").exists():
-        shutil.copytree(
-            Path(".").joinpath("static"),
-            Path(".").joinpath("build", gallery_path, "static"),
-        )
+# Static directories with the bundles of stylesheets and scripts of templates, by theme. They
+# are written once per build and copied to each static directory of the build.
+staged_static = {}
 
-    else:
-        shutil.copytree(
-            Path(__file__).parent.joinpath("themes", theme, "static"),
-            Path(".").joinpath("build", gallery_path, "static"),
+
+def get_static(theme):
+    if theme not in staged_static:
+        staged_static[theme] = stage_static(
+            get_theme_templates(theme),
+            static_source(theme),
+            Path(".").joinpath(".recitale_cache", "static", theme),
         )
+    return staged_static[theme]
 
-    return subgallery_templates
+
+def copy_static(theme, gallery_path):
+    sync_tree(
+        get_static(theme),
+        Path(".").joinpath("build", gallery_path, "static"),
+        tuple(PRECOMPRESSED_EXTENSIONS.values()),
+    )
 
 
 def process_directory(
-    gallery_name, settings, parent_templates, parent_gallery_path=False
+    gallery_name, settings, parent_theme, pages, parent_gallery_path=False
 ):
+    # Galleries are only listed here, along with the theme of their parent index, in pages to
+    # be rendered later with Pages.render_galleries(). Indexes of subgalleries are built right
+    # away.
     if parent_gallery_path:
         gallery_path = parent_gallery_path.joinpath(gallery_name)
     else:
@@ -230,13 +347,13 @@ def process_directory(
     Path("build").joinpath(gallery_path).mkdir(parents=True, exist_ok=True)
 
     if not gallery_settings.get("public", True):
-        build_gallery(settings, gallery_settings, gallery_path, parent_templates)
+        pages.gallery(gallery_settings, gallery_path, parent_theme)
         return gallery_cover
 
     gallery_cover = create_cover(gallery_name, gallery_settings, gallery_path)
 
     if not sub_galleries:
-        build_gallery(settings, gallery_settings, gallery_path, parent_templates)
+        pages.gallery(gallery_settings, gallery_path, parent_theme)
         return gallery_cover
 
     if gallery_settings.get("sections", False):
@@ -252,7 +369,6 @@ def process_directory(
     subgallery_templates = get_gallery_templates(
         theme,
         gallery_path,
-        parent_templates,
         date_locale=settings["settings"].get("date_locale"),
     )
     sub_page_galleries_cover = []
@@ -264,15 +380,12 @@ def process_directory(
         bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
     ):
         sub_page_galleries_cover.append(
-            process_directory(
-                subgallery.name, settings, subgallery_templates, gallery_path
-            )
+            process_directory(subgallery.name, settings, theme, pages, gallery_path)
         )
 
-    build_index(
-        settings,
-        sub_page_galleries_cover,
+    pages.index(
         subgallery_templates,
+        sub_page_galleries_cover,
         gallery_path,
         sub_index=True,
         gallery_settings=gallery_settings,
@@ -356,13 +469,17 @@ def __build_gallery(
         )
 
 
+def has_light_mode(settings, gallery_settings):
+    return gallery_settings.get("light_mode", False) or (
+        settings["settings"].get("light_mode", False)
+        and not gallery_settings.get("light_mode")
+    )
+
+
 def build_gallery(settings, gallery_settings, gallery_path, template):
     __build_gallery(settings, gallery_settings, gallery_path, gallery_path, template)
 
-    if not gallery_settings.get("light_mode", False) and (
-        not settings["settings"].get("light_mode", False)
-        or gallery_settings.get("light_mode")
-    ):
+    if not has_light_mode(settings, gallery_settings):
         return
 
     Path("build").joinpath(gallery_path, "light").mkdir(parents=True, exist_ok=True)
@@ -376,6 +493,384 @@ def build_gallery(settings, gallery_settings, gallery_path, template):
     )
 
 
+def record_page(func, *args, **kwargs):
+    # Renders a page with func and returns the templates it loaded and the media it requested,
+    # which are not added to the factories.
+    factories = ImageFactory.base_imgs, VideoFactory.base_vids, AudioFactory.base_audios
+    ImageFactory.base_imgs = dict()
+    VideoFactory.base_vids = dict()
+    AudioFactory.base_audios = dict()
+    loaded_templates.clear()
+    try:
+        func(*args, **kwargs)
+        return sorted(loaded_templates), (
+            ImageFactory.base_imgs,
+            VideoFactory.base_vids,
+            AudioFactory.base_audios,
+        )
+    finally:
+        (
+            ImageFactory.base_imgs,
+            VideoFactory.base_vids,
+            AudioFactory.base_audios,
+        ) = factories
+
+
+def merge_media(requests):
+    base_imgs, base_vids, base_audios = requests
+    ImageFactory.merge(base_imgs)
+    VideoFactory.merge(base_vids)
+    AudioFactory.merge(base_audios)
+
+
+def dump_requests(requests):
+    # Media requested by a page, as JSON stored in the cache: the options of each picture, video
+    # and audio file, and the sizes and formats of the thumbnails and reencodes requested. Options
+    # removed by remove_superficial_options() are stored aside so that load_requests() creates
+    # the same objects.
+    base_imgs, base_vids, base_audios = requests
+    return json.dumps(
+        {
+            "images": [
+                {
+                    "options": dict(
+                        base.options,
+                        name=str(base.filepath),
+                        resize=base.resize,
+                        draft=base.draft,
+                        **{"reduction-ratio": base.reduction_ratio},
+                    ),
+                    "thumbnails": [
+                        [thumbnail.size, sorted(thumbnail.formats)]
+                        for thumbnail in base.thumbnails.values()
+                    ],
+                }
+                for base in base_imgs.values()
+            ],
+            "videos": [
+                {
+                    "options": dict(
+                        base.options, name=str(base.filepath), threads=base.threads
+                    ),
+                    "thumbnails": [
+                        thumbnail.size for thumbnail in base.thumbnails.values()
+                    ],
+                    "reencodes": [
+                        reencode.size for reencode in base.reencodes.values()
+                    ],
+                }
+                for base in base_vids.values()
+            ],
+            "audios": [
+                {
+                    "filepath": str(base.filepath),
+                    "options": base.options,
+                    "reencode": bool(base.reencodes),
+                }
+                for base in base_audios.values()
+            ],
+        },
+        sort_keys=True,
+    )
+
+
+def load_requests(text):
+    # Returns the media stored with dump_requests() as dictionaries like those of the factories
+    requests = json.loads(text)
+    base_imgs, base_vids, base_audios = {}, {}, {}
+
+    for image in requests["images"]:
+        base = BaseImage(
+            dict(image["options"], name=Path(image["options"]["name"])), {}
+        )
+        for size, formats in image["thumbnails"]:
+            thumbnail = Thumbnail(base.filepath, base.chksum_opt, tuple(size))
+            thumbnail.formats = frozenset(formats)
+            base._add_thumbnail(thumbnail)
+        base_imgs[base.filepath / str(base.chksum_opt)] = base
+
+    for video in requests["videos"]:
+        base = BaseVideo(
+            dict(video["options"], name=Path(video["options"]["name"])), {}
+        )
+        for size in video["thumbnails"]:
+            base.thumbnail(tuple(size))
+        for size in video["reencodes"]:
+            base.reencode(tuple(size))
+        base_vids[base.filepath / str(base.chksum_opt)] = base
+
+    for audio in requests["audios"]:
+        base = BaseAudio(Path(audio["filepath"]), audio["options"])
+        if audio["reencode"]:
+            base.reencode()
+        base_audios[base.filepath / str(base.chksum_opt)] = base
+
+    return base_imgs, base_vids, base_audios
+
+
+def render_gallery(page):
+    # Renders the page of a gallery in a process of the pool. Thumbnails and reencodes requested
+    # by the templates are returned so that they are added to the factories of the main process,
+    # along with what changed in the copy of the cache of this process, e.g. media probed.
+    gallery_settings, gallery_path, theme = page
+    shared = render_gallery.shared
+    settings = shared["settings"]
+    date_locale = settings["settings"].get("date_locale")
+
+    (
+        ImageFactory.global_options,
+        VideoFactory.global_options,
+        AudioFactory.global_options,
+    ) = shared["options"]
+    ImageFactory.cache = VideoFactory.cache = AudioFactory.cache = shared["cache"]
+    staged_static.update(shared["static"])
+
+    try:
+        templates, requests = record_page(
+            build_gallery,
+            settings,
+            gallery_settings,
+            gallery_path,
+            get_theme_templates(theme, date_locale),
+        )
+    except SystemExit as e:
+        # The error is already logged, the pool would wait forever for this process to return
+        return e.code, None, None, shared["cache"].pop_updates()
+
+    return None, templates, requests, shared["cache"].pop_updates()
+
+
+# Digests of templates by theme and name, they do not change during a build
+template_digests = {}
+
+
+def template_digest(theme, name):
+    if (theme, name) not in template_digests:
+        templates = get_theme_templates(theme)
+        try:
+            source, filename, _ = templates.loader.get_source(templates, name)
+            # Preprocessed since the tags of bundles depend on the static directory too
+            source = templates.preprocess(source, name, filename)
+            digest = hashlib.blake2b(
+                (filename + "\0" + source).encode("utf-8")
+            ).hexdigest()
+        except TemplateNotFound:
+            digest = None
+        template_digests[theme, name] = digest
+    return template_digests[theme, name]
+
+
+def page_digest(cache, context, templates, media):
+    # Digest of everything a page depends on: context holds the settings it was rendered with,
+    # templates and media are those used the last time it was rendered. Templates are identified
+    # by their path and content, so that a template overridden in the templates directory of the
+    # site is detected too. Pictures, videos and audio files by their metadata.
+    def metadata(path):
+        try:
+            return cache.probe_infos(path)
+        except OSError:
+            return None
+
+    inputs = [
+        context,
+        [(theme, name, template_digest(theme, name)) for theme, name in templates],
+        [(path, metadata(path)) for path in media],
+    ]
+    return hashlib.blake2b(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class Pages:
+    # Renders pages of the site only if one of their inputs changed since the last build, or
+    # all of them if full is set. The media requested by a page are kept in the cache too, so
+    # that they are added to the factories even if the page is not rendered again. Galleries
+    # are rendered in the processes of workers. When changed_galleries is not None, only the
+    # galleries it returned True for are considered, the others are known to be up to date.
+    def __init__(
+        self, cache, settings, full=False, workers=None, changed_galleries=None
+    ):
+        self.cache = cache
+        self.settings = settings
+        self.workers = workers
+        self.full = full
+        self.changed_galleries = changed_galleries
+        self.galleries = []
+
+    def _context(self, kind, **context):
+        context.update(kind=kind, version=__version__, settings=self.settings)
+        return json.dumps(context, sort_keys=True, default=str)
+
+    def _requests(self, page, context, outputs):
+        # Returns the media requested by the page if it is up to date, None otherwise
+        if self.full or not all(Path(output).exists() for output in outputs):
+            return None
+        stored = self.cache.page(page)
+        if stored is None or stored["digest"] != page_digest(
+            self.cache, context, stored["templates"], stored["media"]
+        ):
+            return None
+        try:
+            requests = load_requests(stored["requests"])
+        except (ValueError, KeyError, TypeError) as e:
+            # e.g. stored by a former version
+            logger.debug("(%s) Cannot load the media it requested: %s", page, e)
+            return None
+        logger.debug("(%s) Inputs did not change, not rendering it again", page)
+        return requests
+
+    def _store(self, page, context, templates, requests):
+        media = sorted(
+            {str(base.filepath) for bases in requests for base in bases.values()}
+        )
+        self.cache.store_page(
+            page,
+            page_digest(self.cache, context, templates, media),
+            templates,
+            media,
+            dump_requests(requests),
+        )
+        merge_media(requests)
+
+    def _render(self, page, context, outputs, func, *args, **kwargs):
+        requests = self._requests(page, context, outputs)
+        if requests is not None:
+            merge_media(requests)
+            return
+        templates, requests = record_page(func, *args, **kwargs)
+        self._store(page, context, templates, requests)
+
+    def index(
+        self,
+        templates,
+        galleries_cover,
+        gallery_path="",
+        sub_index=False,
+        gallery_settings={},
+    ):
+        page = str(Path("build").joinpath(gallery_path, "index.html"))
+        context = self._context(
+            "index",
+            theme=templates.theme,
+            galleries=galleries_cover,
+            path=str(gallery_path),
+            sub_index=sub_index,
+            gallery=gallery_settings,
+        )
+        self._render(
+            page,
+            context,
+            [page],
+            build_index,
+            self.settings,
+            galleries_cover,
+            templates,
+            gallery_path,
+            sub_index=sub_index,
+            gallery_settings=gallery_settings,
+        )
+
+    def feed(self, templates, galleries_cover):
+        page = str(Path("build").joinpath("feed.xml"))
+        context = self._context(
+            "feed", theme=templates.theme, galleries=galleries_cover
+        )
+        self._render(
+            page, context, [page], build_feed, self.settings, galleries_cover, templates
+        )
+
+    def gallery(self, gallery_settings, gallery_path, theme):
+        # Rendered later, in parallel, with render_galleries()
+        page = str(Path("build").joinpath(gallery_path, "index.html"))
+        if self.changed_galleries is not None and not self.changed_galleries(
+            gallery_path
+        ):
+            logger.debug("(%s) Gallery did not change, not rendering it again", page)
+            return
+        context = self._context(
+            "gallery", theme=theme, path=str(gallery_path), gallery=gallery_settings
+        )
+        outputs = [page]
+        if has_light_mode(self.settings, gallery_settings):
+            outputs.append(
+                str(Path("build").joinpath(gallery_path, "light", "index.html"))
+            )
+        self.galleries.append(
+            (page, context, outputs, (gallery_settings, gallery_path, theme))
+        )
+
+    def _render_galleries(self, galleries):
+        # Yields what render_gallery() returns for each of galleries, in the same order
+        if not galleries:
+            return
+        # The light mode static directory is staged once here rather than by each process
+        if any(
+            has_light_mode(self.settings, gallery_settings)
+            for gallery_settings, _, _ in galleries
+        ):
+            get_static("light")
+        shared = {
+            "settings": self.settings,
+            "cache": self.cache,
+            "static": staged_static,
+            "options": (
+                ImageFactory.global_options,
+                VideoFactory.global_options,
+                AudioFactory.global_options,
+            ),
+        }
+        pool = self.workers.share(set_func_args, (shared, [render_gallery]))
+        yield from pool.imap(render_gallery, galleries)
+
+    def render_galleries(self):
+        # Pages of galleries are rendered in parallel, which is most of the time spent building
+        # galleries. Media they request are merged in the order of pages, like if they were
+        # rendered one after the other.
+        galleries = [
+            (page, context, args, self._requests(page, context, outputs))
+            for page, context, outputs, args in self.galleries
+        ]
+        results = self._render_galleries(
+            [args for _, _, args, requests in galleries if requests is None]
+        )
+
+        for page, context, args, requests in tqdm(
+            galleries,
+            desc="Building galleries",
+            bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
+        ):
+            gallery_settings, gallery_path, _ = args
+            if requests is None:
+                code, templates, requests, updates = next(results)
+                # Before storing the page, whose digest depends on the probes of its media
+                self.cache.merge(updates)
+                if requests is None:
+                    sys.exit(code)
+                self._store(page, context, templates, requests)
+                continue
+
+            merge_media(requests)
+            # Static files of the light mode are copied when rendering its page
+            if has_light_mode(self.settings, gallery_settings):
+                copy_static("light", Path(gallery_path).joinpath("light"))
+
+
+def build_feed(settings, galleries_cover, templates):
+    feed_template = templates.get_template("feed.xml")
+
+    xml = feed_template.render(
+        settings=settings,
+        galleries=reversed(
+            sorted(
+                [x for x in galleries_cover if x != {}],
+                key=lambda x: x["date"],
+            )
+        ),
+    ).encode("Utf-8")
+
+    open(Path("build").joinpath("feed.xml"), "wb").write(xml)
+
+
 def build_index(
     settings,
     galleries_cover,
@@ -415,64 +910,107 @@ def build_index(
         open(Path("build").joinpath(gallery_path, "index.html"), "wb").write(html)
 
 
-def image_params(img, options):
-    format = img.format
-
-    params = {"format": format}
+def image_params(metadata, options):
+    params = {"format": metadata["format"]}
     if "progressive" in options:
         params["progressive"] = options["progressive"]
     if "quality" in options:
         params["quality"] = options["quality"]
-    if "dpi" in img.info:
-        params["dpi"] = img.info["dpi"]
-        # For following formats, dpi is of type IFDRational which is not serializable
-        if format in ["JPEG", "MPO", "TIFF"]:
-            params["dpi"] = (float(params["dpi"][0]), float(params["dpi"][1]))
-    if format == "JPEG" or format == "MPO":
-        params["subsampling"] = JpegImagePlugin.get_sampling(img)
-
-    exif = img.getexif()
-    if exif:
-        params["exif"] = exif
+    if metadata["dpi"] is not None:
+        params["dpi"] = tuple(metadata["dpi"])
+    if metadata["subsampling"] is not None:
+        params["subsampling"] = metadata["subsampling"]
 
     return params
 
 
-def noncached_images(base):
-    img = Image.open(base.filepath)
-    params = image_params(img, base.options)
-
-    if params.get("exif") and base.options.get("strip", False):
-        del params["exif"]
-
-    for thumbnail in base.thumbnails.values():
-        filepath = Path("build") / thumbnail.filepath
-
-        if noncached_images.shared["cache"].needs_to_be_generated(
-            base.filepath, str(filepath), params
-        ):
-            noncached_images.shared["queue"].put(1)
-            return base
-
-    noncached_images.shared["queue"].put(1)
+def variant_params(params, fmt):
+    # Options of a thumbnail variant in the format fmt, the quality and EXIF metadata are the
+    # same as those of the thumbnail.
+    variant = {"format": fmt}
+    for key in ("quality", "exif"):
+        if params.get(key):
+            variant[key] = params[key]
+    return variant
+
+
+def save_variant(im, target, params):
+    # WebP and AVIF only store RGB pictures, with or without an alpha channel
+    if im.mode not in ("RGB", "RGBA"):
+        alpha = im.mode in ("LA", "PA", "RGBa") or "transparency" in im.info
+        im = im.convert("RGBA" if alpha else "RGB")
+    im.save(target, **params)
+
+
+def render_thumbnails(task):
+    start = time.perf_counter()
+    filepath, chksum_opt, draft, reduction_ratio, thumbnails = task
+    options = render_thumbnails.shared["options"][chksum_opt]
+
+    # Parameters of thumbnails only depend on the metadata of the picture, usually found in the
+    # cache. The picture is opened and decoded only if at least one of its thumbnails actually
+    # needs to be generated.
+    metadata = image_metadata(filepath, render_thumbnails.shared["cache"])
+    params = image_params(metadata, options)
+
+    # Files to write for each thumbnail, the thumbnail and its variants in other formats, with
+    # the format of each, None for the format of the thumbnail.
+    outputs = {}
+    for path, size, variants in thumbnails:
+        outputs[path] = [
+            (target, fmt)
+            for target, fmt in [(path, None)] + list(variants)
+            if render_thumbnails.shared["cache"].needs_to_be_generated(
+                filepath,
+                str(Path("build") / target),
+                params if fmt is None else variant_params(params, fmt),
+            )
+        ]
+    thumbnails = [(path, size) for path, size, _ in thumbnails if outputs[path]]
 
+    if not thumbnails:
+        return (
+            filepath,
+            0,
+            time.perf_counter() - start,
+            render_thumbnails.shared["cache"].pop_updates(),
+        )
 
-def render_thumbnails(base):
-    logger.debug("(%s) Rendering thumbnails", base.filepath)
+    logger.debug("(%s) Rendering thumbnails", filepath)
 
-    img = Image.open(base.filepath)
-    params = image_params(img, base.options)
+    img = Image.open(filepath)
+    exif = img.getexif()
+    if exif:
+        params["exif"] = exif
 
-    exif = params.get("exif")
+    orientation = 1
+    if exif and options.get("auto-orient", False):
+        orientation = metadata["orientation"]
+
+    # Orientations 5 to 8 swap width and height of the original image
+    width, height = img.size if orientation < 5 else reversed(img.size)
+    sizes = {path: thumbnail_size((width, height), size) for path, size in thumbnails}
+
+    if draft and sizes:
+        # Ask the JPEG decoder to scale the picture down with its DCT scaling (by 1/2, 1/4 or
+        # 1/8) while decoding, which is much faster and uses less memory than decoding the full
+        # resolution picture. The decoder picks the smallest scale which keeps the picture at
+        # least as big as the biggest thumbnail to create, so that all thumbnails are still
+        # resampled with LANCZOS from a bigger picture. This is a no-op for other formats.
+        draft_width = max(w for w, _ in sizes.values())
+        draft_height = max(h for _, h in sizes.values())
+        if orientation >= 5:
+            draft_width, draft_height = draft_height, draft_width
+        if draft_width < img.size[0] and draft_height < img.size[1]:
+            img.draft(img.mode, (draft_width, draft_height))
+            logger.debug("(%s) Decoding picture with draft size %s", filepath, img.size)
 
     # Re-orient if requested and if Orientation EXIF metadata stored in 0x0112 states that
     # it's not upright.
-    if exif and base.options.get("auto-orient", False) and exif.get(0x0112, 1) != 1:
-        orientation = exif.get(0x0112)
-
+    if orientation != 1:
         logger.debug(
             "(%s) Orientation EXIF tag set to %d: rotating thumbnails",
-            base.filepath,
+            filepath,
             orientation,
         )
 
@@ -493,52 +1031,83 @@ def render_thumbnails(base):
                 8: Image.ROTATE_90,
             }.get(orientation)
             img = img.transpose(method)
-            if not base.options.get("strip", False):
+            if not options.get("strip", False):
                 logger.warning(
                     "(%s) Original image contains EXIF metadata that Pillow < %s cannot "
                     "handle. Consider upgrading to a newer release. The image will be "
                     "forcefully stripped of its EXIF metadata as a work-around.",
-                    base.filepath,
+                    filepath,
                     "7.2.0" if isinstance(e, TypeError) else "7.0.0",
                 )
                 del params["exif"]
 
-    if params.get("exif") and base.options.get("strip", False):
+    if params.get("exif") and options.get("strip", False):
         del params["exif"]
 
-    for thumbnail in base.thumbnails.values():
-        filepath = Path("build") / thumbnail.filepath
+    if params.get("exif"):
+        # Thumbnails are now upright, viewers must not rotate them again
+        if orientation != 1:
+            del params["exif"][0x0112]
 
-        if not render_thumbnails.shared["cache"].needs_to_be_generated(
-            base.filepath, str(filepath), params
-        ):
-            continue
+        # Serialize EXIF metadata once for all thumbnails instead of once per save
+        try:
+            params["exif"] = params["exif"].tobytes()
+        except TypeError as e:
+            # Work-around for Pillow < 7.2.0 because of broken handling of some exif metadata
+            # Fixed with https://github.com/python-pillow/Pillow/pull/4637
+            logger.warning(
+                "(%s) Original image contains EXIF metadata that Pillow < 7.2.0 cannot handle. "
+                "Consider upgrading to a newer release. The image will be forcefully stripped of "
+                "its EXIF metadata as a work-around.\n"
+                'The original error is "%s"',
+                filepath,
+                e,
+            )
+            del params["exif"]
 
-        # Needed because im.thumbnail replaces the original image
-        im = img.copy()
+    # Create thumbnails from the biggest to the smallest so that each one can be resampled from
+    # a smaller already created thumbnail instead of the original picture.
+    thumbnails.sort(key=lambda thumbnail: sizes[thumbnail[0]], reverse=True)
+    pyramid = [img]
 
-        width, height = thumbnail.size
+    for path, size in thumbnails:
+        target = Path("build") / path
 
-        if not width or not height:
-            # im.thumbnail() needs both valid values in the size tuple.
-            # Moreover, the function creates a thumbnail whose dimensions are
-            # within the provided size.
-            # When only one dimension is specified, the other should thus be
-            # outrageously big so that the thumbnail dimension will always be
-            # of the specified value.
-            IGNORE_DIM = 65596
-            height = height if height is not None else IGNORE_DIM
-            width = width if width is not None else IGNORE_DIM
-            im.thumbnail((width, height), Image.LANCZOS)
+        # Sizes are computed from the original picture dimensions so that they do not depend on
+        # the draft size of the decoded picture nor on the intermediate picture used.
+        width, height = sizes[path]
+
+        im = pyramid_resize(pyramid, (width, height), reduction_ratio)
+
+        for variant, fmt in outputs[path]:
+            if fmt is None:
+                continue
+            variant = Path("build") / variant
+            logger.debug(
+                "(%s) Creating thumbnail %s: size=%s from %s",
+                filepath,
+                variant,
+                size,
+                im.size,
+            )
+            variant_options = variant_params(params, fmt)
+            save_variant(im, variant, variant_options)
+            render_thumbnails.shared["cache"].cache_picture(
+                filepath, str(variant), variant_options
+            )
+        if outputs[path][0][1] is not None:
+            # Only variants of this thumbnail needed to be generated
+            continue
 
         logger.debug(
-            "(%s) Creating thumbnail %s: size=%s",
-            base.filepath,
+            "(%s) Creating thumbnail %s: size=%s from %s",
             filepath,
-            thumbnail.size,
+            target,
+            size,
+            im.size,
         )
         try:
-            im.save(filepath, **params)
+            im.save(target, **params)
         except OSError as e:
             # Work-around for:
             # https://github.com/python-pillow/Pillow/issues/148
@@ -548,107 +1117,201 @@ def render_thumbnails(base):
                 ' progressive, globally or for "%s". As a work-around, increase buffer size. This'
                 " might result in side-effects.\n"
                 'The original error is "%s"',
-                base.filepath,
                 filepath,
-                base.filepath,
+                target,
+                filepath,
                 e,
             )
-            width, height = (width, height) if width and height else thumbnail.size
             ImageFile.MAXBLOCK = max(
                 ImageFile.MAXBLOCK,
                 (4 * width * height) + len(im.info.get("icc_profile", "")) + 10,
             )
-            im.save(filepath, **params)
-        except TypeError as e:
-            # Work-around for Pillow < 7.2.0 because of broken handling of some exif metadata
-            # Fixed with https://github.com/python-pillow/Pillow/pull/4637
-            logger.warning(
-                "(%s) Original image contains EXIF metadata that Pillow < 7.2.0 cannot handle. "
-                "Consider upgrading to a newer release. The image will be forcefully stripped of "
-                "its EXIF metadata as a work-around.\n"
-                'The original error is "%s"',
-                base.filepath,
-                e,
-            )
-            del params["exif"]
-            im.save(filepath, **params)
+            im.save(target, **params)
 
         logger.debug(
             "(%s) Done creating thumbnail %s: size=%s",
-            base.filepath,
             filepath,
-            thumbnail.size,
+            target,
+            size,
         )
-        render_thumbnails.shared["cache"].cache_picture(
-            base.filepath, str(filepath), params
+        render_thumbnails.shared["cache"].cache_picture(filepath, str(target), params)
+
+    # This process works on its own copy of the cache, send back what changed along with a few
+    # figures for the main process.
+    return (
+        filepath,
+        len(thumbnails),
+        time.perf_counter() - start,
+        render_thumbnails.shared["cache"].pop_updates(),
+    )
+
+
+def merge_thumbnails(cache, cost, result):
+    filepath, created, elapsed, updates = result
+    logger.debug(
+        "(%s) %d thumbnails created: estimated cost %dms, actual cost %dms",
+        filepath,
+        created,
+        cost,
+        elapsed * 1000,
+    )
+    # Merged as soon as received so that they are part of the cache dumped even if the build is
+    # interrupted.
+    cache.merge(updates)
+
+
+def image_job(cache, base):
+    cost = base.cost(
+        thumbnail
+        for thumbnail in base.thumbnails.values()
+        if not all(
+            cache.may_be_cached(base.filepath, str(Path("build") / path))
+            for path in [thumbnail.filepath]
+            + [thumbnail.variant(name) for name in thumbnail.formats]
         )
-    render_thumbnails.shared["queue"].put(1)
+    )
+    # Tasks and results are kept small as they are pickled to and from the processes
+    return Job(
+        render_thumbnails,
+        (base.task(),),
+        cost=cost,
+        in_pool=True,
+        on_done=partial(merge_thumbnails, cache, cost),
+    )
 
 
-def render_video(cache, base):
-    logger.debug("(%s) Rendering thumbnails and reencodes", base.filepath)
-    basecmd = "{binary} -loglevel {loglevel} -y -i " + shlex.quote(str(base.filepath))
+def store_precompressed(cache, path, encodings, fingerprint):
+    cache.store_precompressed(path, fingerprint, encodings)
 
-    if base.reencodes:
-        reencodecmd = (
-            basecmd
-            + " -c:v {video} -b:v {vbitrate} {other} -c:a {audio} -b:a {abitrate} "
-            + "-f {format} -progress /dev/stdout "
+
+def precompress_jobs(cache, encodings):
+    # Compressing files is CPU-bound, it is done in the pool of processes like pictures
+    return [
+        Job(
+            precompress,
+            (path, encodings),
+            cost=precompress_cost(path, encodings),
+            in_pool=True,
+            on_done=partial(store_precompressed, cache, path, encodings),
         )
-        for reencode in base.reencodes.values():
-            logger.info("Reencoding (%s)" % base.filepath)
-            filepath = Path("build") / reencode.filepath
-            if not cache.needs_to_be_generated(
-                base.filepath, str(filepath), base.options
-            ):
-                continue
+        for path in stale_outputs(cache, "build", encodings)
+    ]
 
-            width, height = reencode.size
-            width = width if width else -1
-            height = height if height else -1
-            command = (
-                reencodecmd
-                + "-s "
-                + str(width)
-                + "x"
-                + str(height)
-                + " "
-                + shlex.quote(str(filepath))
-            )
-            command = command.format(**base.options)
-
-            proc = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE)
-
-            old_reencoded_secs = 0
-
-            with tqdm(
-                total=base.duration,
-                desc="Reencoding %s" % (str(base.filepath)),
-                leave=False,
-                bar_format="{l_bar}{bar}| {n_fmt}s/{total_fmt}s | ETA: {remaining}",
-            ) as pbar:
-                for content in proc.stdout:
-                    m = re.search(r"out_time_us=(.*)\\n", str(content))
-                    if m and m.group(1):
-                        us = int(m.group(1))
-                        reencoded_secs = us // 1000000
-                        if reencoded_secs - old_reencoded_secs:
-                            pbar.update(reencoded_secs - old_reencoded_secs)
-                        old_reencoded_secs = reencoded_secs
-
-            proc.wait()
-
-            if proc.returncode != 0:
-                logger.error(
-                    "An error occured while rendering reencodes for %s", base.filepath
-                )
-                return
 
-            cache.cache_picture(base.filepath, str(filepath), base.options)
+class Progress:
+    # Progress bar shared by jobs running at the same time in different threads, only shown once
+    # entered and if there is something to do.
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.total = 0
+        self.lock = threading.Lock()
+        self.pbar = None
+
+    def __enter__(self):
+        if self.total:
+            self.pbar = tqdm(total=self.total, **self.kwargs)
+        return self
+
+    def __exit__(self, *exc):
+        if self.pbar is not None:
+            self.pbar.close()
+
+    def update(self, n):
+        with self.lock:
+            if self.pbar is not None:
+                self.pbar.update(n)
+
+
+def run_ffmpeg(command, filepath, duration, progress):
+    # Runs in a thread of the main process, the work is done by ffmpeg
+    logger.info("Reencoding (%s)" % filepath)
+    proc = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE)
+
+    reencoded_secs = 0
 
-    if not base.thumbnails:
+    try:
+        for line in proc.stdout:
+            # -progress writes key=value lines, out_time_us is N/A until the first frame is out
+            key, _, value = line.strip().partition(b"=")
+            if key == b"out_time_us" and value.isdigit():
+                secs = min(int(value) / 1000000, duration)
+                progress.update(secs - reencoded_secs)
+                reencoded_secs = secs
+
+        proc.wait()
+    finally:
+        # Also when the reencode failed, so that the progress still ends at 100%
+        progress.update(duration - reencoded_secs)
+
+    return proc.returncode == 0
+
+
+def run_command(command):
+    # Runs in a thread of the main process, the work is done by the command
+    return subprocess.run(shlex.split(command)).returncode == 0
+
+
+def cache_outputs(cache, base, filepaths, error, failures, success):
+    if not success:
+        logger.error(error, base.filepath)
+        failures.append(base.filepath)
         return
 
+    for filepath in filepaths:
+        cache.cache_picture(base.filepath, str(filepath), base.options)
+
+
+def video_jobs(cache, base, progress, failures, slots):
+    # slots is the number of CPU slots of the scheduler running the jobs, no job gets more
+    logger.debug("(%s) Planning thumbnails and reencodes", base.filepath)
+    basecmd = "{binary} -loglevel {loglevel} -y -i " + shlex.quote(str(base.filepath))
+    jobs = []
+
+    reencodecmd = (
+        basecmd
+        + " -c:v {video} -b:v {vbitrate} {other} -c:a {audio} -b:a {abitrate} "
+        + "-f {format} -threads {threads} -progress /dev/stdout "
+    )
+    for reencode in base.reencodes.values():
+        filepath = Path("build") / reencode.filepath
+        if not cache.needs_to_be_generated(base.filepath, str(filepath), base.options):
+            continue
+
+        width, height = reencode.size
+        width = width if width else -1
+        height = height if height else -1
+        command = (
+            reencodecmd
+            + "-s "
+            + str(width)
+            + "x"
+            + str(height)
+            + " "
+            + shlex.quote(str(filepath))
+        )
+        # ffmpeg uses as many threads as CPU slots the job is given
+        threads = min(base.threads, slots)
+        command = command.format(threads=threads, **base.options)
+
+        progress.total += base.duration
+        jobs.append(
+            Job(
+                run_ffmpeg,
+                (command, base.filepath, base.duration, progress),
+                slots=threads,
+                cost=base.cost(reencodes=1),
+                group="video",
+                on_done=partial(
+                    cache_outputs,
+                    cache,
+                    base,
+                    [filepath],
+                    "An error occured while rendering reencodes for %s",
+                    failures,
+                ),
+            )
+        )
+
     uncached = []
     command = ""
     for thumbnail in base.thumbnails.values():
@@ -665,233 +1328,240 @@ def render_video(cache, base):
             + str(width)
             + ":"
             + str(height)
-            + " "
+            + " -threads 1 "
             + shlex.quote(str(filepath))
         )
-        uncached.append(thumbnail)
+        uncached.append(filepath)
 
-    if not uncached:
-        return
-
-    command = basecmd + command
-    command = command.format(**base.options)
-    if subprocess.run(shlex.split(command)).returncode != 0:
-        logger.error(
-            "An error occured while rendering thumbnails for %s", str(base.filepath)
+    if uncached:
+        command = basecmd + command
+        command = command.format(**base.options)
+        jobs.append(
+            Job(
+                run_command,
+                (command,),
+                cost=base.cost(thumbnails=len(uncached)),
+                on_done=partial(
+                    cache_outputs,
+                    cache,
+                    base,
+                    uncached,
+                    "An error occured while rendering thumbnails for %s",
+                    failures,
+                ),
+            )
         )
-        return
 
-    for thumbnail in uncached:
-        cache.cache_picture(base.filepath, str(filepath), base.options)
+    return jobs
 
 
-def reencode_audio(cache, base):
-    logger.debug("(%s) Rendering reencodes", base.filepath)
+def audio_jobs(cache, base, progress, failures):
+    logger.debug("(%s) Planning reencodes", base.filepath)
     basecmd = "{binary} -loglevel {loglevel} -progress /dev/stdout -i " + shlex.quote(
         str(base.filepath)
     )
-    basecmd = basecmd + " -c:a {audio} -y "
-
-    if not base.reencodes:
-        return
+    basecmd = basecmd + " -c:a {audio} -threads 1 -y "
+    jobs = []
 
     for reencode in base.reencodes.values():
-        logger.info("Reencoding (%s)" % base.filepath)
         filepath = Path("build") / reencode.filepath
         if not cache.needs_to_be_generated(base.filepath, str(filepath), base.options):
             logger.info("Skipped: %s is already generated", reencode.filepath)
-            return
+            continue
 
         command = basecmd + shlex.quote(str(filepath))
         command = command.format(**base.options)
 
-        proc = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE)
-
-        old_reencoded_secs = 0
-
-        with tqdm(
-            total=base.duration,
-            desc="Reencoding %s" % (str(base.filepath)),
-            leave=False,
-            bar_format="{l_bar}{bar}| {n_fmt}s/{total_fmt}s | ETA: {remaining}",
-        ) as pbar:
-            for content in proc.stdout:
-                m = re.search(r"out_time_us=(.*)\\n", str(content))
-                if m and m.group(1):
-                    us = int(m.group(1))
-                    reencoded_secs = us // 1000000
-                    if reencoded_secs - old_reencoded_secs:
-                        pbar.update(reencoded_secs - old_reencoded_secs)
-                    old_reencoded_secs = reencoded_secs
-
-        proc.wait()
-
-        if proc.returncode != 0:
-            logger.error(
-                "An error occured while rendering reencodes for %s", base.filepath
+        progress.total += base.duration
+        jobs.append(
+            Job(
+                run_ffmpeg,
+                (command, base.filepath, base.duration, progress),
+                cost=base.cost(),
+                group="audio",
+                on_done=partial(
+                    cache_outputs,
+                    cache,
+                    base,
+                    [filepath],
+                    "An error occured while rendering reencodes for %s",
+                    failures,
+                ),
             )
-            return
-
-        cache.cache_picture(base.filepath, str(filepath), base.options)
-
-
-def set_func_args(initargs):
-    shared, funcs = initargs
-    for func in funcs:
-        func.shared = shared
-
-
-def handle_pbar(desc, queue, pbar_len):
-    with tqdm(
-        total=pbar_len,
-        desc=desc,
-        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
-    ) as pbar:
-        while queue.get():
-            pbar.update()
-
+        )
 
-logger = logging.getLogger("recitale")
+    return jobs
 
 
-def main():
-    loglevel_parser = ArgumentParser(add_help=False)
-    loglevel_parser.add_argument(
-        "--log-level",
-        default=logging.WARNING,
-        type=loglevel,
-        help="Configure the logging level",
-    )
+def run_probe(media):
+    filepath, probe = media
+    try:
+        return probe(filepath)
+    except (subprocess.CalledProcessError, OSError, ValueError, KeyError) as e:
+        # Probed again when needed, which reports the error
+        logger.debug("(%s) Probing failed: %s", filepath, e)
+        return None
+
+
+def probe_media(cache, media, jobs, executor=ThreadPoolExecutor):
+    # media is a list of (filepath, probe) with probe the function returning the metadata of
+    # filepath, e.g. by running ffprobe or by reading the header of a picture. Files not in the
+    # probe index of the cache yet, or which changed since, are probed in parallel with
+    # executor, threads by default which is enough to wait for subprocesses. Only the main
+    # thread writes to the cache.
+    media = [
+        (filepath, probe)
+        for filepath, probe in media
+        if cache.probe_infos(filepath) is None
+    ]
+    if not media:
+        return
 
-    parser = ArgumentParser(
-        description="Static site generator for your story.", parents=[loglevel_parser]
-    )
-    parser.add_argument(
-        "--version", action="version", version="%(prog)s " + __version__
+    logger.info("Probing %d media files...", len(media))
+    with executor(jobs) as e:
+        for (filepath, _), infos in zip(media, e.map(run_probe, media)):
+            if infos is not None:
+                cache.store_probe_infos(filepath, infos)
+    cache.commit()
+
+
+def gallery_media(galleries_dirs):
+    # Pictures, videos and audio files of the galleries, recognized by their extension. Paths
+    # are relative to the current directory like those of the factories.
+    media = {"image": [], "video": [], "audio": []}
+    extensions = Image.registered_extensions()
+    for gallery in galleries_dirs:
+        for filepath in sorted(gallery.rglob("*")):
+            if filepath.suffix.lower() in extensions:
+                media["image"].append(filepath)
+                continue
+            mimetype = mimetypes.guess_type(filepath.name)[0] or ""
+            if mimetype.startswith("video/"):
+                media["video"].append(filepath)
+            elif mimetype.startswith("audio/"):
+                media["audio"].append(filepath)
+    return media
+
+
+def probe_gallery_media(cache, galleries_dirs, jobs):
+    # Templates need the dimensions of pictures and videos, probe all of them at once
+    # beforehand. Reading headers of pictures keeps CPUs busy, hence processes for them.
+    media = gallery_media(galleries_dirs)
+    probe_media(cache, [(path, read_metadata) for path in media["image"]], jobs, Pool)
+    probe_media(
+        cache,
+        [(path, probe_video) for path in media["video"]]
+        + [(path, probe_audio) for path in media["audio"]],
+        jobs,
     )
+    return media
+
+
+def probe_placeholders(cache, paths, jobs):
+    # Placeholders of pictures are part of the pages using them, so they are computed before
+    # rendering any page, from reduced draft decodes of the pictures. They are kept by digest so
+    # that a picture touched or moved is not decoded again, and with the metadata of the
+    # picture so that warm builds only read its probe infos.
+    # Pictures which could not be probed have no metadata to keep it with
+    probed = {path: cache.probe_infos(path) for path in paths}
+    paths = [
+        path
+        for path, infos in probed.items()
+        if infos is not None and "placeholder" not in infos
+    ]
+    if not paths:
+        return
 
-    subparser = parser.add_subparsers(dest="cmd")
-    parser_build = subparser.add_parser(
-        "build", help="Generate static site", parents=[loglevel_parser]
-    )
-    parser_build.add_argument(
-        "-j",
-        "--jobs",
-        default=None,
-        type=int,
-        help="Specifies number of jobs (thumbnail generations) to run simultaneously. Default: "
-        "number of threads available on the system",
-    )
-    subparser.add_parser(
-        "test", help="Verify all your yaml data", parents=[loglevel_parser]
-    )
-    subparser.add_parser(
-        "preview",
-        help="Start preview webserver on port 9000",
-        parents=[loglevel_parser],
-    )
-    subparser.add_parser(
-        "deploy", help="Deploy your website", parents=[loglevel_parser]
-    )
-    parser_autogen = subparser.add_parser(
-        "autogen", help="Generate gallery automaticaly", parents=[loglevel_parser]
-    )
-    group = parser_autogen.add_mutually_exclusive_group(required=True)
-    group.add_argument(
-        "-d",
-        dest="folder",
-        metavar="folder",
-        help="folder to use for automatic gallery generation",
-    )
-    group.add_argument(
-        "--all",
-        action="store_const",
-        const=None,
-        dest="folder",
-        help="find all folders with settings.yaml for automatic gallery generation",
-    )
-    parser_autogen.add_argument(
-        "--force",
-        action="store_true",
-        help="**DESTRUCTIVE** force regeneration of gallery even if sections are already defined.",
+    cache.update_fingerprints(paths, jobs)
+    digests = {path: cache.fingerprint(path)["digest"] for path in paths}
+    placeholders = {path: cache.placeholder(digest) for path, digest in digests.items()}
+    missing = [
+        (path, read_placeholder) for path, p in placeholders.items() if p is None
+    ]
+    if missing:
+        logger.info("Computing placeholders of %d pictures...", len(missing))
+        with Pool(jobs) as pool:
+            for (path, _), placeholder in zip(missing, pool.imap(run_probe, missing)):
+                if placeholder is not None:
+                    cache.store_placeholder(digests[path], placeholder)
+                placeholders[path] = placeholder
+
+    for path, placeholder in placeholders.items():
+        if placeholder is not None:
+            cache.store_probe_infos(path, dict(probed[path], placeholder=placeholder))
+    cache.commit()
+
+
+def probe_durations(cache, bases, jobs):
+    # The duration of videos and audio files to reencode is needed to schedule them and to show
+    # the progress of reencodes. Most were probed before building the galleries, this catches
+    # the others.
+    probe_media(
+        cache,
+        [
+            (base.filepath, probe_video if isinstance(base, BaseVideo) else probe_audio)
+            for base in bases
+            if not hasattr(base, "dur")
+            and not all(
+                cache.may_be_cached(
+                    base.filepath, str(Path("build") / reencode.filepath)
+                )
+                for reencode in base.reencodes.values()
+            )
+        ],
+        jobs,
     )
-    args = parser.parse_args()
-
-    handler = logging.StreamHandler()
-    handler.setFormatter(CustomFormatter())
-    logger.addHandler(handler)
-    logger.setLevel(args.log_level)
 
-    settings = get_settings()
 
-    front_page_galleries_cover = []
-
-    galleries_dirs = [
-        x for x in Path(".").iterdir() if x.joinpath("settings.yaml").exists()
-    ]
-    includes = [x for x in settings["include"] if Path(".").joinpath(x).exists()]
-
-    if not galleries_dirs:
-        logger.error(
-            "I can't find at least one directory with a settings.yaml in the current "
-            "working directory (NOT the settings.yaml in your current directory, but one "
-            "INSIDE A DIRECTORY in your current directory), you don't have any gallery?"
+def changed_galleries(galleries_dirs, changes):
+    # Returns a function telling whether a gallery, by its path, needs to be rendered again
+    # after changes, the paths changed since the previous build. Returns None if all of them
+    # do: changes is None or some are out of the galleries, e.g. settings of the site or
+    # templates.
+    if changes is None:
+        return None
+    changes = [Path(os.path.relpath(path)) for path in changes]
+    for path in changes:
+        if not any(
+            path == gallery or gallery in path.parents for gallery in galleries_dirs
+        ):
+            return None
+
+    def changed(gallery_path):
+        # Changed files of a gallery or of one of its parents, e.g. the settings.yaml of the
+        # index of subgalleries
+        gallery_path = Path(gallery_path)
+        return any(
+            path == gallery_path
+            or gallery_path in path.parents
+            or (path.parent != Path(".") and path.parent in gallery_path.parents)
+            for path in changes
         )
-        sys.exit(1)
 
-    if args.cmd == "preview":
-        if not Path("build").exists():
-            logger.error("Please build the website before launch preview")
-            sys.exit(1)
+    return changed
 
-        os.chdir("build")
-        handler = http.server.SimpleHTTPRequestHandler
-        httpd = TCPServerV4(("", 9000), handler)
-        print("Start server on http://localhost:9000")
-        try:
-            httpd.serve_forever()
-        except (KeyboardInterrupt, SystemExit):
-            print("\nShutdown server")
-            httpd.shutdown()
-            raise
-
-    if args.cmd == "deploy":
-        if shutil.which("rsync") is None:
-            logger.error(
-                "I can't locate the rsync + please install the 'rsync' package."
-            )
-            sys.exit(1)
-        if not Path("build").exists():
-            logger.error("Please build the website before launch deployment")
-            sys.exit(1)
-
-        r_dest = settings["settings"]["deploy"]["dest"]
-        if settings["settings"]["deploy"]["others"]:
-            r_others = settings["settings"]["deploy"]["others"]
-        else:
-            r_others = ""
-        if settings["settings"]["deploy"]["ssh"]:
-            r_username = settings["settings"]["deploy"]["username"]
-            r_hostname = settings["settings"]["deploy"]["hostname"]
-            r_cmd = "rsync -avz --progress %s build/* %s@%s:%s" % (
-                shlex.quote(r_others),
-                shlex.quote(r_username),
-                shlex.quote(r_hostname),
-                shlex.quote(r_dest),
-            )
-        else:
-            r_cmd = "rsync -avz --progress %s build/* %s" % (
-                shlex.quote(r_others),
-                shlex.quote(r_dest),
+
+def build(
+    cache,
+    settings,
+    galleries_dirs,
+    jobs,
+    full=False,
+    test=False,
+    workers=None,
+    changes=None,
+):
+    # Renders the pages of the site, then the thumbnails and reencodes they requested unless
+    # test is set. watch() gives the workers to keep them from one build to the other, and the
+    # paths changed since the previous build to render only the galleries they are in.
+    if workers is None:
+        with closing(Workers(jobs)) as workers:
+            return build(
+                cache, settings, galleries_dirs, jobs, full, test, workers, changes
             )
-        if subprocess.run(shlex.split(r_cmd)).returncode != 0:
-            logger.error("deployment failed")
-            sys.exit(1)
-        return
 
-    if args.cmd == "autogen":
-        autogen(args.folder, args.force)
-        return
+    galleries_cover = []
+    includes = [x for x in settings["include"] if Path(".").joinpath(x).exists()]
 
     Path("build").mkdir(parents=True, exist_ok=True)
     theme = settings["settings"].get("theme", "exposure")
@@ -899,29 +1569,33 @@ def main():
     templates = get_gallery_templates(theme, date_locale=date_locale)
 
     if Path("custom.js").exists():
-        shutil.copy(Path("custom.js"), Path(".").joinpath("build", "", "static", "js"))
+        shutil.copy2(Path("custom.js"), Path(".").joinpath("build", "", "static", "js"))
         settings["custom_js"] = True
 
     if Path("custom.css").exists():
-        shutil.copy(
+        shutil.copy2(
             Path("custom.css"), Path(".").joinpath("build", "", "static", "css")
         )
         settings["custom_css"] = True
 
+    media = probe_gallery_media(cache, galleries_dirs, jobs)
+    probe_placeholders(cache, media["image"], jobs)
+
     logger.info("Building galleries...")
 
-    for gallery in tqdm(
-        galleries_dirs,
-        desc="Building galleries",
-        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
-    ):
-        front_page_galleries_cover.append(
+    pages = Pages(
+        cache, settings, full, workers, changed_galleries(galleries_dirs, changes)
+    )
+    for gallery in galleries_dirs:
+        galleries_cover.append(
             process_directory(
                 gallery.resolve(strict=True).relative_to(Path(".").resolve()),
                 settings,
-                templates,
+                theme,
+                pages,
             )
         )
+    pages.render_galleries()
 
     for i in includes:
         srcdir = Path(i).parent
@@ -932,101 +1606,272 @@ def main():
         logger.warning("copied", d)
 
     if settings["rss"]:
-        feed_template = templates.get_template("feed.xml")
-
-        xml = feed_template.render(
-            settings=settings,
-            galleries=reversed(
-                sorted(
-                    [x for x in front_page_galleries_cover if x != {}],
-                    key=lambda x: x["date"],
-                )
-            ),
-        ).encode("Utf-8")
-
-        open(Path("build").joinpath("feed.xml"), "wb").write(xml)
+        pages.feed(templates, galleries_cover)
 
-    build_index(settings, front_page_galleries_cover, templates)
+    pages.index(templates, galleries_cover)
 
-    if args.cmd == "test":
-        logger.info("Success: HTML file building without error")
-        sys.exit(0)
-
-    cache = Cache()
-
-    # If recitale is started without any argument, 'build' is assumed but the jobs parameter
-    # is not part of the namespace, so set its default to None (or 'number of available CPU
-    # treads')
-    jobs = args.jobs if args.cmd else None
+    if test:
+        cache.cache_dump()
+        return
 
     try:
-        pbar_queue = Manager().Queue()
+        cache.update_fingerprints(
+            [base.filepath for base in ImageFactory.base_imgs.values()]
+            + [base.filepath for base in VideoFactory.base_vids.values()]
+            + [base.filepath for base in AudioFactory.base_audios.values()],
+            jobs,
+        )
 
-        with Pool(
+        # Options are shared by most pictures, send them only once to each process
+        options = {
+            base.chksum_opt: base.options for base in ImageFactory.base_imgs.values()
+        }
+
+        # Each picture is a separate job: it checks which of its thumbnails are not cached and
+        # generates only those, decoding the picture only once and only if needed. Each reencode
+        # of a video or audio is a separate job too, as well as the thumbnails of a video.
+        # Jobs are handed out one by one to keep all CPUs busy until the end, the most
+        # expensive first so that they do not end up being the longest ones at the end with all
+        # other CPUs idle, e.g. a huge panorama or a long video in the last gallery.
+        # Pictures are rendered in the pool of processes while ffmpeg jobs are only waited for
+        # in threads, each job using as many of the -j/--jobs CPU slots as it keeps busy.
+        # Videos are reencoded by ffmpeg with several threads, the number of videos and audio
+        # files reencoded at the same time can be further limited, e.g. to limit memory usage.
+        scheduler = Scheduler(
             jobs,
-            initializer=set_func_args,
-            initargs=(
-                (
-                    {"queue": pbar_queue, "cache": cache},
-                    [noncached_images, render_thumbnails],
-                ),
-            ),
-        ) as pool:
-            logger.info("Generating list of thumbnails to create...")
-
-            pbar = Process(
-                target=handle_pbar,
-                args=(
-                    "Filtering cached thumbnails",
-                    pbar_queue,
-                    len(ImageFactory.base_imgs),
-                ),
+            {
+                "video": VideoFactory.global_options.get("concurrency"),
+                "audio": AudioFactory.global_options.get("concurrency"),
+            },
+        )
+        media_jobs = [
+            image_job(cache, base) for base in ImageFactory.base_imgs.values()
+        ]
+        # Reencodes of videos and audio files share a progress bar weighted by their duration
+        progress = Progress(
+            desc="Reencoding",
+            bar_format="{l_bar}{bar}| {n:.0f}s/{total:.0f}s | ETA: {remaining}",
+        )
+        failures = []
+        probe_durations(
+            cache,
+            list(VideoFactory.base_vids.values())
+            + list(AudioFactory.base_audios.values()),
+            jobs,
+        )
+        for base in VideoFactory.base_vids.values():
+            media_jobs.extend(
+                video_jobs(cache, base, progress, failures, scheduler.slots)
             )
-            pbar.start()
-            # Pool splits the iterable into pre-defined chunks which are then assigned to processes.
-            # There is no other scheduling in play after that. This is an issue when chunks are
-            # outrageously unbalanced in terms of CPU time which happens when most galleries are
-            # already built and thus hit the cache but not some, in which case, only a few processes
-            # will run and not the full CPU power will be used, wasting time.
-            # In order to optimize this, a first very quick run through the list of images is done
-            # to list only those which actually need to be generated.
-            # In the following implementation, the first pool.map function will be slightly
-            # unbalanced because some images will hit the cache directly while some won't at all,
-            # iterating over all the thumbnails it needs to create. But it is **much** less
-            # unbalanced than sending to render_thumbnails all images even those which would hit the
-            # cache. After the first pool.map, the second will only contain images with at least one
-            # thumbnail to create.
-            base_imgs = pool.map(noncached_images, ImageFactory.base_imgs.values())
-            pbar_queue.put(None)
-            pbar.join()
-            base_imgs = [img for img in base_imgs if img]
-
-            if base_imgs:
-                logger.info("Generating thumbnails...")
-                pbar = Process(
-                    target=handle_pbar,
-                    args=("Generating thumbnails", pbar_queue, len(base_imgs)),
-                )
-                pbar.start()
-                base_imgs = pool.map(render_thumbnails, base_imgs)
-                pbar_queue.put(None)
-                pbar.join()
-
-        if len(VideoFactory.base_vids):
-            for video in tqdm(
-                VideoFactory.base_vids.values(),
-                desc="Generating video thumbnails and resizes",
-            ):
-                render_video(cache, video)
+        for base in AudioFactory.base_audios.values():
+            media_jobs.extend(audio_jobs(cache, base, progress, failures))
+
+        # Compressed siblings of pages, feed and static files, for web servers to send them
+        # as is instead of compressing them on every request
+        encodings = get_encodings(settings["settings"].get("precompress"))
+        if encodings:
+            media_jobs.extend(precompress_jobs(cache, encodings))
 
-        if len(AudioFactory.base_audios):
-            for audio in tqdm(
-                AudioFactory.base_audios.values(), desc="Generating audio reencodes"
+        pool = workers.share(
+            set_func_args, ({"cache": cache, "options": options}, [render_thumbnails])
+        )
+        with progress:
+            logger.info("Generating thumbnails and reencodes...")
+
+            for job in tqdm(
+                scheduler.run(media_jobs, pool),
+                total=len(media_jobs),
+                desc="Generating thumbnails and reencodes",
+                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
             ):
-                reencode_audio(cache, audio)
+                pass
+
+        if failures:
+            logger.error(
+                "Failed to render %d videos or audio files: %s",
+                len(set(failures)),
+                ", ".join(sorted(set(str(failure) for failure in failures))),
+            )
     finally:
         cache.cache_dump()
 
 
+def rebuild(cache, jobs, defaults, workers, changes=None):
+    # Settings of the site and media requested by pages are global, start over from defaults.
+    # changes are the paths changed since the previous build, None for the first one.
+    SETTINGS.update(copy.deepcopy(defaults))
+    ImageFactory.global_options = SETTINGS["gm"]
+    VideoFactory.global_options = SETTINGS["ffmpeg"]
+    AudioFactory.global_options = SETTINGS["ffmpeg_audio"]
+    ImageFactory.base_imgs = dict()
+    VideoFactory.base_vids = dict()
+    AudioFactory.base_audios = dict()
+    template_digests.clear()
+    staged_static.clear()
+    invalidate_theme_templates(changes)
+    if workers.pool is not None:
+        # The processes keep their environments too
+        workers.share(invalidate_theme_templates, changes)
+
+    # Only settings files modified since the previous build are parsed again
+    preload_settings(jobs)
+    settings = get_settings()
+    set_media_settings(settings)
+    galleries_dirs = find_galleries()
+    if not galleries_dirs:
+        logger.error("I can't find at least one directory with a settings.yaml")
+        sys.exit(1)
+    build(cache, settings, galleries_dirs, jobs, workers=workers, changes=changes)
+
+
+def watch(cache, jobs, bind, port):
+    # Builds the site, serves it on bind:port and builds it again whenever one of its files or of
+    # the themes changes. The process and its pool of processes stay up so that the cache and
+    # templates are kept from one build to the other, and since only galleries in which files
+    # changed and pages whose inputs changed are rendered again, e.g. only the gallery whose
+    # settings.yaml was modified, a build takes a fraction of a second.
+    # Pages open in a browser are reloaded after each build.
+    defaults = copy.deepcopy(SETTINGS)
+    livereload = LiveReload()
+    watcher = get_watcher(
+        [Path("."), Path(__file__).parent.joinpath("themes")], ["build", "__pycache__"]
+    )
+    workers = Workers(jobs)
+    server = None
+    changes = None
+    try:
+        while True:
+            start = time.monotonic()
+            try:
+                rebuild(cache, jobs, defaults, workers, changes)
+            except (Exception, SystemExit) as e:
+                # Errors are logged before exiting, others are not
+                if not isinstance(e, SystemExit):
+                    logger.exception(e)
+                logger.error("Build failed, waiting for changes to build again")
+            else:
+                logger.info("Built in %.2fs", time.monotonic() - start)
+                livereload.reload()
+                changes = set()
+
+            if server is None:
+                server = make_server("build", bind, port, livereload)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                print("Start server on http://%s:%d" % (bind or "localhost", port))
+
+            more = watcher.wait()
+            logger.info(
+                "Building again, changed: %s",
+                ", ".join(sorted(str(path) for path in more)),
+            )
+            # Galleries changed before a failed build are still to be rendered again
+            if changes is not None:
+                changes |= more
+    except KeyboardInterrupt:
+        print("\nShutdown server")
+    finally:
+        watcher.close()
+        workers.close()
+        if server is not None:
+            server.shutdown()
+        cache.cache_dump()
+
+
+def set_func_args(initargs):
+    shared, funcs = initargs
+    for func in funcs:
+        func.shared = shared
+
+
+# Barrier of the pool of the process, set by Workers when the process is started
+workers_barrier = None
+
+
+def set_workers_barrier(barrier):
+    global workers_barrier
+    workers_barrier = barrier
+
+
+def run_in_worker(task):
+    func, args = task
+    func(*args)
+    # Keeps this process from running the task of another one
+    workers_barrier.wait()
+
+
+class Workers:
+    # Pool of processes rendering galleries, thumbnails and precompressed files, started on
+    # first use. watch() keeps it from one build to the other, so what the processes need for
+    # a build is not given to them when starting but sent again with share() before each use.
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+
+    def share(self, func, *args):
+        # Runs func(*args) once in each process of the pool and returns the pool
+        if self.pool is None:
+            barrier = multiprocessing.Barrier(self.processes)
+            self.pool = Pool(
+                self.processes, initializer=set_workers_barrier, initargs=(barrier,)
+            )
+        self.pool.map(run_in_worker, [(func, args)] * self.processes, chunksize=1)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+logger = logging.getLogger("recitale")
+
+
+def run(args, galleries_dirs):
+    # Commands reading the media of the site: build, test, watch and autogen. The other ones
+    # are handled by main() without importing this module.
+
+    # If recitale is started without any argument, 'build' is assumed but the jobs parameter
+    # is not part of the namespace, so set its default to None (or 'number of available CPU
+    # treads'). Neither is it for 'test' nor 'autogen'.
+    jobs = getattr(args, "jobs", None)
+
+    # The cache is opened first since it migrates a former .recitale_cache file to the
+    # directory in which parsed settings are kept.
+    cache = Cache()
+    # Metadata of pictures, videos and audio files is read through the probe index of the cache
+    ImageFactory.cache = VideoFactory.cache = AudioFactory.cache = cache
+
+    preload_settings(jobs)
+    settings = get_settings()
+    set_media_settings(settings)
+
+    if args.cmd == "autogen":
+        # Pictures are sorted by capture date, read all of them at once beforehand
+        probe_gallery_media(
+            cache, [Path(args.folder)] if args.folder else galleries_dirs, jobs
+        )
+        autogen(args.folder, args.force)
+        cache.cache_dump()
+        return
+
+    if args.cmd == "watch":
+        watch(cache, jobs, args.bind, args.port)
+        return
+
+    build(
+        cache,
+        settings,
+        galleries_dirs,
+        jobs,
+        getattr(args, "full", False),
+        args.cmd == "test",
+    )
+
+    if args.cmd == "test":
+        logger.info("Success: HTML file building without error")
+        sys.exit(0)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger("recitale." + __name__)
+
+
+class Job:
+    def __init__(
+        self, func, args, slots=1, cost=0, in_pool=False, on_done=None, group=None
+    ):
+        # func(*args) is run in the pool of processes if in_pool is True, otherwise in a thread
+        # of the main process which is enough for jobs spending their time waiting for a
+        # subprocess. It keeps `slots` CPUs busy and is estimated to take `cost` milliseconds.
+        # on_done() is called with the value returned by func, always from the main thread.
+        # The number of jobs of the same group running at the same time can be limited.
+        self.func = func
+        self.args = args
+        self.slots = slots
+        self.cost = cost
+        self.in_pool = in_pool
+        self.on_done = on_done
+        self.group = group
+
+
+class Scheduler:
+    def __init__(self, slots=None, limits=None):
+        self.slots = slots if slots else os.cpu_count() or 1
+        # Maximum number of jobs running at the same time per group
+        self.limits = {group: limit for group, limit in (limits or {}).items() if limit}
+
+    def _next(self, pending, groups, start=None):
+        # Returns the index in pending of the most expensive job before `start` whose group is
+        # not at its limit, None if there is none.
+        if start is None:
+            start = len(pending)
+        for index in range(start - 1, -1, -1):
+            group = pending[index].group
+            if group not in self.limits or groups[group] < self.limits[group]:
+                return index
+        return None
+
+    def _slots(self, job):
+        # A job asking for more slots than available would never start otherwise
+        return min(job.slots, self.slots)
+
+    def _run_in_thread(self, job, done):
+        try:
+            done.put((job, job.func(*job.args), None))
+        except BaseException as e:
+            done.put((job, None, e))
+
+    def _start(self, job, pool, done):
+        if job.in_pool:
+            pool.apply_async(
+                job.func,
+                job.args,
+                callback=lambda result: done.put((job, result, None)),
+                error_callback=lambda e: done.put((job, None, e)),
+            )
+        else:
+            threading.Thread(
+                target=self._run_in_thread, args=(job, done), daemon=True
+            ).start()
+
+    def _backfill(self, pending, head, running, free, now, groups):
+        # Returns the index in pending of the most expensive job which can start in the free
+        # slots without delaying the next job to start, at index head in pending, which needs
+        # more slots than free.
+        # Running jobs are assumed to end after their estimated cost, the next job can start
+        # once enough of them ended. Until then, jobs estimated to end before that can start, as
+        # well as jobs using the slots the next job does not need.
+        needed = self._slots(pending[head])
+        available = free
+        for end, slots in sorted(
+            (max(end, now), slots) for end, slots in running.values()
+        ):
+            available += slots
+            if available >= needed:
+                break
+        extra = available - needed
+
+        index = self._next(pending, groups, head)
+        while index is not None:
+            job = pending[index]
+            if self._slots(job) <= free and (
+                now + job.cost <= end or self._slots(job) <= extra
+            ):
+                return index
+            index = self._next(pending, groups, index)
+        return None
+
+    def run(self, jobs, pool):
+        # Runs jobs, the most expensive first, so that at most self.slots CPUs are busy at any
+        # time. Jobs are only started out of order when they do not delay the next job, e.g. when
+        # pictures can be rendered while waiting for enough free slots to reencode a video.
+        # Yields each job once done.
+        # Sorted by increasing cost so that the next job to start is popped from the end
+        pending = sorted(jobs, key=lambda job: job.cost)
+        done = queue.SimpleQueue()
+        free = self.slots
+        running = {}
+        groups = collections.Counter()
+
+        while pending or running:
+            now = time.monotonic() * 1000
+            while pending:
+                index = head = self._next(pending, groups)
+                if head is None:
+                    break
+                if self._slots(pending[head]) > free:
+                    index = self._backfill(pending, head, running, free, now, groups)
+                    if index is None:
+                        break
+                job = pending.pop(index)
+                free -= self._slots(job)
+                groups[job.group] += 1
+                running[job] = now + job.cost, self._slots(job)
+                self._start(job, pool, done)
+
+            job, result, error = done.get()
+            free += self._slots(job)
+            groups[job.group] -= 1
+            del running[job]
+            if error is not None:
+                raise error
+            if job.on_done is not None:
+                job.on_done(result)
+            yield job
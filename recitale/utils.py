@@ -1,20 +1,35 @@
+import json
 import logging
+import os
+import shutil
+import stat
 import sys
 import base64
-from Cryptodome.Cipher import AES
-from Cryptodome.Hash import MD5
-from Cryptodome.Random import get_random_bytes
-from Cryptodome.Util.Padding import pad
 from email.utils import formatdate
-from datetime import datetime
+from datetime import date, datetime
 from builtins import str
 
 from pathlib import Path
-import ruamel.yaml as yaml
 
 
 logger = logging.getLogger("recitale." + __name__)
 
+# Parsed settings files of the site, kept from one build to the other in this file
+SETTINGS_CACHE = Path(".recitale_cache", "settings.json")
+# Version of the content of SETTINGS_CACHE, those of other versions are ignored
+SETTINGS_CACHE_VERSION = 2
+# Settings files are only parsed in a pool of processes when those to parse are at least that big
+# in total, starting the pool takes longer than parsing smaller ones.
+PARALLEL_SETTINGS_SIZE = 64 * 1024
+# Keys of the JSON objects standing for dates and datetimes in settings stored as JSON
+JSON_DATE = "$date"
+JSON_DATETIME = "$datetime"
+
+# Settings files parsed by load_settings() or preload_settings(), by resolved path, with the
+# mtime_ns and size of the file when parsed. Settings are kept as JSON and decoded on each load,
+# so that callers get their own copy to modify.
+parsed_settings = {}
+
 
 def remove_superficial_options(options):
     cleaned_options = options.copy()
@@ -36,6 +51,22 @@ def remove_superficial_options(options):
     # non-copy thumbnails).
     if "resize" in cleaned_options:
         del cleaned_options["resize"]
+    # "draft" and "reduction-ratio" only speed up the creation of thumbnails, which are visually
+    # identical whatever their value.
+    if "draft" in cleaned_options:
+        del cleaned_options["draft"]
+    if "reduction-ratio" in cleaned_options:
+        del cleaned_options["reduction-ratio"]
+    # "formats" only sets which other formats thumbnails are rendered in too, each of them is a
+    # file of its own, cached with its own options.
+    if "formats" in cleaned_options:
+        del cleaned_options["formats"]
+    # "threads" and "concurrency" only set how many threads ffmpeg uses to reencode a video and
+    # how many videos are reencoded at the same time, not the videos themselves.
+    if "threads" in cleaned_options:
+        del cleaned_options["threads"]
+    if "concurrency" in cleaned_options:
+        del cleaned_options["concurrency"]
     return cleaned_options
 
 
@@ -107,6 +138,12 @@ def cryptojs_openssl_compatible_encrypt(plaintext, passphrase):
     # by using the salt and the OpenSSL specific derivation called
     # EVP_BytesToKey. The key is 32-byte long for AES-256 and the IV is 16-byte
     # long for CBC.
+    # Only imported by builds of galleries with a password, like ruamel.yaml for commands
+    # loading settings, so that other commands start faster.
+    from Cryptodome.Cipher import AES
+    from Cryptodome.Hash import MD5
+    from Cryptodome.Random import get_random_bytes
+    from Cryptodome.Util.Padding import pad
 
     salt = get_random_bytes(8)
     keyiv = evp_bytestokey(MD5, salt, bytes(passphrase, "utf-8"), 1, 32 + 16)
@@ -134,17 +171,292 @@ def encrypt(password, template, gallery_path, settings, gallery_settings):
     return html
 
 
+def copy_file(source, destination):
+    # Copies source to destination with copy_file_range() which lets the kernel copy the content
+    # without going through user space, and filesystems supporting it (e.g. btrfs, XFS, NFS)
+    # share the blocks of both files instead of copying them. The modification time of source is
+    # kept so that unchanged files can be told apart by sync_tree() and rsync.
+    # destination is removed first so that a file hardlinked to it is never written through.
+    try:
+        os.unlink(destination)
+    except FileNotFoundError:
+        pass
+
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+        except (AttributeError, OSError):
+            # Not available before Python 3.8 and Linux 4.5, nor across filesystems before
+            # Linux 5.3
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(source, destination)
+
+
+def sync_tree(source, destination, suffixes=(), keep=()):
+    # Makes destination a copy of source like shutil.copytree() but only copies the files whose
+    # size or modification time differ and only removes the files which are not in source
+    # anymore, so that unchanged files are neither rewritten nor uploaded again on deploy.
+    # Files of destination named after a file of source with one of suffixes appended are kept,
+    # e.g. its precompressed siblings, as well as those of keep, paths relative to destination of
+    # files written there by other means.
+    source = Path(source)
+    destination = Path(destination)
+    expected = set()
+    for path in keep:
+        expected.add(Path(path))
+        expected.update(Path(path).parents)
+
+    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+        relative = Path(dirpath).relative_to(source)
+        expected.add(relative)
+        target = destination.joinpath(relative)
+        if target.is_symlink() or (target.exists() and not target.is_dir()):
+            target.unlink()
+        target.mkdir(parents=True, exist_ok=True)
+
+        for name in filenames:
+            expected.add(relative.joinpath(name))
+            src = Path(dirpath, name)
+            dst = target.joinpath(name)
+            src_stat = src.stat()
+            try:
+                dst_stat = dst.lstat()
+            except FileNotFoundError:
+                dst_stat = None
+
+            if dst_stat is not None and stat.S_ISDIR(dst_stat.st_mode):
+                shutil.rmtree(dst)
+                dst_stat = None
+
+            if (
+                dst_stat is None
+                or not stat.S_ISREG(dst_stat.st_mode)
+                or dst_stat.st_size != src_stat.st_size
+                or dst_stat.st_mtime_ns != src_stat.st_mtime_ns
+            ):
+                logger.debug("Copying %s to %s", src, dst)
+                copy_file(src, dst)
+
+    # Bottom-up so that stale directories are empty by the time they are removed
+    for dirpath, dirnames, filenames in os.walk(destination, topdown=False):
+        relative = Path(dirpath).relative_to(destination)
+        for name in filenames:
+            if relative.joinpath(name) in expected or any(
+                name.endswith(suffix)
+                and relative.joinpath(name[: -len(suffix)]) in expected
+                for suffix in suffixes
+            ):
+                continue
+            logger.debug("Removing %s", Path(dirpath, name))
+            os.unlink(Path(dirpath, name))
+        for name in dirnames:
+            if relative.joinpath(name) not in expected:
+                logger.debug("Removing %s", Path(dirpath, name))
+                if Path(dirpath, name).is_symlink():
+                    os.unlink(Path(dirpath, name))
+                else:
+                    os.rmdir(Path(dirpath, name))
+
+
 def rfc822(date):
     epoch = datetime.utcfromtimestamp(0).date()
     return formatdate((date - epoch).total_seconds())
 
 
+def find_galleries():
+    return [x for x in Path(".").iterdir() if x.joinpath("settings.yaml").exists()]
+
+
+def parse_yaml(text):
+    # The loader of ruamel.yaml written in C, when installed, parses big settings files several
+    # times faster. Errors are raised by the pure Python one, which quotes the faulty line.
+    import ruamel.yaml as yaml
+
+    try:
+        from ruamel.yaml.cyaml import CSafeLoader
+    except ImportError:
+        return yaml.safe_load(text)
+
+    loader = CSafeLoader(text)
+    try:
+        return loader.get_single_data()
+    except yaml.YAMLError:
+        return yaml.safe_load(text)
+    finally:
+        loader.dispose()
+
+
+def settings_key(path):
+    # Settings files are parsed again when their mtime_ns or size changed
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def encode_settings(value):
+    # Returns value, parsed from YAML, with its dates replaced by JSON objects. Raises TypeError
+    # if it does not survive a trip through JSON, e.g. with keys which are not strings.
+    if isinstance(value, dict):
+        if not all(isinstance(key, str) for key in value) or (
+            len(value) == 1 and (JSON_DATE in value or JSON_DATETIME in value)
+        ):
+            raise TypeError("Settings with such keys cannot be stored as JSON")
+        return {key: encode_settings(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [encode_settings(item) for item in value]
+    if isinstance(value, datetime):
+        return {JSON_DATETIME: value.isoformat()}
+    if isinstance(value, date):
+        return {JSON_DATE: value.isoformat()}
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise TypeError("%s cannot be stored as JSON" % type(value).__name__)
+
+
+def decode_settings(obj):
+    # object_hook of json.loads() for the output of encode_settings()
+    if len(obj) == 1 and JSON_DATE in obj:
+        return date.fromisoformat(obj[JSON_DATE])
+    if len(obj) == 1 and JSON_DATETIME in obj:
+        return datetime.fromisoformat(obj[JSON_DATETIME])
+    return obj
+
+
+def settings_json(settings):
+    # Settings as stored in parsed_settings, None if they cannot be, in which case they are parsed
+    # again on each load.
+    try:
+        return json.dumps(encode_settings(settings))
+    except (TypeError, ValueError) as e:
+        logger.debug("Settings not cached: %s", e)
+        return None
+
+
+def parse_settings(path):
+    # Runs in processes of a pool. Files which cannot be parsed are left out, they are parsed
+    # again by load_settings() which reports the error.
+    import ruamel.yaml as yaml
+
+    key = settings_key(path)
+    try:
+        with open(path, "r") as settings:
+            text = settings_json(parse_yaml(settings.read()))
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        logger.debug("(%s) Cannot parse settings: %s", path, e)
+        return None
+    return (key, text) if text is not None else None
+
+
+def find_settings():
+    # Settings files of the site and its galleries in one walk of the tree. Galleries are the
+    # directories with a settings.yaml file at the root of the site or in a gallery, as searched
+    # by find_galleries() and process_directory().
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(".", followlinks=True):
+        if dirpath == ".":
+            dirnames[:] = [
+                name
+                for name in dirnames
+                if name != "build" and not name.startswith(".")
+            ]
+        elif "settings.yaml" not in filenames:
+            dirnames[:] = []
+            continue
+        if "settings.yaml" in filenames:
+            paths.append(str(Path(dirpath, "settings.yaml").resolve()))
+    return paths
+
+
+def preload_settings(jobs=None):
+    # Parses the settings files of the site up front, in parallel, so that load_settings() finds
+    # them in parsed_settings. Those which did not change since the previous build are read from
+    # SETTINGS_CACHE instead.
+    if not parsed_settings:
+        try:
+            with open(SETTINGS_CACHE, "r") as f:
+                cached = json.load(f)
+            if cached.get("version") == SETTINGS_CACHE_VERSION:
+                parsed_settings.update(
+                    (path, ((entry["mtime_ns"], entry["size"]), entry["settings"]))
+                    for path, entry in cached["settings"].items()
+                )
+        except (OSError, ValueError) as e:
+            logger.debug("Cannot read %s: %s", SETTINGS_CACHE, e)
+
+    paths = find_settings()
+    keys = {path: settings_key(path) for path in paths}
+    stale = [
+        path
+        for path in paths
+        if keys[path] is not None
+        and (path not in parsed_settings or parsed_settings[path][0] != keys[path])
+    ]
+    if not stale:
+        return
+
+    # The biggest files first, so that no process is left parsing one at the end
+    stale.sort(key=lambda path: keys[path][1], reverse=True)
+    if (
+        len(stale) > 1
+        and sum(keys[path][1] for path in stale) >= PARALLEL_SETTINGS_SIZE
+    ):
+        from multiprocessing import Pool
+
+        with Pool(jobs) as pool:
+            results = pool.map(parse_settings, stale, chunksize=1)
+    else:
+        results = [parse_settings(path) for path in stale]
+
+    for path, result in zip(stale, results):
+        if result is not None:
+            parsed_settings[path] = result
+
+    # Until Cache() migrates it, .recitale_cache may still be the file of the former JSON cache
+    if SETTINGS_CACHE.parent.exists() and not SETTINGS_CACHE.parent.is_dir():
+        return
+    SETTINGS_CACHE.parent.mkdir(exist_ok=True)
+    tmp = SETTINGS_CACHE.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(
+            {
+                "version": SETTINGS_CACHE_VERSION,
+                "settings": {
+                    path: {
+                        "mtime_ns": parsed_settings[path][0][0],
+                        "size": parsed_settings[path][0][1],
+                        "settings": parsed_settings[path][1],
+                    }
+                    for path in paths
+                    if path in parsed_settings
+                },
+            },
+            f,
+        )
+    os.replace(tmp, SETTINGS_CACHE)
+
+
 def load_settings(folder):
+    import ruamel.yaml as yaml
+
+    path = str(Path(".").joinpath(folder, "settings.yaml").resolve())
+    key = settings_key(path)
     try:
-        with open(
-            Path(".").joinpath(folder, "settings.yaml").resolve(), "r"
-        ) as settings:
-            gallery_settings = yaml.safe_load(settings.read())
+        if key is not None and parsed_settings.get(path, (None,))[0] == key:
+            gallery_settings = json.loads(
+                parsed_settings[path][1], object_hook=decode_settings
+            )
+        else:
+            with open(path, "r") as settings:
+                gallery_settings = parse_yaml(settings.read())
+            text = settings_json(gallery_settings) if key is not None else None
+            if text is not None:
+                parsed_settings[path] = key, text
     except (yaml.error.MarkedYAMLError, yaml.YAMLError) as exc:
         msg = "There is something wrong in %s/settings.yaml" % folder
         if isinstance(exc, yaml.error.MarkedYAMLError):
@@ -13,24 +13,60 @@ from .utils import remove_superficial_options
 
 logger = logging.getLogger("recitale." + __name__)
 
+# Rough time in milliseconds to reencode a second of video and to extract a thumbnail, only
+# meaningful relatively to the estimated costs of other media.
+REENCODE_COST = 1000
+THUMBNAIL_COST = 200
+
+
+def probe(filepath):
+    # Returns the dimensions of the first video stream, the duration, the codecs of all streams
+    # and the overall bitrate (None if unknown) of filepath.
+    if VideoFactory.global_options["binary"] == "ffmpeg":
+        binary = "ffprobe"
+    else:
+        binary = "avprobe"
+    command = (
+        binary
+        + " -v error -show_entries stream=codec_type,codec_name,width,height "
+        + " -show_entries format=duration,bit_rate "
+        + " -print_format json=compact=1 "
+        + shlex.quote(str(filepath))
+    )
+    out = subprocess.check_output(shlex.split(command))
+    infos = json_loads(out)
+    stream = next(
+        (
+            stream
+            for stream in infos["streams"]
+            if stream.get("codec_type", "video") == "video"
+        ),
+        None,
+    )
+    if stream is None:
+        # e.g. audio only WebM files, whose MIME type is still video/webm
+        raise ValueError("No video stream in %s" % filepath)
+    bitrate = infos["format"].get("bit_rate")
+    return {
+        "width": stream["width"],
+        "height": stream["height"],
+        "duration": float(infos["format"]["duration"]),
+        "codecs": [s["codec_name"] for s in infos["streams"] if "codec_name" in s],
+        "bitrate": int(bitrate) if bitrate else None,
+    }
+
 
 class VideoCommon:
     def __get_infos(self):
-        if VideoFactory.global_options["binary"] == "ffmpeg":
-            binary = "ffprobe"
-        else:
-            binary = "avprobe"
-        command = (
-            binary
-            + " -v error -select_streams v:0 -show_entries stream=width,height "
-            + " -show_entries format=duration "
-            + " -print_format json=compact=1 "
-            + shlex.quote(str(self.filepath))
-        )
-        out = subprocess.check_output(shlex.split(command))
-        infos = json_loads(out)
-        self.size = infos["streams"][0]["width"], infos["streams"][0]["height"]
-        self.dur = float(infos["format"]["duration"])
+        # Probing is expensive, results are kept in the cache, if any, until the file changes
+        cache = VideoFactory.cache
+        infos = cache.probe_infos(self.filepath) if cache is not None else None
+        if infos is None:
+            infos = probe(self.filepath)
+            if cache is not None:
+                cache.store_probe_infos(self.filepath, infos)
+        self.size = infos["width"], infos["height"]
+        self.dur = infos["duration"]
 
     @property
     def duration(self):
@@ -82,6 +118,7 @@ class BaseVideo(VideoCommon):
         self.options = global_options.copy()
         self.options.update(options)
         self.filepath = self.options["name"]
+        self.threads = self.options.get("threads", 2)
         self.options = remove_superficial_options(self.options)
         self.chksum_opt = crc32(
             bytes(json_dumps(self.options, sort_keys=True), "utf-8")
@@ -90,6 +127,13 @@ class BaseVideo(VideoCommon):
     def _add_reencode(self, reencode):
         return self.reencodes.setdefault(reencode.filepath, reencode)
 
+    def cost(self, reencodes=0, thumbnails=0):
+        # Estimated time in milliseconds to create the given number of reencodes and thumbnails
+        cost = THUMBNAIL_COST * thumbnails
+        if reencodes:
+            cost += REENCODE_COST * reencodes * self.duration
+        return cost
+
     def reencode(self, size):
         reencode = Reencode(
             self.filepath, self.chksum_opt, size, self.options["extension"]
@@ -108,6 +152,7 @@ class BaseVideo(VideoCommon):
 class VideoFactory:
     base_vids = dict()
     global_options = dict()
+    cache = None
 
     @classmethod
     def get(cls, path, video):
@@ -117,3 +162,15 @@ class VideoFactory:
         vid["name"] = Path(path).joinpath(vid["name"]).resolve().relative_to(Path.cwd())
         bvid = BaseVideo(vid, cls.global_options)
         return cls.base_vids.setdefault(bvid.filepath / str(bvid.chksum_opt), bvid)
+
+    @classmethod
+    def merge(cls, base_vids):
+        # Adds the videos, thumbnails and reencodes requested in another process, e.g. one
+        # rendering galleries
+        for key, base in base_vids.items():
+            known = cls.base_vids.setdefault(key, base)
+            if known is not base:
+                for thumbnail in base.thumbnails.values():
+                    known._add_thumbnail(thumbnail)
+                for reencode in base.reencodes.values():
+                    known._add_reencode(reencode)
@@ -0,0 +1,230 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+
+logger = logging.getLogger("recitale." + __name__)
+
+# From linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT = struct.Struct("iIII")
+
+# Editors and file managers often write a file in several steps, e.g. a temporary file renamed
+# over the original, changes are reported once no other happened for that long (in seconds).
+SETTLE_DELAY = 0.1
+
+
+class Watcher(ABC):
+    # Reports changes to files in the directories of roots and their subdirectories, except
+    # hidden ones and those named in ignored, e.g. the build directory.
+    def __init__(self, roots, ignored=()):
+        self.roots = [Path(root) for root in roots]
+        self.ignored = set(ignored)
+
+    def is_ignored(self, path):
+        for root in self.roots:
+            try:
+                parts = Path(path).relative_to(root).parts
+            except ValueError:
+                continue
+            return any(part in self.ignored or part.startswith(".") for part in parts)
+        return False
+
+    def walk(self, root):
+        # Yields the directories to watch under root, root included
+        for dirpath, dirnames, _ in os.walk(root, followlinks=True):
+            dirnames[:] = [
+                name for name in dirnames if not self.is_ignored(Path(dirpath, name))
+            ]
+            yield Path(dirpath)
+
+    @abstractmethod
+    def changes(self, timeout=None):
+        # Returns the paths changed since the last call, waiting at most timeout seconds for one
+        # (forever if None). Returns an empty set if nothing changed.
+        pass
+
+    def wait(self):
+        # Blocks until something changed and returns the changed paths
+        changes = set()
+        while not changes:
+            changes = self.changes()
+        while True:
+            more = self.changes(SETTLE_DELAY)
+            if not more:
+                return changes
+            changes |= more
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    # Watches directories with inotify(7), called through ctypes since the standard library has
+    # no binding for it. Raises OSError if inotify is not available.
+    def __init__(self, roots, ignored=()):
+        super().__init__(roots, ignored)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        try:
+            for root in self.roots:
+                self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, root):
+        for path in self.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = path
+                continue
+            error = ctypes.get_errno()
+            # The directory may have been removed or replaced by a file in the meantime
+            if error not in (errno.ENOENT, errno.ENOTDIR):
+                raise OSError(error, "Cannot watch %s" % path)
+
+    def changes(self, timeout=None):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+
+        changes = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, report everything as changed
+                changes.update(self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+
+            path = self.watches[wd]
+            if name:
+                path = path.joinpath(os.fsdecode(name))
+            if self.is_ignored(path):
+                continue
+            changes.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._watch_tree(path)
+                except OSError as e:
+                    logger.warning("%s, changes in it will be missed", e)
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(Watcher):
+    # Compares the modification time and size of all files every interval seconds, for systems
+    # without inotify or when there are more directories than inotify is allowed to watch.
+    interval = 0.5
+
+    def __init__(self, roots, ignored=()):
+        super().__init__(roots, ignored)
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root in self.roots:
+            for path in self.walk(root):
+                try:
+                    entries = list(os.scandir(path))
+                except OSError:
+                    continue
+                for entry in entries:
+                    entry_path = Path(entry.path)
+                    if self.is_ignored(entry_path):
+                        continue
+                    try:
+                        # Directories change whenever a file is added or removed in them,
+                        # which is reported for the file already.
+                        if entry.is_dir():
+                            snapshot[entry_path] = None
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    snapshot[entry_path] = stat.st_mtime_ns, stat.st_size
+        return snapshot
+
+    def changes(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return set()
+            time.sleep(delay)
+
+            snapshot = self._scan()
+            changes = snapshot.keys() ^ self.snapshot.keys()
+            changes.update(
+                path
+                for path in snapshot.keys() & self.snapshot.keys()
+                if snapshot[path] != self.snapshot[path]
+            )
+            self.snapshot = snapshot
+            if changes:
+                return changes
+
+
+def get_watcher(roots, ignored=()):
+    try:
+        return InotifyWatcher(roots, ignored)
+    except OSError as e:
+        logger.info("Cannot use inotify (%s), polling for changes instead", e)
+        return PollingWatcher(roots, ignored)
@@ -0,0 +1,128 @@
+import pytest
+
+from jinja2 import DictLoader
+
+from recitale.assets import bundle, bundle_name, bundle_tags, minify_css, stage_static
+from recitale.recitale import TemplatesEnvironment
+
+CSS = '<link rel="stylesheet" href="../static/css/%s"/>'
+JS = '<script src="../static/js/%s"></script>'
+
+
+@pytest.fixture
+def static(tmp_path):
+    static = tmp_path / "static"
+    static.joinpath("css").mkdir(parents=True)
+    static.joinpath("js").mkdir()
+    static.joinpath("css", "fonts.css").write_text(
+        "@font-face {\n  font-family: a;\n}\n"
+    )
+    static.joinpath("css", "style.css").write_text(
+        "/* Style */\nbody {\n  margin: 0;\n}\n"
+    )
+    static.joinpath("css", "lib.min.css").write_text("a{b:c}")
+    static.joinpath("js", "lib.min.js").write_text("var a=1")
+    static.joinpath("js", "app.js").write_text("a()")
+    static.joinpath("js", "copy.min.js").write_text("var a=1")
+    return static
+
+
+@pytest.mark.parametrize(
+    "css,expected",
+    [
+        ("a {\n  color: red;\n}\n", "a{color: red}"),
+        ("a , b > c { margin : 0 }", "a,b>c{margin : 0}"),
+        ("a :hover { }", "a :hover{}"),
+        ("/* comment */ a { margin: 0/**/auto }", "a{margin: 0 auto}"),
+        ("/*! licence */\na {}", "/*! licence */ a{}"),
+        ('a { content: "  /* x */ ; " }', 'a{content: "  /* x */ ; "}'),
+        ("a { content: 'it''s' }", "a{content: 'it''s'}"),
+    ],
+)
+def test_minify_css(css, expected):
+    assert minify_css(css) == expected
+
+
+def test_bundle_tags(static):
+    source = "<head>\n%s\n%s\n</head>\n%s %s" % (
+        CSS % "fonts.css",
+        CSS % "style.css",
+        JS % "lib.min.js",
+        JS % "app.js",
+    )
+    css = bundle_name("css", ["css/fonts.css", "css/style.css"])
+    js = bundle_name("js", ["js/lib.min.js", "js/app.js"])
+    assert bundle_tags(source, static) == (
+        "<head>\n%s\n</head>\n%s" % (CSS % css[4:], JS % js[3:]),
+        {css: ["css/fonts.css", "css/style.css"], js: ["js/lib.min.js", "js/app.js"]},
+    )
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        # Conditional
+        CSS % "fonts.css" + "{% if a %}" + CSS % "style.css" + "{% endif %}",
+        # Other attributes
+        CSS % "fonts.css" + CSS.replace("/>", ' media="print"/>') % "style.css",
+        # Different kinds
+        CSS % "fonts.css" + JS % "app.js",
+        # Not in the static directory
+        CSS % "fonts.css" + CSS % "missing.css",
+        # Added by the site
+        CSS % "fonts.css" + CSS % "custom.css",
+        # Not a stylesheet
+        CSS % "fonts.css" + '<link rel="icon" href="../static/css/style.css">',
+        # Separated by something else
+        CSS % "fonts.css" + "<meta>" + CSS % "style.css",
+        # Elsewhere
+        CSS % "fonts.css" + CSS.replace("../", "https://example.com/") % "style.css",
+    ],
+)
+def test_bundle_tags_not_bundled(static, source):
+    assert bundle_tags(source, static) == (source, {})
+
+
+def test_bundle(static):
+    assert bundle(static, ["css/lib.min.css", "css/style.css"]) == (
+        b"a{b:c}\nbody{margin: 0}\n"
+    )
+    # Duplicates are included once
+    assert bundle(static, ["js/lib.min.js", "js/copy.min.js", "js/app.js"]) == (
+        b"var a=1\n;\na()\n"
+    )
+
+
+def test_stage_static(static, tmp_path):
+    templates = TemplatesEnvironment(
+        "exposure",
+        loader=DictLoader(
+            {
+                "index.html": CSS % "fonts.css" + CSS % "style.css",
+                "page.html": JS % "app.js",
+            }
+        ),
+    )
+    staged = tmp_path / "staged"
+    name = bundle_name("css", ["css/fonts.css", "css/style.css"])
+    staged.joinpath("css").mkdir(parents=True)
+    staged.joinpath("css", "bundle-old.css").write_text("old")
+
+    assert stage_static(templates, static, staged) == staged
+    assert sorted(str(path.relative_to(staged)) for path in staged.rglob("*.*")) == [
+        name,
+        "css/fonts.css",
+        "css/lib.min.css",
+        "css/style.css",
+        "js/app.js",
+        "js/copy.min.js",
+        "js/lib.min.js",
+    ]
+    assert staged.joinpath(name).read_bytes() == (
+        b"@font-face{font-family: a}\nbody{margin: 0}\n"
+    )
+
+    # Unchanged bundles are not written again
+    mtime = staged.joinpath(name).stat().st_mtime_ns
+    stage_static(templates, static, staged)
+    assert staged.joinpath(name).stat().st_mtime_ns == mtime
@@ -1,7 +1,7 @@
 import pytest
 
 from json import dumps as json_dumps
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from zlib import crc32
 
 from recitale.audio import AudioFactory, BaseAudio
@@ -28,6 +28,31 @@ class TestAudioCommon:
             assert baud.duration == 10.4
         assert baud.duration == 10.4
 
+    def test_probe_cached(self):
+        AudioFactory.global_options = {"binary": "ffmpeg", "extension": "mp3"}
+        baud = BaseAudio("test.mp3", AudioFactory.global_options)
+        cache = MagicMock()
+        cache.probe_infos.return_value = {"duration": 3}
+        with patch.object(AudioFactory, "cache", cache), patch(
+            "recitale.audio.subprocess.check_output"
+        ) as mock_probe:
+            assert baud.duration == 3
+        mock_probe.assert_not_called()
+
+    def test_probe_stored(self):
+        AudioFactory.global_options = {"binary": "ffmpeg", "extension": "mp3"}
+        baud = BaseAudio("test.mp3", AudioFactory.global_options)
+        cache = MagicMock()
+        cache.probe_infos.return_value = None
+        output = '{"streams": [{"codec_name": "mp3"}], "format": {"duration": "10.4"}}'
+        with patch.object(AudioFactory, "cache", cache), patch(
+            "recitale.audio.subprocess.check_output", return_value=output
+        ):
+            assert baud.duration == 10.4
+        cache.store_probe_infos.assert_called_once_with(
+            "test.mp3", {"duration": 10.4, "codecs": ["mp3"], "bitrate": None}
+        )
+
 
 class TestBaseAudio:
     def test_baseid(self):
@@ -47,6 +72,11 @@ class TestBaseAudio:
         mock_rm_sup_opt.assert_called_with({"extension": "ogg", "name": "test123test"})
         assert base1.chksum_opt == base2.chksum_opt
 
+    def test_cost(self):
+        base = BaseAudio("test.mp3", {"extension": "ogg"})
+        base.dur = 10.5
+        assert base.cost() == 210
+
     def test_reencode_same_obj(self):
         base = BaseAudio("test.mp3", {"extension": "ogg"})
         base.reencode()
@@ -109,3 +139,15 @@ class TestAudioFactory:
         base_audios = AudioFactory.base_audios
         assert len(base_audios.keys()) == 1
         assert audio1 is list(base_audios.values())[0]
+
+    def test_merge(self):
+        audio = AudioFactory.get("gallery", "test.mp3")
+        base_audios = AudioFactory.base_audios
+        AudioFactory.base_audios = dict()
+        AudioFactory.get("gallery", "test.mp3").reencode()
+        new = AudioFactory.get("gallery", "new.mp3")
+        merged = AudioFactory.base_audios
+        AudioFactory.base_audios = base_audios
+        AudioFactory.merge(merged)
+        assert list(AudioFactory.base_audios.values()) == [audio, new]
+        assert len(audio.reencodes) == 1
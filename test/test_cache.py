@@ -1,66 +1,199 @@
 import json
 import os
 import pytest
+import sqlite3
 
-from unittest.mock import call, mock_open, patch
+from types import SimpleNamespace
+from unittest.mock import call, patch
 
-from recitale.cache import Cache, CACHE_VERSION
+from recitale.cache import Cache, CACHE_VERSION, file_digest
 from recitale.utils import remove_superficial_options
 
 
 @pytest.fixture
-def cache():
-    return Cache()
+def cache(tmp_path):
+    return Cache(tmp_path.joinpath(".recitale_cache"))
+
+
+STAT = SimpleNamespace(st_mtime_ns=1234, st_size=12345678)
+FINGERPRINT = {"mtime_ns": 1234, "size": 12345678, "digest": "abcd"}
+
+
+def entry(digest="abcd", options="{}", size=None):
+    return {"digest": digest, "size": size, "options": options}
+
+
+def test_file_digest(tmp_path):
+    path = tmp_path.joinpath("source.jpg")
+    path.write_bytes(b"content")
+    digest = file_digest(path)
+    assert len(digest) == 64
+    path.write_bytes(b"contenu")
+    assert file_digest(path) != digest
 
 
 class TestCache:
     def test_new_cache(self, cache):
-        assert dict(cache.cache) == {"version": CACHE_VERSION}
+        assert os.path.isdir(cache.cache_dir)
+        assert cache.db.execute("PRAGMA user_version").fetchone()[0] == CACHE_VERSION
+        assert cache.db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert cache.db.execute("SELECT * FROM entries").fetchall() == []
 
-    @patch("recitale.cache.os.path.exists", return_value=True)
-    def test_load_cache(self, mock_ospath):
-        cache_json = {"version": CACHE_VERSION, "some": "value"}
-        with patch("builtins.open", mock_open(read_data=json.dumps(cache_json))):
-            cache = Cache()
+    def test_load_cache(self, cache):
+        cache._update_source("source.jpg", FINGERPRINT)
+        cache._update_entry("target.jpg", entry())
+        cache.cache_dump()
 
-        assert dict(cache.cache) == cache_json
+        cache = Cache(cache.cache_dir)
+        assert cache._entry("target.jpg") == entry()
+        assert cache._source("source.jpg") == FINGERPRINT
+
+    def test_load_old_cache(self, cache):
+        cache._update_entry("target.jpg", entry())
+        cache.db.execute("PRAGMA user_version = %d" % (CACHE_VERSION - 1))
+        cache.cache_dump()
+
+        cache = Cache(cache.cache_dir)
+        assert cache._entry("target.jpg") is None
+        assert cache.db.execute("PRAGMA user_version").fetchone()[0] == CACHE_VERSION
 
-    @patch("recitale.cache.os.path.exists", return_value=True)
     @pytest.mark.parametrize(
-        "cache_dict", [{"version": CACHE_VERSION + 1}, {"some": "value"}]
+        "cache_json",
+        [
+            {"version": 3, "target.jpg": {"size": 123, "options": {"b": 1, "a": 2}}},
+            {
+                "version": 4,
+                "sources": {"source.jpg": FINGERPRINT},
+                "target.jpg": {"digest": "abcd", "options": {"b": 1, "a": 2}},
+            },
+        ],
     )
-    def test_load_old_cache(self, mock_ospath, cache_dict):
-        with patch("builtins.open", mock_open(read_data=json.dumps(cache_dict))):
-            cache = Cache()
+    def test_migrate_json_cache(self, tmp_path, cache_json):
+        cache_path = tmp_path.joinpath(".recitale_cache")
+        cache_path.write_text(json.dumps(cache_json))
 
-        assert dict(cache.cache) == {"version": CACHE_VERSION}
+        cache = Cache(cache_path)
+        assert cache_path.is_dir()
+        expected = cache_json["target.jpg"]
+        assert cache._entry("target.jpg") == entry(
+            expected.get("digest"), '{"a": 2, "b": 1}', expected.get("size")
+        )
+        assert cache._source("source.jpg") == cache_json.get("sources", {}).get(
+            "source.jpg"
+        )
+
+    @pytest.mark.parametrize("cache_json", [{"version": 2, "target.jpg": {}}, {}])
+    def test_migrate_old_json_cache(self, tmp_path, cache_json):
+        cache_path = tmp_path.joinpath(".recitale_cache")
+        cache_path.write_text(json.dumps(cache_json))
+
+        cache = Cache(cache_path)
+        assert cache_path.is_dir()
+        assert cache._entry("target.jpg") is None
 
     def test_dump_cache(self, cache):
-        with patch("builtins.open", mock_open()) as p:
-            cache.cache_dump()
-
-        p.assert_called_with(os.path.join(os.getcwd(), ".recitale_cache"), "w")
-        p.return_value.write.assert_has_calls(
-            [
-                call("{"),
-                call('"version"'),
-                call(": "),
-                call(str(CACHE_VERSION)),
-                call("}"),
-            ]
-        )
+        cache._update_entry("target.jpg", entry())
+        other = sqlite3.connect(cache.db_path)
+        assert other.execute("SELECT * FROM entries").fetchall() == []
+        cache.cache_dump()
+        assert other.execute("SELECT target FROM entries").fetchall() == [
+            ("target.jpg",)
+        ]
+
+    @patch("recitale.cache.COMMIT_EVERY", 2)
+    def test_batched_commits(self, cache):
+        other = sqlite3.connect(cache.db_path)
+        cache._update_entry("target1.jpg", entry())
+        assert other.execute("SELECT * FROM entries").fetchall() == []
+        cache._update_entry("target2.jpg", entry())
+        assert len(other.execute("SELECT * FROM entries").fetchall()) == 2
+
+    def test_interned_options(self, cache):
+        cache._update_entry("target1.jpg", entry(options='{"a": 1}'))
+        cache._update_entry("target2.jpg", entry(options='{"a": 1}'))
+        cache._update_entry("target3.jpg", entry(options='{"a": 2}'))
+        assert cache.db.execute("SELECT COUNT(*) FROM options").fetchone()[0] == 2
 
     @patch(
         "recitale.cache.remove_superficial_options", return_value={"some": "options"}
     )
-    @patch("recitale.cache.os.path.getsize", return_value=12345678)
-    def test_cache_picture(self, mock_ossize, mock_options, cache):
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_cache_picture(self, mock_digest, mock_stat, mock_options, cache):
         cache.cache_picture("some.jpg", "thumbnail/path/some.jpg", {"some": "options"})
-        assert cache.cache["thumbnail/path/some.jpg"] == {
-            "size": 12345678,
-            "options": {"some": "options"},
-        }
+        assert cache._entry("thumbnail/path/some.jpg") == entry(
+            options='{"some": "options"}'
+        )
+        assert cache._source("some.jpg") == FINGERPRINT
         mock_options.assert_called_once_with({"some": "options"})
+        mock_digest.assert_called_once_with("some.jpg")
+
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_pop_updates(self, mock_digest, mock_stat, cache):
+        with patch("recitale.cache.os.getpid", return_value=cache.pid + 1):
+            cache.cache_picture("some.jpg", "target.jpg", {})
+            assert cache._entry("target.jpg") == entry()
+            cache.store_probe_infos("some.jpg", {"width": 10})
+            assert cache.probe_infos("some.jpg") == {"width": 10}
+            assert cache.pop_updates() == (
+                {"target.jpg": entry()},
+                {"some.jpg": FINGERPRINT},
+                {"some.jpg": (1234, 12345678, '{"width": 10}')},
+            )
+            assert cache.pop_updates() == ({}, {}, {})
+        assert cache._entry("target.jpg") is None
+        assert cache.probe_infos("some.jpg") is None
+
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    def test_merge(self, mock_stat, cache):
+        cache._update_entry("target.jpg", entry("old"))
+        cache.merge(
+            (
+                {"target.jpg": entry()},
+                {"some.jpg": FINGERPRINT},
+                {"some.jpg": (1234, 12345678, '{"width": 10}')},
+            )
+        )
+        assert cache._entry("target.jpg") == entry()
+        assert cache._source("some.jpg") == FINGERPRINT
+        assert cache.probe_infos("some.jpg") == {"width": 10}
+        assert cache.pop_updates() == ({}, {}, {})
+
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_fingerprint_unchanged(self, mock_digest, mock_stat, cache):
+        cache._update_source("source.jpg", FINGERPRINT)
+        assert cache.fingerprint("source.jpg") == FINGERPRINT
+        mock_digest.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "fingerprint",
+        [
+            {"mtime_ns": 1, "size": 12345678, "digest": "old"},
+            {"mtime_ns": 1234, "size": 1, "digest": "old"},
+        ],
+    )
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_fingerprint_changed(self, mock_digest, mock_stat, fingerprint, cache):
+        cache._update_source("source.jpg", fingerprint)
+        assert cache.fingerprint("source.jpg") == FINGERPRINT
+        assert cache._source("source.jpg") == FINGERPRINT
+        mock_digest.assert_called_once_with("source.jpg")
+
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_update_fingerprints(self, mock_digest, mock_stat, cache):
+        cache._update_source("cached.jpg", FINGERPRINT)
+        cache.update_fingerprints(["cached.jpg", "new.jpg", "new.jpg", "other.jpg"])
+        assert cache.pending == 0
+        for source in ["cached.jpg", "new.jpg", "other.jpg"]:
+            assert cache._source(source) == FINGERPRINT
+        assert sorted(mock_digest.call_args_list) == [
+            call("new.jpg"),
+            call("other.jpg"),
+        ]
 
     def test_needs_to_be_generated_target_not_found(self, cache):
         ret = cache.needs_to_be_generated("source.jpg", "/notfound/target.jpg", {})
@@ -73,40 +206,84 @@ class TestCache:
         assert ret is True
 
     @patch("recitale.cache.os.path.exists", return_value=True)
-    @patch("recitale.cache.os.path.getsize", return_value=12345678)
-    def test_needs_to_be_generated_diff_size(self, mock_ossize, mock_ospath, cache):
-        with patch.dict(
-            cache.cache,
-            {
-                "/path/target.jpg": {
-                    "size": 87654321,
-                }
-            },
-        ):
-            ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", {})
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_needs_to_be_generated_diff_digest(
+        self, mock_digest, mock_stat, mock_ospath, cache
+    ):
+        cache._update_entry("/path/target.jpg", entry("dcba"))
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", {})
         assert ret is True
         mock_ospath.assert_called_once()
-        mock_ossize.assert_called_once_with("source.jpg")
+        mock_stat.assert_called_once_with("source.jpg")
+
+    @patch("recitale.cache.os.path.exists", return_value=True)
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_needs_to_be_generated_same_size_diff_content(
+        self, mock_digest, mock_stat, mock_ospath, cache
+    ):
+        cache._update_source(
+            "source.jpg", {"mtime_ns": 1, "size": 12345678, "digest": "dcba"}
+        )
+        cache._update_entry("/path/target.jpg", entry("dcba"))
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", {})
+        assert ret is True
+        mock_digest.assert_called_once_with("source.jpg")
+
+    @patch("recitale.cache.os.path.exists", return_value=True)
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_needs_to_be_generated_touched(
+        self, mock_digest, mock_stat, mock_ospath, cache
+    ):
+        cache._update_source(
+            "source.jpg", {"mtime_ns": 1, "size": 12345678, "digest": "abcd"}
+        )
+        cache._update_entry("/path/target.jpg", entry())
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", {})
+        assert ret is False
+        assert cache._source("source.jpg") == FINGERPRINT
+
+    @patch("recitale.cache.os.path.exists", return_value=True)
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_needs_to_be_generated_diff_size_version_3(
+        self, mock_digest, mock_stat, mock_ospath, cache
+    ):
+        cache._update_entry("/path/target.jpg", entry(None, size=87654321))
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", {})
+        assert ret is True
+
+    @patch("recitale.cache.os.path.exists", return_value=True)
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    @patch("recitale.cache.file_digest", return_value="abcd")
+    def test_needs_to_be_generated_same_version_3(
+        self, mock_digest, mock_stat, mock_ospath, cache
+    ):
+        cache._update_entry("/path/target.jpg", entry(None, size=12345678))
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", {})
+        assert ret is False
+        assert cache._entry("/path/target.jpg") == entry()
 
     @patch(
         "recitale.cache.remove_superficial_options",
         side_effect=remove_superficial_options,
     )
     @patch("recitale.cache.os.path.exists", return_value=True)
-    @patch("recitale.cache.os.path.getsize", return_value=12345678)
+    @patch("recitale.cache.os.stat", return_value=STAT)
     def test_needs_to_be_generated_diff_options(
-        self, mock_ossize, mock_ospath, mock_options, cache
+        self, mock_stat, mock_ospath, mock_options, cache
     ):
-        with patch.dict(
-            cache.cache, {"/path/target.jpg": {"size": 12345678, "options": {}}}
-        ):
-            ret = cache.needs_to_be_generated(
-                "source.jpg", "/path/target.jpg", {"some": "option"}
-            )
+        cache._update_source("source.jpg", FINGERPRINT)
+        cache._update_entry("/path/target.jpg", entry())
+        ret = cache.needs_to_be_generated(
+            "source.jpg", "/path/target.jpg", {"some": "option"}
+        )
 
         assert ret is True
         mock_ospath.assert_called_once()
-        mock_ossize.assert_called_once_with("source.jpg")
+        mock_stat.assert_called_once_with("source.jpg")
         mock_options.assert_called_once_with({"some": "option"})
 
     @patch(
@@ -114,19 +291,18 @@ class TestCache:
         side_effect=remove_superficial_options,
     )
     @patch("recitale.cache.os.path.exists", return_value=True)
-    @patch("recitale.cache.os.path.getsize", return_value=12345678)
+    @patch("recitale.cache.os.stat", return_value=STAT)
     def test_needs_to_be_generated_same(
-        self, mock_ossize, mock_ospath, mock_options, cache
+        self, mock_stat, mock_ospath, mock_options, cache
     ):
-        options = {"option": 1}
-        with patch.dict(
-            cache.cache, {"/path/target.jpg": {"size": 12345678, "options": options}}
-        ):
-            ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", options)
+        cache._update_source("source.jpg", FINGERPRINT)
+        options = {"option": 1, "name": "superficial"}
+        cache._update_entry("/path/target.jpg", entry(options='{"option": 1}'))
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", options)
 
         assert ret is False
         mock_ospath.assert_called_once()
-        mock_ossize.assert_called_once_with("source.jpg")
+        mock_stat.assert_called_once_with("source.jpg")
         mock_options.assert_called_once_with(options)
 
     @patch(
@@ -134,20 +310,84 @@ class TestCache:
         side_effect=remove_superficial_options,
     )
     @patch("recitale.cache.os.path.exists", return_value=True)
-    @patch("recitale.cache.os.path.getsize", return_value=12345678)
+    @patch("recitale.cache.os.stat", return_value=STAT)
     def test_needs_to_be_generated_options_tuple(
-        self, mock_ossize, mock_ospath, mock_options, cache
+        self, mock_stat, mock_ospath, mock_options, cache
     ):
+        cache._update_source("source.jpg", FINGERPRINT)
         options = {"option": (0, 1)}
-        with patch.dict(
-            cache.cache,
-            json.loads(
-                json.dumps({"/path/target.jpg": {"size": 12345678, "options": options}})
-            ),
-        ):
-            ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", options)
+        cache._update_entry("/path/target.jpg", entry(options='{"option": [0, 1]}'))
+        ret = cache.needs_to_be_generated("source.jpg", "/path/target.jpg", options)
 
         assert ret is False
         mock_ospath.assert_called_once()
-        mock_ossize.assert_called_once_with("source.jpg")
+        mock_stat.assert_called_once_with("source.jpg")
         mock_options.assert_called_once_with(options)
+
+    def test_may_be_cached_target_not_found(self, cache):
+        assert not cache.may_be_cached("source.jpg", "/notfound/target.jpg")
+
+    @patch("recitale.cache.os.path.exists", return_value=True)
+    def test_may_be_cached_not_in_cache(self, mock_ospath, cache):
+        assert not cache.may_be_cached("source.jpg", "target.jpg")
+
+    @pytest.mark.parametrize(
+        "cached,expected",
+        [
+            (entry(options='{"other": "options"}'), True),
+            (entry("dcba"), False),
+            (entry(None, size=12345678), True),
+            (entry(None, size=87654321), False),
+        ],
+    )
+    @patch("recitale.cache.os.path.exists", return_value=True)
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    def test_may_be_cached(self, mock_stat, mock_ospath, cached, expected, cache):
+        cache._update_source("source.jpg", FINGERPRINT)
+        cache._update_entry("target.jpg", cached)
+        assert cache.may_be_cached("source.jpg", "target.jpg") is expected
+
+    @patch("recitale.cache.os.stat", return_value=STAT)
+    def test_probe_infos(self, mock_stat, cache):
+        assert cache.probe_infos("video.mp4") is None
+        cache.store_probe_infos("video.mp4", {"duration": 10.4, "codecs": ["h264"]})
+        cache.commit()
+        assert cache.probe_infos("video.mp4") == {"duration": 10.4, "codecs": ["h264"]}
+        mock_stat.assert_called_with("video.mp4")
+
+    @pytest.mark.parametrize(
+        "stat",
+        [
+            SimpleNamespace(st_mtime_ns=4321, st_size=12345678),
+            SimpleNamespace(st_mtime_ns=1234, st_size=87654321),
+        ],
+    )
+    def test_probe_infos_changed(self, stat, cache):
+        with patch("recitale.cache.os.stat", return_value=STAT):
+            cache.store_probe_infos("video.mp4", {"duration": 10.4})
+        with patch("recitale.cache.os.stat", return_value=stat):
+            assert cache.probe_infos("video.mp4") is None
+
+    def test_probes_table_added(self, tmp_path):
+        cache_dir = tmp_path.joinpath(".recitale_cache")
+        Cache(cache_dir).db.executescript("DROP TABLE probes;")
+        cache = Cache(cache_dir)
+        with patch("recitale.cache.os.stat", return_value=STAT):
+            assert cache.probe_infos("video.mp4") is None
+
+    def test_page(self, cache):
+        assert cache.page("build/index.html") is None
+        cache.store_page("build/index.html", "abcd", [["theme", "index.html"]], [], b"")
+        assert cache.page("build/index.html") == {
+            "digest": "abcd",
+            "templates": [["theme", "index.html"]],
+            "media": [],
+            "requests": b"",
+        }
+
+    def test_precompressed(self, cache):
+        assert cache.precompressed("build/index.html") is None
+        cache.store_precompressed("build/index.html", FINGERPRINT, ["gzip", "br"])
+        assert cache.precompressed("build/index.html") == dict(
+            FINGERPRINT, encodings=["gzip", "br"]
+        )
@@ -0,0 +1,56 @@
+import pytest
+import subprocess
+import sys
+
+from recitale import __version__
+
+# Modules only needed to render the site, which the command line must not import by itself so
+# that --version, preview and deploy start fast.
+HEAVY_MODULES = ("PIL", "jinja2", "babel", "tqdm", "ruamel", "Cryptodome", "numpy")
+# Cumulative import time in microseconds of the modules of these commands, about 40ms on a
+# laptop, against more than 200ms when everything was imported up front. It leaves room for
+# slower machines.
+IMPORT_BUDGET = 150000
+
+
+def import_times(*modules):
+    # Cumulative import time of each module imported, as reported by python -X importtime
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    "modules",
+    [
+        # --version and deploy
+        ("recitale.cli",),
+        # preview
+        ("recitale.cli", "recitale.preview"),
+    ],
+)
+def test_import_budget(modules):
+    times = import_times(*modules)
+    heavy = sorted(name for name in times if name.split(".")[0] in HEAVY_MODULES)
+    assert heavy == []
+    assert sum(times[module] for module in modules) < IMPORT_BUDGET
+
+
+def test_version():
+    output = subprocess.run(
+        [sys.executable, "-c", "from recitale.cli import main; main()", "--version"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.split() == ["-c", __version__]
@@ -1,35 +1,113 @@
 import pytest
 
+from base64 import b64decode
+from io import BytesIO
 from json import dumps as json_dumps
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+from PIL import Image
 from zlib import crc32
 
-from recitale.image import BaseImage, ImageFactory
+from recitale.image import (
+    BaseImage,
+    ImageFactory,
+    Thumbnail,
+    dominant_color,
+    get_formats,
+    image_metadata,
+    image_placeholder,
+    read_placeholder,
+    pyramid_resize,
+    read_metadata,
+    thumbnail_size,
+)
 from recitale.utils import remove_superficial_options
 
 
+def metadata(width, height, format="JPEG", orientation=1):
+    return {
+        "width": width,
+        "height": height,
+        "format": format,
+        "orientation": orientation,
+        "subsampling": None,
+        "dpi": None,
+        "date": None,
+    }
+
+
+@pytest.mark.parametrize(
+    "size,box,expected",
+    [
+        ((6000, 4000), (None, 450), (675, 450)),
+        ((6000, 4000), (450, None), (450, 300)),
+        ((6000, 4000), (400, 400), (400, 267)),
+        ((4000, 6000), (400, 400), (267, 400)),
+        ((6001, 4000), (None, 450), (675, 450)),
+        ((6000, 4000), (None, 5000), (6000, 4000)),
+        ((6000, 4000), (6000, 4000), (6000, 4000)),
+        ((10000, 10), (None, 1), (1000, 1)),
+        ((10, 10000), (1, None), (1, 1000)),
+    ],
+)
+def test_thumbnail_size(size, box, expected):
+    assert thumbnail_size(size, box) == expected
+
+
+class TestPyramidResize:
+    def test_from_original(self):
+        original = Image.new("RGB", (1000, 500))
+        pyramid = [original]
+        im = pyramid_resize(pyramid, (600, 300), 2)
+        assert im.size == (600, 300)
+        assert pyramid == [original, im]
+
+    def test_from_smallest_intermediate(self):
+        pyramid = [Image.new("RGB", (4000, 2000))]
+        big = pyramid_resize(pyramid, (2000, 1000), 2)
+        medium = pyramid_resize(pyramid, (800, 400), 2)
+        with patch.object(medium, "resize", wraps=medium.resize) as mock_resize:
+            small = pyramid_resize(pyramid, (400, 200), 2)
+        mock_resize.assert_called_once_with((400, 200), Image.LANCZOS)
+        assert pyramid == [pyramid[0], big, medium, small]
+
+    def test_ratio_guard(self):
+        original = Image.new("RGB", (4000, 2000))
+        pyramid = [original]
+        big = pyramid_resize(pyramid, (2000, 1000), 2)
+        with patch.object(original, "resize", wraps=original.resize) as mock_resize:
+            pyramid_resize(pyramid, (1500, 750), 2)
+        mock_resize.assert_called_once_with((1500, 750), Image.LANCZOS)
+        assert len(pyramid) == 3 and pyramid[1] is big
+
+    def test_same_size(self):
+        original = Image.new("RGB", (1000, 500))
+        pyramid = [original]
+        assert pyramid_resize(pyramid, (1000, 500), 2) is original
+        assert pyramid == [original]
+
+
 class TestBaseImage:
-    @patch("recitale.image.imagesize.get", return_value=(200, 300))
-    def test_first_copy_no_resize(self, mock_imgsz):
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_first_copy_no_resize(self, mock_metadata):
         base = BaseImage({"name": "test.jpg"}, {})
         base.copy()
         assert base.copysize == (200, 300)
 
-    @patch("recitale.image.imagesize.get", return_value=(200, 300))
-    def test_two_copies_no_resize(self, mock_imgsz):
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_two_copies_no_resize(self, mock_metadata):
         base = BaseImage({"name": "test.jpg"}, {})
         base.copy()
         base.copy()
         assert len(base.thumbnails.keys()) == 1
 
-    @patch("recitale.image.imagesize.get", return_value=(200, 300))
-    def test_copy_resize(self, mock_imgsz):
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_copy_resize(self, mock_metadata):
         base = BaseImage({"name": "test.jpg", "resize": "50%"}, {})
         base.copy()
         assert base.copysize == (100, 150)
 
-    @patch("recitale.image.imagesize.get", return_value=(200, 300))
-    def test_copy_filepath(self, mock_imgsz):
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_copy_filepath(self, mock_metadata):
         base = BaseImage({"name": "test.jpg", "resize": "50%"}, {})
         copy = base.copy()
         assert copy == "test-%s-100x150.jpg" % (
@@ -40,9 +118,9 @@ class TestBaseImage:
         "recitale.image.remove_superficial_options",
         side_effect=remove_superficial_options,
     )
-    @patch("recitale.image.imagesize.get", return_value=(200, 300))
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
     def test_copy_filepath_remove_superficial_options(
-        self, mock_imgsz, mock_rm_sup_opt
+        self, mock_metadata, mock_rm_sup_opt
     ):
         base = BaseImage({"name": "test.jpg", "resize": "50%", "test": "test123"}, {})
         copy = base.copy()
@@ -53,8 +131,54 @@ class TestBaseImage:
             crc32(bytes(json_dumps({"test": "test123"}, sort_keys=True), "utf-8"))
         )
 
-    @patch("recitale.image.imagesize.get", return_value=(200, 300))
-    def test_copy_invalid_resize(self, mock_imgsz, caplog):
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_task(self, mock_metadata):
+        base = BaseImage({"name": "dir/test.jpg", "resize": "50%"}, {"draft": False})
+        base.copy()
+        base.thumbnail((None, 150))
+        chksum = crc32(bytes(json_dumps({}, sort_keys=True), "utf-8"))
+        assert base.task() == (
+            "dir/test.jpg",
+            chksum,
+            False,
+            2,
+            (
+                ("dir/test-%s-100x150.jpg" % chksum, (100, 150), ()),
+                ("dir/test-%s-x150.jpg" % chksum, (None, 150), ()),
+            ),
+        )
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_variants(self, mock_metadata, monkeypatch):
+        monkeypatch.setattr(
+            ImageFactory, "global_options", {"formats": ["avif", "webp"]}
+        )
+        base = BaseImage({"name": "dir/test.jpg"}, {})
+        chksum = crc32(bytes(json_dumps({}, sort_keys=True), "utf-8"))
+        name = "test-%s-x150.jpg" % chksum
+        assert base.variants((None, 150)) == [
+            ("image/avif", name + ".avif"),
+            ("image/webp", name + ".webp"),
+        ]
+        # Same thumbnail as the one in the original format
+        assert base.thumbnail((None, 150)) == name
+        assert base.task()[4] == (
+            (
+                "dir/" + name,
+                (None, 150),
+                (("dir/%s.avif" % name, "AVIF"), ("dir/%s.webp" % name, "WEBP")),
+            ),
+        )
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300, "WEBP"))
+    def test_variants_same_format(self, mock_metadata, monkeypatch):
+        monkeypatch.setattr(ImageFactory, "global_options", {"formats": ["webp"]})
+        base = BaseImage({"name": "test.webp"}, {})
+        assert base.variants((None, 150)) == []
+        assert base.mime_type == "image/webp"
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_copy_invalid_resize(self, mock_metadata, caplog):
         base = BaseImage({"name": "test.jpg", "resize": "50"}, {})
         with pytest.raises(SystemExit) as sysexit:
             base.copy()
@@ -64,6 +188,146 @@ class TestBaseImage:
                 caplog.text == "(test.jpg) specified resize setting is not a percentage"
             )
 
+    @pytest.mark.parametrize(
+        "options,orientation,expected",
+        [
+            ({"auto-orient": True}, 1, (200, 100)),
+            ({"auto-orient": True}, 6, (100, 200)),
+            ({"auto-orient": False}, 6, (200, 100)),
+        ],
+    )
+    def test_size_orientation(self, options, orientation, expected):
+        with patch(
+            "recitale.image.read_metadata",
+            return_value=metadata(200, 100, orientation=orientation),
+        ):
+            base = BaseImage({"name": "test.jpg"}, options)
+            assert base.ratio == expected[0] / expected[1]
+            base.copy()
+        assert base.copysize == expected
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_metadata_read_once(self, mock_metadata):
+        base = BaseImage({"name": "test.jpg"}, {})
+        assert base.ratio == 200 / 300
+        base.copy()
+        mock_metadata.assert_called_once_with("test.jpg")
+
+
+class TestPlaceholder:
+    @pytest.fixture
+    def picture(self):
+        # Mostly blue with a red band, both dark and light shades of blue
+        im = Image.new("RGB", (300, 200), (0, 0, 200))
+        im.paste((0, 0, 250), (0, 0, 300, 50))
+        im.paste((255, 0, 0), (0, 180, 300, 200))
+        return im
+
+    def test_dominant_color(self, picture, monkeypatch):
+        monkeypatch.setattr("recitale.image.numpy", None)
+        assert dominant_color(picture) == (0, 0, 200)
+        assert dominant_color(Image.new("RGB", (2, 1), (10, 20, 30))) == (10, 20, 30)
+
+    def test_dominant_color_numpy(self, picture):
+        pytest.importorskip("numpy")
+        assert dominant_color(picture) == (0, 0, 200)
+        noise = Image.effect_noise((64, 64), 100).convert("RGB")
+        with patch("recitale.image.numpy", None):
+            expected = dominant_color(noise)
+        assert dominant_color(noise) == expected
+
+    @pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "P"])
+    def test_image_placeholder(self, picture, mode):
+        placeholder = image_placeholder(picture.convert(mode))
+        assert set(placeholder) == {"color", "uri"}
+        assert placeholder["uri"].startswith("data:image/")
+        with Image.open(BytesIO(b64decode(placeholder["uri"].split(",", 1)[1]))) as im:
+            assert im.size == (16, 11)
+
+    @patch("recitale.image.read_metadata")
+    def test_property(self, mock_metadata):
+        mock_metadata.return_value = metadata(200, 300)
+        assert BaseImage({"name": "test.jpg"}, {}).placeholder is None
+        mock_metadata.return_value["placeholder"] = {"color": "#000000", "uri": ""}
+        assert BaseImage({"name": "test.jpg"}, {}).placeholder["color"] == "#000000"
+
+    def test_read_placeholder(self, tmp_path):
+        path = tmp_path.joinpath("test.jpg")
+        Image.new("RGB", (2000, 1000), "red").save(path)
+        placeholder = read_placeholder(path)
+        assert set(placeholder) == {"color", "uri"}
+        assert placeholder["color"] == "#fe0000"
+
+    def test_upright(self, tmp_path):
+        # Stored sideways, the placeholder of the upright picture is kept too
+        path = tmp_path.joinpath("test.jpg")
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new("RGB", (400, 200), "red").save(path, exif=exif)
+        placeholder = read_placeholder(path)
+        with Image.open(BytesIO(b64decode(placeholder["uri"].split(",", 1)[1]))) as im:
+            assert im.size == (16, 8)
+        uri = placeholder["upright"]
+        with Image.open(BytesIO(b64decode(uri.split(",", 1)[1]))) as im:
+            assert im.size == (8, 16)
+
+    @patch("recitale.image.read_metadata")
+    def test_property_upright(self, mock_metadata):
+        mock_metadata.return_value = metadata(200, 300)
+        mock_metadata.return_value["placeholder"] = {
+            "color": "#000000",
+            "uri": "sideways",
+            "upright": "upright",
+        }
+        assert BaseImage({"name": "test.jpg"}, {}).placeholder["uri"] == "sideways"
+        image = BaseImage({"name": "test.jpg", "auto-orient": True}, {})
+        assert image.placeholder["uri"] == "upright"
+
+
+class TestMetadata:
+    def test_read_metadata(self, tmp_path):
+        path = tmp_path.joinpath("test.jpg")
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif[0x0132] = "2023:06:10 10:10:10"
+        Image.new("RGB", (40, 20)).save(path, dpi=(300, 300), exif=exif)
+        assert read_metadata(path) == {
+            "width": 40,
+            "height": 20,
+            "format": "JPEG",
+            "orientation": 6,
+            "subsampling": 2,
+            "dpi": [300.0, 300.0],
+            "date": "2023:06:10 10:10:10",
+        }
+
+    @pytest.mark.parametrize("tag", [0x9003, 0x9004, 0x0132])
+    def test_read_metadata_date(self, tmp_path, tag):
+        path = tmp_path.joinpath("test.jpg")
+        exif = Image.Exif()
+        exif[tag] = "2023:06:10 10:10:10"
+        Image.new("RGB", (40, 20)).save(path, exif=exif)
+        assert read_metadata(path)["date"] == "2023:06:10 10:10:10"
+
+    def test_read_metadata_png(self, tmp_path):
+        path = tmp_path.joinpath("test.png")
+        Image.new("RGB", (40, 20)).save(path)
+        assert read_metadata(path) == metadata(40, 20, "PNG")
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_cached(self, mock_metadata):
+        cache = MagicMock()
+        cache.probe_infos.return_value = metadata(20, 30)
+        assert image_metadata("test.jpg", cache) == metadata(20, 30)
+        mock_metadata.assert_not_called()
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_stored(self, mock_metadata):
+        cache = MagicMock()
+        cache.probe_infos.return_value = None
+        assert image_metadata("test.jpg", cache) == metadata(200, 300)
+        cache.store_probe_infos.assert_called_once_with("test.jpg", metadata(200, 300))
+
 
 # HACK because ImageFactory.base_imgs does not seem to be reset between tests.
 @pytest.fixture
@@ -124,3 +388,77 @@ class TestImageFactory:
         base_imgs = ImageFactory.base_imgs
         assert len(base_imgs.keys()) == 1
         assert img1 is list(base_imgs.values())[0]
+
+    @patch("recitale.image.read_metadata", return_value=metadata(200, 300))
+    def test_merge(self, mock_metadata):
+        img = ImageFactory.get("gallery", "test.jpg")
+        img.thumbnail((None, 100))
+        base_imgs = ImageFactory.base_imgs
+        ImageFactory.base_imgs = dict()
+        other = ImageFactory.get("gallery", "test.jpg")
+        other.thumbnail((None, 100))
+        other.thumbnail((None, 200))
+        new = ImageFactory.get("gallery", "new.jpg")
+        merged = ImageFactory.base_imgs
+        ImageFactory.base_imgs = base_imgs
+        ImageFactory.merge(merged)
+        assert list(ImageFactory.base_imgs.values()) == [img, new]
+        assert len(img.thumbnails) == 2
+
+
+class TestGetFormats:
+    def test_formats(self):
+        assert get_formats(None) == []
+        assert get_formats("webp") == ["webp"]
+        assert get_formats(["avif", "webp"]) == ["avif", "webp"]
+
+    def test_unknown(self, caplog):
+        with pytest.raises(SystemExit):
+            get_formats(["webp", "jxl"])
+        assert "Unknown thumbnail format 'jxl'" in caplog.text
+
+    def test_unsupported(self, monkeypatch, caplog):
+        monkeypatch.delitem(Image.SAVE, "AVIF", raising=False)
+        monkeypatch.setattr(Image, "init", lambda: None)
+        assert get_formats(["avif", "webp"]) == ["webp"]
+        assert "Pillow cannot write AVIF pictures" in caplog.text
+
+
+class TestBaseImageCost:
+    @patch("recitale.image.read_metadata", return_value=metadata(2000, 1000))
+    def test_cost(self, mock_metadata):
+        base = BaseImage({"name": "test.jpg"}, {})
+        thumbnails = [
+            Thumbnail("test.jpg", 0, (None, 500)),
+            Thumbnail("test.jpg", 0, (100, 100)),
+        ]
+        # 2MP decoded and resampled, 0.5MP + 0.005MP encoded
+        assert base.cost(thumbnails) == pytest.approx(2 * 45 + 0.505 * 25)
+
+    @patch("recitale.image.read_metadata", return_value=metadata(2000, 1000))
+    def test_cost_variants(self, mock_metadata):
+        base = BaseImage({"name": "test.jpg"}, {})
+        thumbnail = Thumbnail("test.jpg", 0, (None, 500))
+        thumbnail.formats = frozenset(["webp"])
+        # 0.5MP encoded as JPEG and WebP
+        assert base.cost([thumbnail]) == pytest.approx(2 * 45 + 0.5 * (25 + 200))
+
+    @patch("recitale.image.read_metadata", return_value=metadata(2000, 1000, "PNG"))
+    def test_cost_format(self, mock_metadata):
+        base = BaseImage({"name": "test.png"}, {})
+        assert base.cost([Thumbnail("test.png", 0, (None, 500))]) == (
+            2 * 65 + 0.5 * 150
+        )
+
+    @patch("recitale.image.read_metadata", return_value=metadata(2000, 1000, "XYZ"))
+    def test_cost_unknown_format(self, mock_metadata):
+        base = BaseImage({"name": "test.unknown"}, {})
+        assert base.cost([Thumbnail("test.unknown", 0, (None, 500))]) == (
+            2 * 50 + 0.5 * 50
+        )
+
+    @patch("recitale.image.read_metadata")
+    def test_cost_nothing_to_render(self, mock_metadata):
+        base = BaseImage({"name": "test.jpg"}, {})
+        assert base.cost([]) == 0
+        mock_metadata.assert_not_called()
@@ -0,0 +1,116 @@
+import gzip
+import os
+
+import pytest
+
+import recitale.precompress
+from recitale.cache import Cache
+from recitale.precompress import (
+    compress,
+    get_encodings,
+    needs_precompress,
+    precompress,
+    stale_outputs,
+)
+
+CONTENT = b"<html><body>" + b"<p>gallery</p>" * 100 + b"</body></html>"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return Cache(tmp_path.joinpath(".recitale_cache"))
+
+
+@pytest.fixture
+def page(tmp_path):
+    path = tmp_path.joinpath("build", "index.html")
+    path.parent.mkdir()
+    path.write_bytes(CONTENT)
+    return str(path)
+
+
+class TestGetEncodings:
+    @pytest.mark.parametrize("setting", [None, False, []])
+    def test_disabled(self, setting):
+        assert get_encodings(setting) == []
+
+    def test_all(self, monkeypatch):
+        monkeypatch.setattr(recitale.precompress, "brotli", object())
+        assert get_encodings(True) == ["gzip", "br"]
+
+    def test_all_without_brotli(self, monkeypatch):
+        monkeypatch.setattr(recitale.precompress, "brotli", None)
+        assert get_encodings(True) == ["gzip"]
+
+    def test_list(self, monkeypatch):
+        monkeypatch.setattr(recitale.precompress, "brotli", None)
+        assert get_encodings("gzip") == ["gzip"]
+        assert get_encodings(["gzip", "br"]) == ["gzip"]
+
+    def test_unknown(self):
+        with pytest.raises(SystemExit):
+            get_encodings(["gzip", "zstd"])
+
+
+def test_compress_gzip_reproducible():
+    compressed = compress(CONTENT, "gzip")
+    assert gzip.decompress(compressed) == CONTENT
+    assert compress(CONTENT, "gzip") == compressed
+
+
+def test_compress_brotli():
+    brotli = pytest.importorskip("brotli")
+    assert brotli.decompress(compress(CONTENT, "br")) == CONTENT
+
+
+def test_precompress(page):
+    fingerprint = precompress(page, ["gzip"])
+    assert gzip.decompress(open(page + ".gz", "rb").read()) == CONTENT
+    assert os.stat(page + ".gz").st_mtime_ns == os.stat(page).st_mtime_ns
+    assert fingerprint["size"] == len(CONTENT)
+    assert fingerprint["mtime_ns"] == os.stat(page).st_mtime_ns
+
+
+class TestNeedsPrecompress:
+    def test_unknown(self, cache, page):
+        assert needs_precompress(cache, page, ["gzip"])
+
+    def test_unchanged(self, cache, page):
+        cache.store_precompressed(page, precompress(page, ["gzip"]), ["gzip"])
+        assert not needs_precompress(cache, page, ["gzip"])
+
+    def test_other_encodings(self, cache, page):
+        cache.store_precompressed(page, precompress(page, ["gzip"]), ["gzip"])
+        assert needs_precompress(cache, page, ["gzip", "br"])
+
+    def test_missing_sibling(self, cache, page):
+        cache.store_precompressed(page, precompress(page, ["gzip"]), ["gzip"])
+        os.remove(page + ".gz")
+        assert needs_precompress(cache, page, ["gzip"])
+
+    def test_modified(self, cache, page):
+        cache.store_precompressed(page, precompress(page, ["gzip"]), ["gzip"])
+        with open(page, "ab") as f:
+            f.write(b"\n")
+        assert needs_precompress(cache, page, ["gzip"])
+
+    def test_same_content_written_again(self, cache, page):
+        cache.store_precompressed(page, precompress(page, ["gzip"]), ["gzip"])
+        mtime = os.stat(page).st_mtime_ns + 10**9
+        os.utime(page, ns=(mtime, mtime))
+
+        assert not needs_precompress(cache, page, ["gzip"])
+        assert os.stat(page + ".gz").st_mtime_ns == mtime
+        assert cache.precompressed(page)["mtime_ns"] == mtime
+
+
+def test_stale_outputs(cache, page, tmp_path):
+    build = tmp_path.joinpath("build")
+    build.joinpath("small.css").write_bytes(b"body {}")
+    build.joinpath("picture.jpg").write_bytes(CONTENT)
+    build.joinpath("static").mkdir()
+    build.joinpath("static", "style.css").write_bytes(CONTENT)
+    assert sorted(stale_outputs(cache, str(build), ["gzip"])) == [
+        page,
+        str(build.joinpath("static", "style.css")),
+    ]
@@ -0,0 +1,242 @@
+import http.client
+import os
+import threading
+
+import pytest
+
+from recitale.preview import (
+    LIVERELOAD_PATH,
+    LIVERELOAD_SCRIPT,
+    LiveReload,
+    accepted_encodings,
+    make_server,
+    parse_range,
+)
+
+VIDEO = bytes(range(256)) * 16
+
+
+@pytest.fixture
+def livereload():
+    return LiveReload()
+
+
+@pytest.fixture
+def build(tmp_path):
+    tmp_path.joinpath("gallery").mkdir()
+    tmp_path.joinpath("gallery", "index.html").write_bytes(
+        b"<html><body>gallery</body></html>"
+    )
+    tmp_path.joinpath("gallery", "video.webm").write_bytes(VIDEO)
+    tmp_path.joinpath("style.css").write_bytes(b"body {}")
+    tmp_path.joinpath("empty.txt").write_bytes(b"")
+    return tmp_path
+
+
+def serve(build, livereload=None):
+    server = make_server(build, "127.0.0.1", 0, livereload)
+    threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def server(build):
+    server = serve(build)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def livereload_server(build, livereload):
+    server = serve(build, livereload)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path, headers={}, connection=None):
+    if connection is None:
+        connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    connection.request("GET", path, headers=headers)
+    return connection.getresponse()
+
+
+def test_file(server):
+    response = get(server, "/style.css")
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "text/css"
+    assert response.getheader("Accept-Ranges") == "bytes"
+    assert response.read() == b"body {}"
+
+
+def test_index(server):
+    response = get(server, "/gallery/")
+    assert response.status == 200
+    assert response.read() == b"<html><body>gallery</body></html>"
+    response = get(server, "/gallery")
+    assert response.status == 301
+    assert response.getheader("Location") == "/gallery/"
+
+
+def test_not_found(server):
+    assert get(server, "/missing.css").status == 404
+    assert get(server, "/style.css/").status == 404
+
+
+def test_empty_file(server):
+    response = get(server, "/empty.txt")
+    assert response.status == 200
+    assert response.read() == b""
+
+
+def test_keepalive(server):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    assert get(server, "/style.css", connection=connection).read() == b"body {}"
+    sock = connection.sock
+    response = get(server, "/gallery/video.webm", connection=connection)
+    assert response.read() == VIDEO
+    assert connection.sock is sock
+
+
+@pytest.mark.parametrize(
+    "header,expected,content_range",
+    [
+        ("bytes=0-99", VIDEO[:100], "bytes 0-99/4096"),
+        ("bytes=4000-", VIDEO[4000:], "bytes 4000-4095/4096"),
+        ("bytes=-10", VIDEO[-10:], "bytes 4086-4095/4096"),
+        ("bytes=4090-5000", VIDEO[4090:], "bytes 4090-4095/4096"),
+    ],
+)
+def test_range(server, header, expected, content_range):
+    response = get(server, "/gallery/video.webm", {"Range": header})
+    assert response.status == 206
+    assert response.getheader("Content-Range") == content_range
+    assert response.read() == expected
+
+
+def test_range_not_satisfiable(server):
+    response = get(server, "/gallery/video.webm", {"Range": "bytes=5000-"})
+    assert response.status == 416
+    assert response.getheader("Content-Range") == "bytes */4096"
+    response.read()
+
+
+def test_if_range(server):
+    etag = get(server, "/gallery/video.webm").getheader("ETag")
+    response = get(
+        server, "/gallery/video.webm", {"Range": "bytes=0-9", "If-Range": etag}
+    )
+    assert response.status == 206
+    response = get(
+        server, "/gallery/video.webm", {"Range": "bytes=0-9", "If-Range": '"old"'}
+    )
+    assert response.status == 200
+    assert response.read() == VIDEO
+
+
+def test_etag(server, build):
+    response = get(server, "/style.css")
+    etag = response.getheader("ETag")
+    response = get(server, "/style.css", {"If-None-Match": etag})
+    assert response.status == 304
+    assert response.read() == b""
+
+    build.joinpath("style.css").write_bytes(b"body { margin: 0 }")
+    response = get(server, "/style.css", {"If-None-Match": etag})
+    assert response.status == 200
+    assert response.getheader("ETag") != etag
+
+
+def test_last_modified(server):
+    last_modified = get(server, "/style.css").getheader("Last-Modified")
+    response = get(server, "/style.css", {"If-Modified-Since": last_modified})
+    assert response.status == 304
+    response = get(
+        server, "/style.css", {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}
+    )
+    assert response.status == 200
+
+
+@pytest.mark.parametrize(
+    "accept,encoding,content",
+    [
+        ("gzip, br", "br", b"brotli"),
+        ("gzip", "gzip", b"gzip"),
+        ("br;q=0, gzip", "gzip", b"gzip"),
+        ("identity", None, b"body {}"),
+    ],
+)
+def test_precompressed(server, build, accept, encoding, content):
+    build.joinpath("style.css.gz").write_bytes(b"gzip")
+    build.joinpath("style.css.br").write_bytes(b"brotli")
+    response = get(server, "/style.css", {"Accept-Encoding": accept})
+    assert response.getheader("Content-Encoding") == encoding
+    assert response.getheader("Content-Type") == "text/css"
+    assert response.getheader("Vary") == "Accept-Encoding"
+    assert response.read() == content
+
+
+def test_precompressed_stale(server, build):
+    build.joinpath("style.css.gz").write_bytes(b"gzip")
+    mtime = build.joinpath("style.css").stat().st_mtime_ns
+    os.utime(build.joinpath("style.css.gz"), ns=(mtime - 10**9, mtime - 10**9))
+    response = get(server, "/style.css", {"Accept-Encoding": "gzip"})
+    assert response.getheader("Content-Encoding") is None
+    assert response.read() == b"body {}"
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=10-", (10, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-2000", (0, 999)),
+        ("bytes=500-2000", (500, 999)),
+        ("bytes=-0", (1000, 999)),
+        ("bytes=2000-", (2000, 999)),
+        ("bytes=0-9,20-29", None),
+        ("bytes=9-0", None),
+        ("bytes=a-b", None),
+        ("items=0-9", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br;q=0.5, zstd;q=0") == {
+        "gzip",
+        "deflate",
+        "br",
+    }
+    assert accepted_encodings("") == set()
+
+
+def test_html_livereload(livereload_server):
+    response = get(livereload_server, "/gallery/")
+    assert response.status == 200
+    assert response.read() == (
+        b"<html><body>gallery" + LIVERELOAD_SCRIPT + b"</body></html>"
+    )
+
+
+def test_livereload_other_files_unchanged(livereload_server):
+    response = get(livereload_server, "/style.css")
+    assert response.status == 200
+    assert response.read() == b"body {}"
+
+
+def test_reload_event(livereload_server, livereload):
+    response = get(livereload_server, LIVERELOAD_PATH)
+    assert response.getheader("Content-Type") == "text/event-stream"
+    threading.Timer(0.1, livereload.reload).start()
+    assert response.fp.readline() == b"data: reload\n"
+
+
+def test_livereload_wait(livereload):
+    assert livereload.wait(0, 0.01) == 0
+    livereload.reload()
+    assert livereload.wait(0) == 1
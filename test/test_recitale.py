@@ -0,0 +1,598 @@
+import copy
+import os
+import pytest
+
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from PIL import Image, ImageChops, ImageStat
+
+from recitale.audio import AudioFactory, BaseAudio, Reencode
+from recitale.cache import Cache
+from recitale.image import ImageFactory, Thumbnail, read_metadata
+from recitale.video import BaseVideo, VideoFactory, probe as probe_video
+import recitale.recitale
+from recitale.recitale import (
+    SETTINGS,
+    Pages,
+    Progress,
+    TemplatesEnvironment,
+    audio_jobs,
+    changed_galleries,
+    dump_requests,
+    gallery_media,
+    get_theme_templates,
+    load_requests,
+    merge_thumbnails,
+    page_digest,
+    probe_durations,
+    probe_media,
+    probe_placeholders,
+    record_page,
+    render_thumbnails,
+    run_ffmpeg,
+    set_func_args,
+    template_digests,
+    theme_templates,
+    video_jobs,
+    Workers,
+)
+
+THEMES = Path(recitale.recitale.__file__).parent.joinpath("themes")
+
+
+class TestProgress:
+    def test_nothing_to_do(self):
+        with patch("recitale.recitale.tqdm") as mock_tqdm:
+            with Progress(desc="test") as progress:
+                progress.update(1)
+        mock_tqdm.assert_not_called()
+
+    def test_update(self):
+        progress = Progress(desc="test")
+        progress.total = 10
+        with patch("recitale.recitale.tqdm") as mock_tqdm:
+            with progress:
+                progress.update(2.5)
+        mock_tqdm.assert_called_once_with(total=10, desc="test")
+        mock_tqdm.return_value.update.assert_called_once_with(2.5)
+        mock_tqdm.return_value.close.assert_called_once()
+
+
+class TestRunFfmpeg:
+    def popen(self, lines, returncode):
+        proc = MagicMock()
+        proc.stdout = iter(lines)
+        proc.returncode = returncode
+        return proc
+
+    @pytest.mark.parametrize("returncode,success", [(0, True), (1, False)])
+    def test_progress(self, returncode, success):
+        lines = [
+            b"frame=0\n",
+            b"out_time_us=N/A\n",
+            b"out_time_us=1500000\n",
+            b"progress=continue\n",
+            b"out_time_us=4000000\n",
+        ]
+        progress = MagicMock()
+        with patch(
+            "recitale.recitale.subprocess.Popen",
+            return_value=self.popen(lines, returncode),
+        ):
+            assert (
+                run_ffmpeg("ffmpeg -i in.mp4 out.webm", "in.mp4", 5, progress)
+                is success
+            )
+        assert [c.args[0] for c in progress.update.call_args_list] == [1.5, 2.5, 1]
+
+    def test_progress_longer_than_duration(self):
+        progress = MagicMock()
+        with patch(
+            "recitale.recitale.subprocess.Popen",
+            return_value=self.popen([b"out_time_us=6000000\n"], 0),
+        ):
+            run_ffmpeg("ffmpeg -i in.mp4 out.webm", "in.mp4", 5, progress)
+        assert [c.args[0] for c in progress.update.call_args_list] == [5, 0]
+
+
+class TestAudioJobs:
+    def base(self):
+        base = BaseAudio(
+            Path("gallery/song.flac"),
+            {
+                "binary": "ffmpeg",
+                "loglevel": "error",
+                "audio": "libmp3lame",
+                "extension": "mp3",
+            },
+        )
+        base.reencode()
+        base._add_reencode(Reencode(base.filepath, "other", "ogg"))
+        base.dur = 10
+        return base
+
+    def test_each_reencode_checked(self):
+        base = self.base()
+        cache = MagicMock()
+        # The first reencode is cached, not the second one
+        cache.needs_to_be_generated.side_effect = [False, True]
+        progress = Progress()
+        jobs = audio_jobs(cache, base, progress, [])
+        assert len(jobs) == 1
+        assert jobs[0].args[0].endswith("build/gallery/song-other.ogg")
+        assert jobs[0].group == "audio"
+        assert progress.total == 10
+
+    def test_failure(self):
+        base = self.base()
+        cache = MagicMock()
+        cache.needs_to_be_generated.return_value = True
+        failures = []
+        jobs = audio_jobs(cache, base, Progress(), failures)
+        assert len(jobs) == 2
+        jobs[0].on_done(False)
+        jobs[1].on_done(True)
+        assert failures == [base.filepath]
+        cache.cache_picture.assert_called_once()
+
+
+class TestVideoJobs:
+    @pytest.mark.parametrize("slots, threads", [(8, 4), (2, 2)])
+    def test_threads(self, slots, threads):
+        # ffmpeg never gets more threads than the CPU slots of the scheduler
+        options = {
+            "binary": "ffmpeg",
+            "loglevel": "error",
+            "video": "libvpx",
+            "vbitrate": "1M",
+            "other": "",
+            "audio": "libvorbis",
+            "abitrate": "128k",
+            "format": "webm",
+            "extension": "webm",
+            "threads": 4,
+        }
+        base = BaseVideo({"name": Path("gallery/video.mp4")}, options)
+        base.reencode((None, 480))
+        base.dur = 10
+        cache = MagicMock()
+        cache.needs_to_be_generated.return_value = True
+        jobs = video_jobs(cache, base, Progress(), [], slots)
+        assert "-threads %d " % threads in jobs[0].args[0]
+        assert jobs[0].slots == threads
+
+
+class TestProbeMedia:
+    def test_probe_unknown_only(self, tmp_path):
+        cache = Cache(tmp_path.joinpath(".recitale_cache"))
+        paths = [tmp_path.joinpath(name) for name in ["a.mp4", "b.mp4", "c.mp4"]]
+        for path in paths:
+            path.write_bytes(b"")
+        cache.store_probe_infos(paths[0], {"duration": 1})
+
+        def probe(path):
+            if path.name == "c.mp4":
+                raise OSError()
+            return {"duration": 2}
+
+        probe = MagicMock(side_effect=probe)
+        probe_media(cache, [(path, probe) for path in paths], 2)
+        assert probe.call_count == 2
+        assert cache.probe_infos(paths[0]) == {"duration": 1}
+        assert cache.probe_infos(paths[1]) == {"duration": 2}
+        assert cache.probe_infos(paths[2]) is None
+
+    def test_probe_audio_only_video(self, tmp_path):
+        # A gallery may have audio only WebM files, which are recognized as videos
+        cache = Cache(tmp_path.joinpath(".recitale_cache"))
+        path = tmp_path.joinpath("audio.webm")
+        path.write_bytes(b"")
+        VideoFactory.global_options = {"binary": "ffmpeg"}
+        output = (
+            '{"streams": [{"codec_type": "audio", "codec_name": "opus"}], '
+            '"format": {"duration": "2.5"}}'
+        )
+        with patch("recitale.video.subprocess.check_output", return_value=output):
+            probe_media(cache, [(path, probe_video)], 2)
+        assert cache.probe_infos(path) is None
+
+    def test_gallery_media(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        for name in ["gallery/a.jpg", "gallery/b.mp4", "gallery/sub/c.ogg"]:
+            Path(name).parent.mkdir(parents=True, exist_ok=True)
+            Path(name).write_bytes(b"")
+        assert gallery_media([Path("gallery")]) == {
+            "image": [Path("gallery/a.jpg")],
+            "video": [Path("gallery/b.mp4")],
+            "audio": [Path("gallery/sub/c.ogg")],
+        }
+
+
+class TestProbePlaceholders:
+    @pytest.fixture
+    def cache(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        Image.new("RGB", (400, 200), "red").save("a.jpg")
+        Image.new("RGB", (400, 200), "blue").save("b.jpg")
+        cache = Cache(tmp_path.joinpath(".recitale_cache"))
+        probe_media(
+            cache, [(Path(name), read_metadata) for name in ["a.jpg", "b.jpg"]], 1
+        )
+        return cache
+
+    def test_probe_placeholders(self, cache):
+        probe_placeholders(cache, [Path("a.jpg"), Path("b.jpg")], 2)
+        assert cache.probe_infos("a.jpg")["placeholder"]["color"] == "#fe0000"
+        assert cache.probe_infos("b.jpg")["placeholder"]["color"] == "#0000fe"
+        # Known from now on
+        with patch("recitale.recitale.read_placeholder") as mock:
+            probe_placeholders(cache, [Path("a.jpg"), Path("b.jpg")], 2)
+        mock.assert_not_called()
+
+    def test_same_content(self, cache):
+        probe_placeholders(cache, [Path("a.jpg")], 1)
+        placeholder = cache.probe_infos("a.jpg")["placeholder"]
+        # Touched, the picture is probed again but not decoded for its placeholder
+        stat = Path("a.jpg").stat()
+        os.utime("a.jpg", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        probe_media(cache, [(Path("a.jpg"), read_metadata)], 1)
+        assert "placeholder" not in cache.probe_infos("a.jpg")
+        with patch("recitale.recitale.read_placeholder") as mock:
+            probe_placeholders(cache, [Path("a.jpg")], 1)
+        mock.assert_not_called()
+        assert cache.probe_infos("a.jpg")["placeholder"] == placeholder
+
+    def test_not_probed(self, cache):
+        Path("c.jpg").write_bytes(b"")
+        probe_placeholders(cache, [Path("c.jpg")], 1)
+        assert cache.probe_infos("c.jpg") is None
+
+
+class TestProbeDurations:
+    check_output = '{"format": {"duration": "10.4"}}'
+
+    def test_probe_uncached_only(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        options = {"binary": "ffmpeg", "extension": "mp3"}
+        AudioFactory.global_options = options
+        bases = [
+            BaseAudio(Path(name), options) for name in ["a.flac", "b.flac", "c.flac"]
+        ]
+        for base in bases:
+            base.filepath.write_bytes(b"")
+            base.reencode()
+        bases[2].dur = 3
+        cache = Cache(tmp_path.joinpath(".recitale_cache"))
+        with patch.object(
+            cache,
+            "may_be_cached",
+            side_effect=lambda source, target: source.name == "a.flac",
+        ), patch(
+            "recitale.audio.subprocess.check_output", return_value=self.check_output
+        ) as mock_probe:
+            probe_durations(cache, bases, 2)
+        mock_probe.assert_called_once()
+        assert "b.flac" in mock_probe.call_args.args[0]
+        assert cache.probe_infos(bases[1].filepath)["duration"] == 10.4
+        assert cache.probe_infos(bases[0].filepath) is None
+
+
+class TestThemeTemplates:
+    @pytest.fixture(autouse=True)
+    def site(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        theme_templates.clear()
+        yield
+        theme_templates.clear()
+
+    def test_shared(self):
+        templates = get_theme_templates("exposure")
+        assert get_theme_templates("exposure") is templates
+        assert get_theme_templates("exposure", "fr_FR") is not templates
+        assert get_theme_templates("light") is not templates
+
+    def test_bytecode_cache(self):
+        get_theme_templates("exposure").get_template("feed.xml")
+        assert list(Path(".recitale_cache/templates").iterdir())
+
+        # Another build
+        theme_templates.clear()
+        with patch.object(TemplatesEnvironment, "compile") as mock:
+            get_theme_templates("exposure").get_template("feed.xml")
+            mock.assert_not_called()
+
+    def test_bytecode_cache_preprocessed(self):
+        css = '<link rel="stylesheet" href="../static/css/%s"/>'
+        Path("templates").mkdir()
+        Path("templates/test.html").write_text(css % "a.css" + css % "b.css")
+        Path("static/css").mkdir(parents=True)
+        Path("static/css/a.css").write_text("a {}")
+        template = get_theme_templates("exposure").get_template("test.html")
+        assert "bundle-" not in template.render()
+
+        # The source of the template did not change, its bundles did
+        Path("static/css/b.css").write_text("b {}")
+        theme_templates.clear()
+        template = get_theme_templates("exposure").get_template("test.html")
+        assert "bundle-" in template.render()
+
+    @pytest.fixture
+    def rebuild(self, monkeypatch):
+        # Builds which only load the templates of the exposure theme
+        environments = []
+        monkeypatch.setattr("recitale.recitale.preload_settings", MagicMock())
+        monkeypatch.setattr(
+            "recitale.recitale.get_settings", MagicMock(return_value={})
+        )
+        monkeypatch.setattr("recitale.recitale.set_media_settings", MagicMock())
+        monkeypatch.setattr(
+            "recitale.recitale.find_galleries", MagicMock(return_value=[Path("a")])
+        )
+        monkeypatch.setattr(
+            "recitale.recitale.build",
+            lambda *args, **kwargs: environments.append(
+                get_theme_templates("exposure")
+            ),
+        )
+        defaults = copy.deepcopy(SETTINGS)
+
+        def rebuild(changes=()):
+            recitale.recitale.rebuild(None, 1, defaults, Workers(1), changes)
+            return environments[-1]
+
+        yield rebuild
+        SETTINGS.update(defaults)
+
+    def test_kept_by_rebuild(self, rebuild):
+        templates = rebuild()
+        assert rebuild([Path("a/settings.yaml")]) is templates
+        assert rebuild([Path("a/settings.yaml")]) is templates
+
+    @pytest.mark.parametrize(
+        "changed",
+        [
+            "templates/page.html",
+            "templates",
+            "static/css/style.css",
+            ".",
+            str(THEMES.joinpath("exposure", "templates", "page.html")),
+            str(THEMES.joinpath("exposure", "static", "js", "script.js")),
+        ],
+    )
+    def test_invalidated_by_rebuild(self, rebuild, changed):
+        templates = rebuild()
+        assert rebuild([Path(changed)]) is not templates
+        # Only once
+        assert rebuild([Path("a/settings.yaml")]) is rebuild()
+
+    def test_other_theme_changed(self, rebuild):
+        templates = rebuild()
+        changed = THEMES.joinpath("material", "templates", "page.html")
+        assert rebuild([changed]) is templates
+
+
+def shared_value(_):
+    return shared_value.shared["value"]
+
+
+class TestWorkers:
+    def test_share(self):
+        # Each process of the pool gets what is shared, again for each use of the pool
+        workers = Workers(2)
+        try:
+            for value in [1, 2]:
+                pool = workers.share(set_func_args, ({"value": value}, [shared_value]))
+                assert pool.map(shared_value, range(20), chunksize=1) == [value] * 20
+            assert workers.share(set_func_args, ({}, [])) is pool
+        finally:
+            workers.close()
+
+
+@pytest.mark.parametrize(
+    "changes, changed",
+    [
+        (None, None),
+        (["a/1.jpg"], {"a"}),
+        (["a"], {"a"}),
+        (["b/settings.yaml"], {"b/c", "b/d"}),
+        (["b/c/1.jpg"], {"b/c"}),
+        (["a/1.jpg", "b/d/1.jpg"], {"a", "b/d"}),
+        # Out of the galleries
+        (["settings.yaml"], None),
+        (["a/1.jpg", "static/css/style.css"], None),
+        ([THEMES.joinpath("exposure", "templates", "page.html")], None),
+    ],
+)
+def test_changed_galleries(changes, changed):
+    changed_gallery = changed_galleries([Path("a"), Path("b")], changes)
+    if changed is None:
+        assert changed_gallery is None
+        return
+    assert {
+        gallery for gallery in ["a", "b/c", "b/d"] if changed_gallery(Path(gallery))
+    } == changed
+
+
+class TestPages:
+    @pytest.fixture
+    def site(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        template_digests.clear()
+        yield Cache(tmp_path.joinpath(".recitale_cache"))
+        template_digests.clear()
+
+    def test_record_page(self, site):
+        templates = get_theme_templates("exposure")
+        assert record_page(templates.get_template, "feed.xml") == (
+            [("exposure", "feed.xml")],
+            ({}, {}, {}),
+        )
+
+    def test_page_digest_templates(self, site):
+        templates = [("exposure", "feed.xml")]
+        digest = page_digest(site, "{}", templates, [])
+        assert page_digest(site, '{"title": "test"}', templates, []) != digest
+        # Overridden by the templates directory of the site
+        Path("templates").mkdir()
+        Path("templates/feed.xml").write_text("feed")
+        template_digests.clear()
+        assert page_digest(site, "{}", templates, []) != digest
+
+    def test_page_digest_media(self, site):
+        Path("test.jpg").write_bytes(b"")
+        digest = page_digest(site, "{}", [], ["test.jpg"])
+        site.store_probe_infos("test.jpg", {"width": 10, "height": 10})
+        assert page_digest(site, "{}", [], ["test.jpg"]) != digest
+
+    def test_requests_json(self, site, monkeypatch):
+        monkeypatch.setattr(ImageFactory, "global_options", {"quality": 80})
+        monkeypatch.setattr(VideoFactory, "global_options", {"extension": "webm"})
+        monkeypatch.setattr(AudioFactory, "global_options", {"extension": "mp3"})
+        monkeypatch.setattr(ImageFactory, "base_imgs", {})
+        monkeypatch.setattr(VideoFactory, "base_vids", {})
+        monkeypatch.setattr(AudioFactory, "base_audios", {})
+        image = ImageFactory.get("gallery", {"name": "a.jpg", "resize": "50%"})
+        thumbnail = Thumbnail(image.filepath, image.chksum_opt, (None, 400))
+        thumbnail.formats = frozenset(["webp", "avif"])
+        image._add_thumbnail(thumbnail)
+        image.thumbnail((200, 200))
+        video = VideoFactory.get("gallery", {"name": "b.mp4", "threads": 4})
+        video.thumbnail((600, None))
+        video.reencode((1280, 720))
+        AudioFactory.get("gallery", "c.ogg").reencode()
+        requests = (
+            ImageFactory.base_imgs,
+            VideoFactory.base_vids,
+            AudioFactory.base_audios,
+        )
+
+        loaded = load_requests(dump_requests(requests))
+        assert [sorted(bases) for bases in loaded] == [
+            sorted(bases) for bases in requests
+        ]
+        ((key, loaded_image),) = loaded[0].items()
+        assert loaded_image.task() == requests[0][key].task()
+        assert loaded_image.resize == "50%"
+        ((key, loaded_video),) = loaded[1].items()
+        assert loaded_video.threads == 4
+        assert sorted(loaded_video.reencodes) == sorted(requests[1][key].reencodes)
+        assert sorted(loaded_video.thumbnails) == sorted(requests[1][key].thumbnails)
+        ((key, loaded_audio),) = loaded[2].items()
+        assert sorted(loaded_audio.reencodes) == sorted(requests[2][key].reencodes)
+
+    def test_requests_not_json(self, site):
+        # Stored by a former version
+        Path("build").mkdir()
+        Path("build/index.html").write_text("index")
+        pages = Pages(site, {"title": "test"})
+        context = pages._context("index")
+        site.store_page(
+            "build/index.html", page_digest(site, context, [], []), [], [], b"\x80\x04."
+        )
+        assert (
+            pages._requests("build/index.html", context, ["build/index.html"]) is None
+        )
+
+    @pytest.mark.parametrize("full", [False, True])
+    def test_index_rendered_once(self, site, full):
+        def build_index(settings, covers, templates, path, **kwargs):
+            templates.get_template("index.html")
+            Path("build").mkdir(exist_ok=True)
+            Path("build/index.html").write_text("index")
+
+        templates = get_theme_templates("exposure")
+        with patch("recitale.recitale.build_index", side_effect=build_index) as mock:
+            Pages(site, {"title": "test"}).index(templates, [])
+            Pages(site, {"title": "test"}, full).index(templates, [])
+            assert mock.call_count == (2 if full else 1)
+            Pages(site, {"title": "changed"}).index(templates, [])
+            assert mock.call_count == (3 if full else 2)
+            Path("build/index.html").unlink()
+            Pages(site, {"title": "changed"}).index(templates, [])
+            assert mock.call_count == (4 if full else 3)
+
+    def test_unchanged_gallery(self, site):
+        changed = changed_galleries([Path("a"), Path("b")], [Path("b/1.jpg")])
+        pages = Pages(site, {"settings": {}}, changed_galleries=changed)
+        pages.gallery({}, Path("a"), "exposure")
+        pages.gallery({}, Path("b"), "exposure")
+        assert [page for page, _, _, _ in pages.galleries] == ["build/b/index.html"]
+
+
+class TestRenderThumbnails:
+    @pytest.fixture
+    def cache(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        Path("build").mkdir()
+        Image.new("RGB", (400, 200), "red").save("test.jpg")
+        cache = Cache(tmp_path.joinpath(".recitale_cache"))
+        render_thumbnails.shared = {"options": {0: {}}, "cache": cache}
+        yield cache
+        del render_thumbnails.shared
+
+    def test_variants(self, cache):
+        task = (
+            "test.jpg",
+            0,
+            True,
+            2,
+            (("test-x100.jpg", (None, 100), (("test-x100.jpg.webp", "WEBP"),)),),
+        )
+        result = render_thumbnails(task)
+        assert result[1] == 1
+        with Image.open("build/test-x100.jpg.webp") as im:
+            assert (im.format, im.size) == ("WEBP", (200, 100))
+        assert Path("build/test-x100.jpg").exists()
+        merge_thumbnails(cache, 0, result)
+        assert render_thumbnails(task)[1] == 0
+
+        # Only the missing variant is written again
+        Path("build/test-x100.jpg.webp").unlink()
+        mtime = Path("build/test-x100.jpg").stat().st_mtime_ns
+        assert render_thumbnails(task)[1] == 1
+        assert Path("build/test-x100.jpg.webp").exists()
+        assert Path("build/test-x100.jpg").stat().st_mtime_ns == mtime
+
+    def test_auto_orient(self, cache):
+        # Stored sideways, the left half is the top of the picture once upright
+        im = Image.new("RGB", (400, 200), "blue")
+        im.paste("red", (0, 0, 200, 200))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif[0x010F] = "recitale"
+        im.save("rotated.jpg", exif=exif)
+        render_thumbnails.shared["options"][0] = {"auto-orient": True}
+
+        task = ("rotated.jpg", 0, True, 2, (("rotated-x100.jpg", (None, 100), ()),))
+        render_thumbnails(task)
+        with Image.open("build/rotated-x100.jpg") as thumbnail:
+            assert thumbnail.size == (50, 100)
+            top = thumbnail.getpixel((25, 10))
+            bottom = thumbnail.getpixel((25, 90))
+            assert top[0] > 200 and top[2] < 50
+            assert bottom[2] > 200 and bottom[0] < 50
+            # Viewers must not rotate it again, other tags are kept
+            exif = thumbnail.getexif()
+            assert 0x0112 not in exif
+            assert exif[0x010F] == "recitale"
+
+    @pytest.mark.parametrize("draft", [False, True])
+    def test_same_as_thumbnail(self, cache, draft):
+        # Thumbnails resized in a single pass look like those of Image.thumbnail() on a copy of
+        # the decoded picture, as they used to be created.
+        im = Image.linear_gradient("L").resize((1024, 512)).convert("RGB")
+        im.paste("green", (100, 100, 300, 300))
+        im.save("gradient.jpg", quality=95)
+
+        task = ("gradient.jpg", 0, draft, 2, (("gradient-x128.jpg", (None, 128), ()),))
+        render_thumbnails(task)
+        with Image.open("gradient.jpg") as original:
+            expected = original.copy()
+        expected.thumbnail((65596, 128), Image.LANCZOS)
+        expected.save("expected.jpg")
+        with Image.open("build/gradient-x128.jpg") as thumbnail, Image.open(
+            "expected.jpg"
+        ) as expected:
+            assert thumbnail.size == expected.size == (256, 128)
+            difference = ImageChops.difference(thumbnail, expected)
+            assert max(ImageStat.Stat(difference).mean) < 2
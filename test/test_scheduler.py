@@ -0,0 +1,158 @@
+import pytest
+import threading
+import time
+
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+from recitale.scheduler import Job, Scheduler
+
+
+class TestScheduler:
+    def run(self, scheduler, jobs):
+        with ThreadPool(scheduler.slots) as pool:
+            return list(scheduler.run(jobs, pool))
+
+    def test_default_slots(self):
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr("recitale.scheduler.os.cpu_count", lambda: 3)
+            assert Scheduler().slots == 3
+            assert Scheduler(2).slots == 2
+
+    @pytest.mark.parametrize("in_pool", [True, False])
+    def test_run(self, in_pool):
+        results = []
+        jobs = [
+            Job(lambda x: x * 2, (i,), in_pool=in_pool, on_done=results.append)
+            for i in range(5)
+        ]
+        assert sorted(self.run(Scheduler(2), jobs), key=jobs.index) == jobs
+        assert sorted(results) == [0, 2, 4, 6, 8]
+
+    def test_most_expensive_first(self):
+        started = []
+        jobs = [
+            Job(started.append, (cost,), cost=cost, in_pool=cost % 2)
+            for cost in [3, 10, 0, 5]
+        ]
+        self.run(Scheduler(1), jobs)
+        assert started == [10, 5, 3, 0]
+
+    def test_slots(self):
+        lock = threading.Lock()
+        busy = []
+        current = [0]
+
+        def work(slots):
+            with lock:
+                current[0] += slots
+                busy.append(current[0])
+            time.sleep(0.01)
+            with lock:
+                current[0] -= slots
+
+        jobs = [Job(work, (2,), slots=2, cost=10) for _ in range(3)]
+        jobs += [Job(work, (1,), cost=1, in_pool=True) for _ in range(6)]
+        self.run(Scheduler(3), jobs)
+        assert max(busy) <= 3
+
+    def test_too_many_slots(self):
+        job = Job(lambda: None, (), slots=8)
+        assert self.run(Scheduler(2), [job]) == [job]
+
+    @pytest.mark.parametrize("in_pool", [True, False])
+    def test_error(self, in_pool):
+        def fail():
+            raise ValueError("failed")
+
+        with pytest.raises(ValueError):
+            self.run(Scheduler(2), [Job(fail, (), in_pool=in_pool)])
+
+    def test_on_done_in_main_thread(self):
+        threads = []
+        job = Job(
+            lambda: None,
+            (),
+            on_done=lambda result: threads.append(threading.current_thread()),
+        )
+        self.run(Scheduler(2), [job])
+        assert threads == [threading.main_thread()]
+
+    def test_backfill(self):
+        started = []
+        jobs = [
+            Job(started.append, ("video1",), slots=2, cost=100),
+            Job(started.append, ("video2",), slots=2, cost=90),
+            Job(started.append, ("picture",), cost=10),
+        ]
+        self.run(Scheduler(3), jobs)
+        assert started == ["video1", "picture", "video2"]
+
+    @pytest.mark.parametrize(
+        "cost,slots,expected",
+        [
+            (50, 1, 0),
+            (200, 1, 0),
+            # Would delay the next job
+            (250, 1, None),
+            # Does not fit in the free slots
+            (50, 2, None),
+        ],
+    )
+    def test_backfill_delay(self, cost, slots, expected):
+        scheduler = Scheduler(4)
+        pending = [Job(None, (), slots=slots, cost=cost), Job(None, (), slots=4)]
+        running = {Job(None, ()): (1100, 1), Job(None, (), slots=2): (1200, 2)}
+        assert scheduler._backfill(pending, 1, running, 1, 1000, Counter()) == expected
+
+    def test_backfill_overdue(self):
+        scheduler = Scheduler(2)
+        pending = [Job(None, (), cost=10), Job(None, (), slots=2)]
+        running = {Job(None, ()): (900, 1)}
+        assert scheduler._backfill(pending, 1, running, 1, 1000, Counter()) is None
+
+    def test_backfill_extra_slots(self):
+        scheduler = Scheduler(4)
+        pending = [Job(None, (), cost=1000), Job(None, (), slots=3)]
+        running = {Job(None, (), slots=2): (1100, 2)}
+        assert scheduler._backfill(pending, 1, running, 2, 1000, Counter()) == 0
+        pending = [Job(None, (), cost=1000), Job(None, (), slots=4)]
+        running = {Job(None, (), slots=3): (1100, 3)}
+        assert scheduler._backfill(pending, 1, running, 1, 1000, Counter()) is None
+
+    def test_group_limit(self):
+        lock = threading.Lock()
+        busy = []
+        started = []
+        current = Counter()
+
+        def work(group):
+            with lock:
+                started.append(group)
+                current[group] += 1
+                busy.append(current["video"])
+            time.sleep(0.01)
+            with lock:
+                current[group] -= 1
+
+        jobs = [Job(work, ("video",), cost=10, group="video") for _ in range(4)]
+        jobs += [Job(work, ("picture",), cost=1) for _ in range(4)]
+        self.run(Scheduler(4, {"video": 2}), jobs)
+        assert max(busy) == 2
+        # Pictures do not wait for the videos over the limit
+        assert Counter(started[:4]) == {"video": 2, "picture": 2}
+
+    def test_no_group_limit(self):
+        scheduler = Scheduler(4, {"video": None})
+        assert scheduler.limits == {}
+
+    def test_next(self):
+        scheduler = Scheduler(4, {"video": 1})
+        pending = [
+            Job(None, ()),
+            Job(None, (), group="video"),
+            Job(None, (), group="video"),
+        ]
+        assert scheduler._next(pending, Counter()) == 2
+        assert scheduler._next(pending, Counter({"video": 1})) == 0
+        assert scheduler._next(pending, Counter({"video": 1}), 0) is None
@@ -1,8 +1,13 @@
+import json
+import logging
+import os
 import pytest
 import subprocess
+from datetime import date, datetime
 from unittest.mock import mock_open, patch
 
 import recitale.utils
+from recitale.cache import Cache
 
 
 def test_cryptojs_openssl_compatible_encrypt():
@@ -25,6 +30,10 @@ def test_remove_superficial_options():
         "size": 12345678,
         "float": "left",
         "resize": "30%",
+        "draft": False,
+        "reduction-ratio": 3,
+        "threads": 4,
+        "concurrency": 2,
     }
     to_keep = {"test": 123, "something": "else"}
     options.update(to_keep)
@@ -59,7 +68,7 @@ class TestLoadSettings:
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch("recitale.utils.yaml.safe_load", return_value=[])
+    @patch("recitale.utils.parse_yaml", return_value=[])
     def test_not_dict_settings_yaml(self, mock_yaml):
         with pytest.raises(SystemExit) as sysexit, patch("builtins.open", mock_open()):
             recitale.utils.load_settings(".")
@@ -67,7 +76,7 @@ class TestLoadSettings:
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch("recitale.utils.yaml.safe_load", return_value={})
+    @patch("recitale.utils.parse_yaml", return_value={})
     def test_missing_title(self, mock_yaml):
         with pytest.raises(SystemExit) as sysexit, patch("builtins.open", mock_open()):
             recitale.utils.load_settings(".")
@@ -76,7 +85,7 @@ class TestLoadSettings:
         assert sysexit.value.code == 1
 
     @patch(
-        "recitale.utils.yaml.safe_load",
+        "recitale.utils.parse_yaml",
         return_value={"title": "test", "date": "01-01-1970"},
     )
     def test_bad_date_format(self, mock_yaml):
@@ -86,9 +95,255 @@ class TestLoadSettings:
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch("recitale.utils.yaml.safe_load", return_value={"title": "test"})
+    @patch("recitale.utils.parse_yaml", return_value={"title": "test"})
     def test_valid_settings(self, mock_yaml):
         with patch("builtins.open", mock_open()):
             settings = recitale.utils.load_settings(".")
 
         assert settings == {"title": "test"}
+
+    def test_error_line(self, tmp_path, monkeypatch, caplog):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "settings.yaml").write_text("title: test\nsections: [a\ncover: b\n")
+        with pytest.raises(SystemExit):
+            recitale.utils.load_settings(".")
+
+        assert "There is something wrong in ./settings.yaml" in caplog.text
+        assert "line 2, column 11:\n    sections: [a" in caplog.text
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(recitale.utils, "parsed_settings", {})
+    (tmp_path / "settings.yaml").write_text("title: root\n")
+    for gallery in ("first", "first/sub", "second"):
+        (tmp_path / gallery).mkdir()
+        (tmp_path / gallery / "settings.yaml").write_text(
+            "title: %s\ndate: 2020-01-01\n" % gallery
+        )
+    # Not part of the site
+    for directory in ("build/first", "pictures/third", ".git"):
+        (tmp_path / directory).mkdir(parents=True)
+        (tmp_path / directory / "settings.yaml").write_text("title: none\n")
+    return tmp_path
+
+
+class TestPreloadSettings:
+    def test_find_settings(self, site):
+        assert sorted(recitale.utils.find_settings()) == [
+            str(site / gallery / "settings.yaml")
+            for gallery in ("first", "first/sub", "second")
+        ] + [str(site / "settings.yaml")]
+
+    def test_parsed_once(self, site):
+        recitale.utils.preload_settings()
+        with patch("recitale.utils.parse_yaml") as mock_yaml:
+            settings = recitale.utils.load_settings("first/sub")
+            recitale.utils.load_settings("first/sub")
+
+        mock_yaml.assert_not_called()
+        assert settings == {"title": "first/sub", "date": date(2020, 1, 1)}
+
+    def test_copies(self, site):
+        settings = recitale.utils.load_settings("second")
+        settings["title"] = "changed"
+
+        assert recitale.utils.load_settings("second")["title"] == "second"
+
+    def test_cached(self, site, monkeypatch):
+        recitale.utils.preload_settings()
+        assert (site / ".recitale_cache" / "settings.json").exists()
+
+        monkeypatch.setattr(recitale.utils, "parsed_settings", {})
+        (site / "second" / "settings.yaml").write_text("title: modified\n")
+        with patch(
+            "recitale.utils.parse_yaml", wraps=recitale.utils.parse_yaml
+        ) as mock_yaml:
+            recitale.utils.preload_settings()
+            assert recitale.utils.load_settings("first")["title"] == "first"
+            assert recitale.utils.load_settings("second")["title"] == "modified"
+
+        mock_yaml.assert_called_once_with("title: modified\n")
+
+    def test_legacy_cache_file(self, site, monkeypatch):
+        legacy = site / ".recitale_cache"
+        legacy.write_text(json.dumps({"version": 4, "sources": {}}))
+        recitale.utils.preload_settings()
+
+        assert recitale.utils.load_settings("first")["title"] == "first"
+        # Left for Cache() to migrate
+        assert json.loads(legacy.read_text()) == {"version": 4, "sources": {}}
+        Cache(legacy)
+        monkeypatch.setattr(recitale.utils, "parsed_settings", {})
+        recitale.utils.preload_settings()
+        assert (legacy / "settings.json").exists()
+
+    @pytest.mark.parametrize(
+        "yaml, expected",
+        [
+            (
+                "title: a\ndate: 2020-01-01\nat: 2020-01-01 10:20:30\n",
+                {
+                    "title": "a",
+                    "date": date(2020, 1, 1),
+                    "at": datetime(2020, 1, 1, 10, 20, 30),
+                },
+            ),
+            ('title: a\nsections: [{"$date": "2020-01-01"}]\n', None),
+            ("title: a\n1: one\n", None),
+        ],
+    )
+    def test_json(self, site, monkeypatch, yaml, expected):
+        (site / "second" / "settings.yaml").write_text(yaml)
+        recitale.utils.preload_settings()
+        monkeypatch.setattr(recitale.utils, "parsed_settings", {})
+        recitale.utils.preload_settings()
+
+        if expected is None:
+            # Would not be the same once decoded, parsed again on each load
+            assert str(site / "second" / "settings.yaml") not in (
+                recitale.utils.parsed_settings
+            )
+            expected = recitale.utils.parse_yaml(yaml)
+        assert recitale.utils.load_settings("second") == expected
+
+    def test_corrupted_cache(self, site, caplog):
+        caplog.set_level(logging.DEBUG)
+        (site / ".recitale_cache").mkdir()
+        (site / ".recitale_cache" / "settings.json").write_text("{")
+        recitale.utils.preload_settings()
+
+        assert "Cannot read" in caplog.text
+        assert recitale.utils.load_settings("first")["title"] == "first"
+
+    def test_parallel(self, site, monkeypatch):
+        monkeypatch.setattr(recitale.utils, "PARALLEL_SETTINGS_SIZE", 0)
+        recitale.utils.preload_settings(2)
+
+        assert len(recitale.utils.parsed_settings) == 4
+        assert recitale.utils.load_settings(".") == {"title": "root"}
+
+    def test_error_reported_on_load(self, site, caplog):
+        (site / "second" / "settings.yaml").write_text("title: [a\n")
+        recitale.utils.preload_settings()
+
+        assert "second" not in caplog.text
+        with pytest.raises(SystemExit):
+            recitale.utils.load_settings("second")
+        assert "There is something wrong in second/settings.yaml" in caplog.text
+
+
+class TestSyncTree:
+    def tree(self, root):
+        return {
+            str(path.relative_to(root)): path.read_bytes() if path.is_file() else None
+            for path in root.rglob("*")
+        }
+
+    def test_copy(self, tmp_path):
+        src = tmp_path / "src"
+        src.joinpath("css").mkdir(parents=True)
+        src.joinpath("empty").mkdir()
+        src.joinpath("css", "main.css").write_bytes(b"body {}")
+        src.joinpath("app.js").write_bytes(b"alert()")
+        dst = tmp_path / "build" / "static"
+
+        recitale.utils.sync_tree(src, dst)
+
+        assert self.tree(dst) == self.tree(src)
+        assert (
+            dst.joinpath("app.js").stat().st_mtime_ns
+            == src.joinpath("app.js").stat().st_mtime_ns
+        )
+
+    def test_unchanged_not_copied(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        src.joinpath("app.js").write_bytes(b"alert()")
+        dst = tmp_path / "dst"
+        recitale.utils.sync_tree(src, dst)
+        inode = dst.joinpath("app.js").stat().st_ino
+
+        with patch("recitale.utils.copy_file") as copy_file:
+            recitale.utils.sync_tree(src, dst)
+        copy_file.assert_not_called()
+        assert dst.joinpath("app.js").stat().st_ino == inode
+
+    def test_changed_copied(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        src.joinpath("app.js").write_bytes(b"alert()")
+        src.joinpath("main.css").write_bytes(b"body {}")
+        dst = tmp_path / "dst"
+        recitale.utils.sync_tree(src, dst)
+
+        src.joinpath("app.js").write_bytes(b"alert(1)")
+        mtime = src.joinpath("main.css").stat().st_mtime_ns + 1000000000
+        src.joinpath("main.css").write_bytes(b"html {}")
+        os.utime(src.joinpath("main.css"), ns=(mtime, mtime))
+        recitale.utils.sync_tree(src, dst)
+
+        assert self.tree(dst) == self.tree(src)
+
+    def test_stale_removed(self, tmp_path):
+        src = tmp_path / "src"
+        src.joinpath("js").mkdir(parents=True)
+        src.joinpath("js", "app.js").write_bytes(b"alert()")
+        dst = tmp_path / "dst"
+        dst.joinpath("js").mkdir(parents=True)
+        dst.joinpath("js", "old.js").write_bytes(b"old")
+        dst.joinpath("fonts", "sub").mkdir(parents=True)
+        dst.joinpath("fonts", "sub", "font.woff").write_bytes(b"font")
+        # A directory in place of a file and the other way around
+        dst.joinpath("js", "app.js").mkdir()
+        src.joinpath("img").mkdir()
+        dst.joinpath("img").write_bytes(b"img")
+
+        recitale.utils.sync_tree(src, dst)
+
+        assert self.tree(dst) == self.tree(src)
+
+    def test_hardlink_not_written_through(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        src.joinpath("app.js").write_bytes(b"alert(1)")
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        other = tmp_path / "other.js"
+        other.write_bytes(b"alert()")
+        os.link(other, dst.joinpath("app.js"))
+
+        recitale.utils.sync_tree(src, dst)
+
+        assert dst.joinpath("app.js").read_bytes() == b"alert(1)"
+        assert other.read_bytes() == b"alert()"
+
+    def test_suffixes_kept(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        src.joinpath("style.css").write_bytes(b"body {}")
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        dst.joinpath("style.css.gz").write_bytes(b"gzip")
+        dst.joinpath("old.css.gz").write_bytes(b"gzip")
+
+        recitale.utils.sync_tree(src, dst, (".gz", ".br"))
+
+        assert sorted(path.name for path in dst.iterdir()) == [
+            "style.css",
+            "style.css.gz",
+        ]
+
+    def test_keep(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        src.joinpath("style.css").write_bytes(b"body {}")
+        dst = tmp_path / "dst"
+        dst.joinpath("css").mkdir(parents=True)
+        dst.joinpath("css", "bundle.css").write_bytes(b"body {}")
+        dst.joinpath("css", "old.css").write_bytes(b"body {}")
+
+        recitale.utils.sync_tree(src, dst, keep=["css/bundle.css"])
+
+        assert sorted(self.tree(dst)) == ["css", "css/bundle.css", "style.css"]
@@ -2,10 +2,10 @@ import pytest
 
 from json import dumps as json_dumps
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from zlib import crc32
 
-from recitale.video import BaseVideo, VideoFactory, Thumbnail, Reencode
+from recitale.video import BaseVideo, VideoFactory, Thumbnail, Reencode, probe
 from recitale.utils import remove_superficial_options
 
 
@@ -56,6 +56,68 @@ class TestVideoCommon:
             assert bvid.duration == 10.4
         assert bvid.duration == 10.4
 
+    def test_probe_cached(self):
+        VideoFactory.global_options = {"binary": "ffmpeg", "extension": "webm"}
+        bvid = BaseVideo({"name": "test.mp4"}, VideoFactory.global_options)
+        cache = MagicMock()
+        cache.probe_infos.return_value = {"width": 840, "height": 480, "duration": 3}
+        with patch.object(VideoFactory, "cache", cache), patch(
+            "recitale.video.subprocess.check_output"
+        ) as mock_probe:
+            assert bvid.ratio == 840 / 480
+            assert bvid.duration == 3
+        mock_probe.assert_not_called()
+        cache.probe_infos.assert_called_once_with("test.mp4")
+
+    def test_probe_stored(self):
+        VideoFactory.global_options = {"binary": "ffmpeg", "extension": "webm"}
+        bvid = BaseVideo({"name": "test.mp4"}, VideoFactory.global_options)
+        cache = MagicMock()
+        cache.probe_infos.return_value = None
+        with patch.object(VideoFactory, "cache", cache), patch(
+            "recitale.video.subprocess.check_output", return_value=self.check_output
+        ):
+            assert bvid.duration == 10.4
+        cache.store_probe_infos.assert_called_once_with(
+            "test.mp4",
+            {
+                "width": 840,
+                "height": 480,
+                "duration": 10.4,
+                "codecs": [],
+                "bitrate": None,
+            },
+        )
+
+
+def test_probe():
+    VideoFactory.global_options = {"binary": "ffmpeg", "extension": "webm"}
+    output = (
+        '{"streams": [{"codec_type": "audio", "codec_name": "aac"}, {"codec_type": '
+        '"video", "codec_name": "h264", "width": 1920, "height": 1080}], '
+        '"format": {"duration": "2.5", "bit_rate": "4000000"}}'
+    )
+    with patch("recitale.video.subprocess.check_output", return_value=output):
+        assert probe("test.mp4") == {
+            "width": 1920,
+            "height": 1080,
+            "duration": 2.5,
+            "codecs": ["aac", "h264"],
+            "bitrate": 4000000,
+        }
+
+
+def test_probe_no_video_stream():
+    VideoFactory.global_options = {"binary": "ffmpeg", "extension": "webm"}
+    output = (
+        '{"streams": [{"codec_type": "audio", "codec_name": "vorbis"}], '
+        '"format": {"duration": "2.5", "bit_rate": "128000"}}'
+    )
+    with patch(
+        "recitale.video.subprocess.check_output", return_value=output
+    ), pytest.raises(ValueError):
+        probe("test.webm")
+
 
 class TestBaseVideo:
     def test_baseid(self):
@@ -77,6 +139,24 @@ class TestBaseVideo:
         mock_rm_sup_opt.assert_called_with({"name": "test.mp4", "some": "options"})
         assert base1.chksum_opt == base2.chksum_opt
 
+    def test_threads(self):
+        base = BaseVideo({"name": "test.mp4"}, {"threads": 4})
+        assert base.threads == 4
+        assert "threads" not in base.options
+        assert BaseVideo({"name": "test.mp4"}, {}).threads == 2
+
+    def test_cost(self):
+        base = BaseVideo({"name": "test.mp4"}, {})
+        base.dur = 10.4
+        assert base.cost(reencodes=1) == 10400
+        assert base.cost(reencodes=2, thumbnails=3) == 21400
+
+    def test_cost_thumbnails_no_probe(self):
+        base = BaseVideo({"name": "test.mp4"}, {})
+        with patch("recitale.video.subprocess.check_output") as mock_probe:
+            assert base.cost(thumbnails=3) == 600
+        mock_probe.assert_not_called()
+
     def test_reencode_same_obj(self):
         base = BaseVideo({"name": "test.mp4", "extension": "webm"}, {})
         reencode1 = Reencode(
@@ -193,3 +273,18 @@ class TestVideoFactory:
         base_vids = VideoFactory.base_vids
         assert len(base_vids.keys()) == 1
         assert vid1 is list(base_vids.values())[0]
+
+    def test_merge(self):
+        vid = VideoFactory.get("gallery", {"name": "test.mp4"})
+        vid.thumbnail((None, 100))
+        base_vids = VideoFactory.base_vids
+        VideoFactory.base_vids = dict()
+        other = VideoFactory.get("gallery", {"name": "test.mp4"})
+        other.thumbnail((None, 200))
+        other.reencode((1280, 720))
+        merged = VideoFactory.base_vids
+        VideoFactory.base_vids = base_vids
+        VideoFactory.merge(merged)
+        assert list(VideoFactory.base_vids.values()) == [vid]
+        assert len(vid.thumbnails) == 2
+        assert len(vid.reencodes) == 1
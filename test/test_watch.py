@@ -0,0 +1,63 @@
+import pytest
+
+from recitale.watch import InotifyWatcher, PollingWatcher, Watcher, get_watcher
+
+
+@pytest.fixture(params=[InotifyWatcher, PollingWatcher])
+def watcher_class(request, monkeypatch):
+    monkeypatch.setattr(PollingWatcher, "interval", 0.05)
+    return request.param
+
+
+@pytest.fixture
+def site(tmp_path):
+    tmp_path.joinpath("gallery").mkdir()
+    tmp_path.joinpath("gallery", "settings.yaml").write_text("title: gallery")
+    tmp_path.joinpath("build").mkdir()
+    tmp_path.joinpath(".recitale_cache").mkdir()
+    return tmp_path
+
+
+def test_changes(site, watcher_class):
+    watcher = watcher_class([site], ["build"])
+    try:
+        assert watcher.changes(0.1) == set()
+        site.joinpath("gallery", "settings.yaml").write_text("title: other")
+        assert watcher.wait() == {site.joinpath("gallery", "settings.yaml")}
+    finally:
+        watcher.close()
+
+
+def test_new_directory(site, watcher_class):
+    watcher = watcher_class([site], ["build"])
+    try:
+        site.joinpath("new").mkdir()
+        assert site.joinpath("new") in watcher.wait()
+        site.joinpath("new", "img.jpg").write_bytes(b"jpg")
+        assert watcher.wait() == {site.joinpath("new", "img.jpg")}
+    finally:
+        watcher.close()
+
+
+def test_ignored(site, watcher_class):
+    watcher = watcher_class([site], ["build"])
+    try:
+        site.joinpath("build", "index.html").write_text("html")
+        site.joinpath(".recitale_cache", "cache.sqlite").write_text("db")
+        site.joinpath("gallery", ".settings.yaml.swp").write_text("swap")
+        assert watcher.changes(0.3) == set()
+    finally:
+        watcher.close()
+
+
+def test_get_watcher_fallback(site, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise OSError("inotify is not available")
+
+    monkeypatch.setattr(InotifyWatcher, "__init__", unavailable)
+    assert isinstance(get_watcher([site]), PollingWatcher)
+
+
+def test_watcher_abstract(site):
+    with pytest.raises(TypeError):
+        Watcher([site])